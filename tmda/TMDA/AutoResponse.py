@@ -31,6 +31,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formataddr, parseaddr
 
+import fcntl
 import os
 import time
 
@@ -232,13 +233,96 @@ class AutoResponse:
         response rate limiting feature, controlled by
         Defaults.MAX_AUTORESPONSES_PER_DAY.
         """
-        response_filename = '%s.%s.%s' % (int(time.time()),
-                                          Defaults.PID,
-                                          Util.normalize_sender(self.recipient))
-        # Create ~/.tmda/responses if necessary.
-        if not os.path.exists(Defaults.RESPONSE_DIR):
-            os.makedirs(Defaults.RESPONSE_DIR, 0700)
-        fp = open(os.path.join(Defaults.RESPONSE_DIR,
-                               response_filename), 'w')
+        record_response(self.recipient)
+
+
+# Auto responses are recorded in RESPONSE_DIR, in one file per sender
+# named after the normalized sender address.  Each line of the file is
+# the time of a response sent to that sender.
+
+def _response_file(sender):
+    name = Util.normalize_sender(sender)
+    # Keep clear of '.', '..' and our own dot files.
+    if not name or name.startswith('.'):
+        name = '_' + name
+    return os.path.join(Defaults.RESPONSE_DIR, name)
+
+
+def _recent(lines, now):
+    """Return the lines of a response file recorded in the last day."""
+    day = Util.seconds('1d')
+    recent = []
+    for line in lines:
+        try:
+            timestamp = int(line)
+        except ValueError:
+            continue
+        if now <= timestamp + day:
+            recent.append(line)
+    return recent
+
+
+def responses_sent(sender):
+    """
+    Return the number of auto responses sent to sender in the last
+    day.
+    """
+    try:
+        fp = open(_response_file(sender), 'r')
+    except IOError:
+        return 0
+    try:
+        return len(_recent(fp.readlines(), int(time.time())))
+    finally:
         fp.close()
 
+
+def record_response(sender):
+    """
+    Record an auto response sent to sender, forgetting any of its
+    responses more than one day old.
+    """
+    # Create ~/.tmda/responses if necessary.
+    if not os.path.exists(Defaults.RESPONSE_DIR):
+        os.makedirs(Defaults.RESPONSE_DIR, 0700)
+    now = int(time.time())
+    fp = open(_response_file(sender), 'a+')
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        fp.seek(0)
+        lines = fp.readlines()
+        recent = _recent(lines, now)
+        if len(recent) < len(lines):
+            fp.seek(0)
+            fp.truncate()
+            fp.writelines(recent)
+        fp.seek(0, 2)
+        fp.write('%d\n' % now)
+    finally:
+        # Closing the file releases the lock.
+        fp.close()
+    _expire_responses(now)
+
+
+def _expire_responses(now):
+    """
+    Once a day, delete the files of senders who haven't been sent an
+    auto response for a day.  RESPONSE_DIR/.expired records when this
+    was last done.
+    """
+    day = Util.seconds('1d')
+    stamp = os.path.join(Defaults.RESPONSE_DIR, '.expired')
+    try:
+        if now <= os.path.getmtime(stamp) + day:
+            return
+    except OSError:
+        pass
+    open(stamp, 'w').close()
+    for name in os.listdir(Defaults.RESPONSE_DIR):
+        path = os.path.join(Defaults.RESPONSE_DIR, name)
+        try:
+            if name != '.expired' and now > os.path.getmtime(path) + day:
+                os.unlink(path)
+        except OSError:
+            # ignore files removed by a concurrent expiry
+            pass
@@ -0,0 +1,165 @@
+# -*- python -*-
+#
+# Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""Snapshots of the resolved TMDA configuration (CONFIG_SNAPSHOT).
+
+A snapshot holds the variables of TMDA.Defaults after the
+configuration files have been read and the defaults filled in.  It is
+only valid while the files it was made from, and the parts of the
+environment that Defaults consults, are unchanged.
+
+This module is imported by Defaults before the configuration is read,
+so it must not import any other TMDA module.
+"""
+
+
+import marshal
+import os
+import sys
+import types
+
+
+# Bump this when the snapshot layout changes.
+FORMAT = 1
+
+# Environment variables that Defaults and the functions it calls read.
+ENVIRONMENT = ('GLOBAL_TMDARC', 'TMDARC', 'HOME',
+               'TMDA_FILTER_INCOMING', 'TMDA_FILTER_OUTGOING',
+               'TMDA_CGI_MODE',
+               'TMDAHOST', 'QMAILHOST', 'MAILHOST',
+               'TMDANAME', 'QMAILNAME', 'NAME', 'MAILNAME',
+               'TMDAUSER', 'QMAILUSER', 'USER', 'LOGNAME')
+
+# Files whose contents the configuration depends on.
+FILES = ('GLOBAL_TMDARC', 'TMDARC', 'CRYPT_KEY_FILE')
+
+# Variables which are set afresh by every process, or depend on the
+# program that is run.
+TRANSIENT = ('PID', 'progpath', 'progdir', 'linkpath')
+
+
+def _stat(path):
+    """Return what is compared of path, or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_mode, st.st_ino)
+
+
+def _context(source, parentdir):
+    """Return the parts of the process environment a snapshot is
+    tied to."""
+    return (FORMAT, sys.version, os.getuid(), parentdir,
+            [os.environ.get(name) for name in ENVIRONMENT],
+            _stat(source))
+
+
+def stamp(source, parentdir, namespace):
+    """Return what the configuration in namespace depends on, for
+    unchanged() to check later.
+
+    source is the path of Defaults.py, and parentdir its PARENTDIR.
+    """
+    files = []
+    for name in FILES:
+        filename = namespace.get(name)
+        if filename:
+            files.append((filename, _stat(filename)))
+    return (_context(source, parentdir), files)
+
+
+def unchanged(stamp, source, parentdir):
+    """Return true if nothing recorded in stamp has changed since."""
+    (context, files) = stamp
+    if context != _context(source, parentdir):
+        return False
+    for (filename, stat) in files:
+        if _stat(filename) != stat:
+            return False
+    return True
+
+
+# The paths load() found a snapshot at, valid or not.
+_found = {}
+
+def load(path, source, parentdir):
+    """Return the variables stored in the snapshot at path, or None if
+    there is no valid snapshot.
+
+    source is the path of Defaults.py, and parentdir its PARENTDIR.
+    """
+    try:
+        fp = open(path, 'rb')
+    except IOError:
+        return None
+    _found[path] = True
+    try:
+        try:
+            (context, files, variables) = marshal.load(fp)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        fp.close()
+    if not unchanged((context, files), source, parentdir):
+        return None
+    return variables
+
+
+def save(path, source, parentdir, namespace):
+    """Store the variables in namespace as a snapshot at path.  Return
+    false if some variable can't be stored, or the file can't be
+    written."""
+    variables = {}
+    for (name, value) in namespace.items():
+        if name.startswith('_') or name in TRANSIENT or \
+               isinstance(value, types.ModuleType):
+            continue
+        variables[name] = value
+    (context, files) = stamp(source, parentdir, variables)
+    try:
+        data = marshal.dumps((context, files, variables))
+    except ValueError:
+        # The configuration holds objects, such as a DB_CONNECTION,
+        # that only exist in the process which created them.
+        return False
+    import tempfile
+    try:
+        (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(path))
+    except OSError:
+        return False
+    fp = os.fdopen(fd, 'wb')
+    try:
+        fp.write(data)
+    finally:
+        fp.close()
+    os.rename(tmpname, path)
+    return True
+
+
+def remove(path):
+    """Remove the snapshot at path, if load() found one there."""
+    if not _found.has_key(path):
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
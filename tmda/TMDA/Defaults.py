@@ -38,6 +38,7 @@ import os
 import string
 import sys
 
+import ConfigSnapshot
 import Errors
 
 
@@ -85,6 +86,16 @@ if _tmdarc:
 elif not vars().has_key('TMDARC'):
     TMDARC = os.path.join(HOMEDIR, '.tmda', 'config')
 
+# If CONFIG_SNAPSHOT was on when the configuration was last read, and
+# nothing it depends on has changed since, start from the snapshot
+# taken then.  TMDARC is not read again, and the defaults below are
+# all already set.
+_source = os.path.splitext(__file__)[0] + '.py'
+_snapshot_file = TMDARC + '.snapshot'
+_snapshot = ConfigSnapshot.load(_snapshot_file, _source, PARENTDIR)
+if _snapshot is not None:
+    globals().update(_snapshot)
+
 # CONFIG_EXEC
 # If set to False in GLOBAL_TMDARC, the user's TMDARC file will be parsed
 # using ConfigParser, otherwise it will evaluated as a sequence of
@@ -93,8 +104,21 @@ elif not vars().has_key('TMDARC'):
 if not vars().has_key('CONFIG_EXEC'):
     CONFIG_EXEC = True
 
+# CONFIG_SNAPSHOT
+# If set to True, the fully resolved configuration is saved next to
+# TMDARC (as TMDARC.snapshot), and later TMDA processes load it
+# instead of reading TMDARC and working out the defaults again.  The snapshot is discarded when either file, the
+# key file, or a relevant environment variable changes.  Don't use it
+# if your configuration depends on anything else, such as other
+# files it reads or the time of day.  It is also not used when the
+# configuration holds objects like a DB_CONNECTION.
+#
+# Default is False
+if not vars().has_key('CONFIG_SNAPSHOT'):
+    CONFIG_SNAPSHOT = False
+
 # Read-in the user's configuration file.
-if os.path.exists(TMDARC):
+if os.path.exists(TMDARC) and _snapshot is None:
     if CONFIG_EXEC:
         execfile(TMDARC)
     else:
@@ -588,6 +612,126 @@ if env_FILTER_OUTGOING:
 elif not vars().has_key('FILTER_OUTGOING'):
     FILTER_OUTGOING = os.path.join(DATADIR, 'filters', 'outgoing')
 
+# FILTER_COMPILE
+# Set this variable to True if you want TMDA to save a compiled copy
+# of each filter file after it has been parsed.  The compiled copy is
+# stored next to the filter file with a `.compiled' suffix (e.g,
+# ~/.tmda/filters/incoming.compiled) and is loaded instead of
+# reparsing the filter on subsequent runs.  It is transparently
+# rebuilt whenever the filter file, any file it includes, or any
+# ${VARIABLE} it references changes.  Large filters with many macros
+# and includes benefit the most.
+#
+# If the directory containing the filter file isn't writable, the
+# filter is simply parsed as usual.
+#
+# Default is False (turned off)
+if not vars().has_key('FILTER_COMPILE'):
+    FILTER_COMPILE = False
+
+# FILTER_BODY_MAXBYTES
+# The number of bytes at the start of a message body that `body' and
+# `body-file' filter rules search, so that a large attachment can't
+# make filtering take longer.  A rule's `-maxbytes=N' argument
+# overrides this for that rule, and `-maxbytes=0' searches the whole
+# body.
+#
+# Example:
+# FILTER_BODY_MAXBYTES = 65536
+#
+# Default is None (search the whole body)
+if not vars().has_key('FILTER_BODY_MAXBYTES'):
+    FILTER_BODY_MAXBYTES = None
+
+# FILTER_BODY_TEXT
+# Set this variable to True to have `body' and `body-file' filter
+# rules search only the text parts of a message, decoded from any
+# base64 or quoted-printable encoding, rather than the raw body with
+# its attachments.  FILTER_BODY_MAXBYTES then applies to the decoded
+# text, and only four times as many bytes of the raw body are parsed
+# for it.  A rule's `-text' argument does the same for that rule.
+#
+# Default is False (search the raw body)
+if not vars().has_key('FILTER_BODY_TEXT'):
+    FILTER_BODY_TEXT = False
+
+# FILTER_PIPE_TIMEOUT
+# The number of seconds that the command of a `pipe -persistent' or
+# `pipe-headers -persistent' filter rule has to answer for a message.
+# A command that takes longer is killed, the rule fails, and the
+# message is deferred.  The command is started again for the next
+# message.
+#
+# A persistent command is only kept running between messages by a
+# resident process such as tmda-filterd.  A plain tmda-filter exits
+# after its one message, so there `-persistent' gains nothing.
+#
+# Default is 30
+if not vars().has_key('FILTER_PIPE_TIMEOUT'):
+    FILTER_PIPE_TIMEOUT = 30
+
+# FILTER_TIMEOUT
+# The number of seconds that checking a message against a filter file
+# may take.  Once it has taken longer, the message gets
+# FILTER_TIMEOUT_ACTION.  A rule that is already running when time
+# runs out is only stopped if it is one of the slow rules described
+# under FILTER_RULE_TIMEOUT.
+#
+# Example:
+# FILTER_TIMEOUT = 60
+#
+# Default is None (no limit)
+if not vars().has_key('FILTER_TIMEOUT'):
+    FILTER_TIMEOUT = None
+
+# FILTER_RULE_TIMEOUT
+# The number of seconds that a single slow filter rule, one with a
+# `from-dbm', `to-dbm', `from-sql', `to-sql', `pipe' or `pipe-headers'
+# source, may take.  A rule's `-timeout=SECONDS' argument overrides
+# this for that rule.  A rule that takes longer gives the message
+# FILTER_TIMEOUT_ACTION; a pipe command is killed, and a lookup is
+# left to finish unheeded.
+#
+# An SQL lookup can only be stopped this way if the DB API module of
+# DB_CONNECTION lets threads share a connection (its `threadsafety' is
+# 2 or more).  Otherwise the lookup runs to the end, and only then
+# counts towards FILTER_TIMEOUT.
+#
+# Example:
+# FILTER_RULE_TIMEOUT = 10
+#
+# Default is None (no limit)
+if not vars().has_key('FILTER_RULE_TIMEOUT'):
+    FILTER_RULE_TIMEOUT = None
+
+# FILTER_TIMEOUT_ACTION
+# The action an incoming message gets when filtering it runs out of
+# time (see FILTER_TIMEOUT and FILTER_RULE_TIMEOUT), written as in the
+# incoming filter file, e.g, "hold" or "confirm".  If it is None,
+# delivery of the message is deferred, so that the MTA tries it again
+# later.  It isn't used for the outgoing filter: tmda-inject always
+# fails with a temporary error when that runs out of time.
+#
+# Example:
+# FILTER_TIMEOUT_ACTION = "hold"
+#
+# Default is None (defer the message)
+if not vars().has_key('FILTER_TIMEOUT_ACTION'):
+    FILTER_TIMEOUT_ACTION = None
+
+# FILTER_PREFETCH
+# The number of slow filter rules (see FILTER_RULE_TIMEOUT) that are
+# looked up in the background, ahead of the rules before them, while
+# those are checked.  The first matching rule still decides what
+# happens to the message, but slow rules no longer wait for each other.
+# A pipe command may then be run for a message that an earlier rule
+# already matched, so only use this with commands that do nothing but
+# answer.
+#
+# Default is 0 (check every rule in turn)
+if not vars().has_key('FILTER_PREFETCH'):
+    FILTER_PREFETCH = 0
+
 # FILTER_BOUNCE_CC
 # An optional e-mail address which will be sent a copy of any message
 # that bounces because of a match in FILTER_INCOMING.
@@ -962,7 +1106,8 @@ if not vars().has_key('MAX_AUTORESPONSES_PER_DAY'):
 
 # RESPONSE_DIR
 # Full path to a directory containing auto-response rate-limiting
-# information.  Only consulted if MAX_AUTORESPONSES_PER_DAY != 0
+# information, one file per sender.  Only consulted if
+# MAX_AUTORESPONSES_PER_DAY != 0
 #
 # Default is ~/.tmda/responses
 if not vars().has_key('RESPONSE_DIR') and MAX_AUTORESPONSES_PER_DAY != 0:
@@ -991,14 +1136,37 @@ if not vars().has_key('AUTORESPONSE_INCLUDE_SENDER_COPY'):
 # created by importing the appropriate module and calling the connect()
 # function.
 #
-# Example:
+# DB_CONNECTION may instead be a function which returns a new
+# connection.  TMDA then only connects when it first needs the
+# database, keeps the connection for as long as the program runs,
+# checks it before reusing it (see DB_CHECK_INTERVAL), and connects
+# again if it fails.  This also lets tmda-filterd share the
+# configuration with the children that filter each message.
+#
+# Statements may use %(name)s parameters whatever the paramstyle of the
+# database module; they are rewritten for modules such as sqlite3.
+#
+# Examples:
 # import MySQLdb
 # DB_CONNECTION = MySQLdb.connect("...")
 #
+# def DB_CONNECTION():
+#     import MySQLdb
+#     return MySQLdb.connect("...")
+#
 # Default is None
 if not vars().has_key('DB_CONNECTION'):
     DB_CONNECTION = None
 
+# DB_CHECK_INTERVAL
+# When DB_CONNECTION is a function, the number of seconds a connection
+# may be left unused before it is checked, with a `SELECT 1', the next
+# time it is needed.  A connection that fails the check is replaced.
+#
+# Default is 60
+if not vars().has_key('DB_CHECK_INTERVAL'):
+    DB_CHECK_INTERVAL = 60
+
 # DB_CONFIRM_APPEND
 # SQL INSERT statement to be used to insert confirmed sender addresses
 # into a SQL database. The Python DB API will take care of properly
@@ -1077,6 +1245,14 @@ if not vars().has_key('PENDING_DIR'):
 #      was introduced with the qmail system by D.J. Bernstein.  For
 #      more information, see http://wiki.tmda.net/TmdaPendingAsMaildir
 #
+# "sqlite"
+#      Messages are stored in an SQLite database, PENDING_DIR/pending.db,
+#      along with indexed columns for their date, recipient, sender and
+#      subject, so that listing and cleaning up a large queue doesn't
+#      require reading every message.  When the database is created, any
+#      messages already in PENDING_DIR in the "original" or "maildir"
+#      format are moved into it.
+#
 # Default is "original".
 if not vars().has_key('PENDING_QUEUE_FORMAT'):
     PENDING_QUEUE_FORMAT = 'original'
@@ -1119,14 +1295,50 @@ if not vars().has_key('PENDING_LIFETIME'):
 # PENDING_CLEANUP_ODDS = 1.0   # 100% chance
 # PENDING_CLEANUP_ODDS = 0.025 # 2.5% chance
 #
+# PENDING_CLEANUP_ODDS is only used when PENDING_CLEANUP_INTERVAL is
+# None, except that 0.0 always disables automatic cleanup.
+#
 # Default is 0.01, or 1% chance of cleanup for every message received,
 # or cleanup approximately once per 100 messages received.
 if not vars().has_key('PENDING_CLEANUP_ODDS'):
     PENDING_CLEANUP_ODDS = 0.01
 
+# PENDING_CLEANUP_INTERVAL
+# A time interval describing how often tmda-filter should clean the
+# pending queue of expired messages.  When a message arrives and the
+# last cleanup started longer ago than this, a cleanup is started in
+# the background, so that delivery of the message doesn't wait for it.
+# Only one cleanup of a queue runs at a time; the time of the last one
+# is recorded in PENDING_DIR/.cleanup.
+#
+# Set it to None to fall back to a random cleanup, controlled by
+# PENDING_CLEANUP_ODDS, that runs before the message is filtered.
+#
+# Examples:
+#
+# PENDING_CLEANUP_INTERVAL = "15m"
+# PENDING_CLEANUP_INTERVAL = None
+#
+# Default is 1h (at most one cleanup an hour)
+if not vars().has_key('PENDING_CLEANUP_INTERVAL'):
+    PENDING_CLEANUP_INTERVAL = '1h'
+
+# PENDING_CLEANUP_BATCH
+# The maximum number of expired messages deleted by one cleanup of the
+# pending queue.  Messages are deleted oldest first, and any expired
+# messages left over are deleted by later cleanups.  This keeps an
+# unlucky incoming message from paying for the cleanup of a large
+# backlog (e.g, after PENDING_LIFETIME was shortened).  Set it to 0 to
+# delete all expired messages at once.
+#
+# Default is 500
+if not vars().has_key('PENDING_CLEANUP_BATCH'):
+    PENDING_CLEANUP_BATCH = 500
+
 # PENDING_CACHE
 # Path to the cache file used when tmda-pending is invoked with the
-# --cache option.
+# --cache option.  The file lists one message id per line; a cache
+# pickled by an earlier version is converted when first read.
 #
 # Default is ~/.tmda/.pendingcache
 if not vars().has_key('PENDING_CACHE'):
@@ -1142,6 +1354,26 @@ if not vars().has_key('PENDING_CACHE'):
 if not vars().has_key('PENDING_CACHE_LEN'):
     PENDING_CACHE_LEN = 5000
 
+# PENDING_RELEASE_WORKERS
+# An integer which specifies how many messages "tmda-pending -b -r"
+# hands to SENDMAIL_PROGRAM at the same time when releasing several
+# messages.  With the "smtp" MAIL_TRANSPORT the messages are instead
+# sent one after another over a single SMTP connection.
+#
+# Default is 4
+if not vars().has_key('PENDING_RELEASE_WORKERS'):
+    PENDING_RELEASE_WORKERS = 4
+
+# PENDING_SCAN_THREADS
+# An integer which specifies how many threads "tmda-pending -b" uses
+# to read messages from the pending queue ahead of listing or
+# disposing of them.  Set to 1 to read one message at a time.  The
+# "sqlite" PENDING_QUEUE_FORMAT is always read one message at a time.
+#
+# Default is 4
+if not vars().has_key('PENDING_SCAN_THREADS'):
+    PENDING_SCAN_THREADS = 4
+
 # PENDING_BLACKLIST_APPEND
 # Filename to which a sender's e-mail address should be appended
 # when a message is "blacklisted" by tmda-pending.
@@ -1730,8 +1962,11 @@ for var in _path_vars:
     if _defaults.has_key(var) and isinstance(_defaults[var], str):
         _defaults[var] = os.path.expanduser(_defaults[var])
 
-# Finish processing CRYPT_KEY_FILE/CRYPT_KEY
-if os.path.exists(CRYPT_KEY_FILE):
+# Finish processing CRYPT_KEY_FILE/CRYPT_KEY.  A snapshot is only
+# valid if the key file is unchanged, so it has been checked already.
+if _snapshot is not None:
+    pass
+elif os.path.exists(CRYPT_KEY_FILE):
     if os.name == 'posix':
         crypt_key_filemode = Util.getfilemode(CRYPT_KEY_FILE)
         if crypt_key_filemode not in (400, 600):
@@ -1749,12 +1984,20 @@ else:
 
 # Read key from CRYPT_KEY_FILE, and then convert it from hex back into
 # raw binary.  Hex has only 4 bits of entropy per byte as opposed to 8.
-try:
-    CRYPT_KEY = binascii.unhexlify(open(CRYPT_KEY_FILE).read().strip())
-except IOError:
-    if os.environ.has_key('TMDA_CGI_MODE') and \
-           os.environ['TMDA_CGI_MODE'] == 'no-su':
-        pass
+if _snapshot is None:
+    try:
+        CRYPT_KEY = binascii.unhexlify(open(CRYPT_KEY_FILE).read().strip())
+    except IOError:
+        if os.environ.has_key('TMDA_CGI_MODE') and \
+               os.environ['TMDA_CGI_MODE'] == 'no-su':
+            pass
+        else:
+            raise
+
+# Save or discard the snapshot of the configuration.
+if _snapshot is None:
+    if CONFIG_SNAPSHOT:
+        ConfigSnapshot.save(_snapshot_file, _source, PARENTDIR, globals())
     else:
-        raise
+        ConfigSnapshot.remove(_snapshot_file)
 
@@ -0,0 +1,442 @@
+# -*- python -*-
+#
+# Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""A resident tmda-rfilter (tmda-filterd) and its client.
+
+tmda-filterd runs as the user whose mail it filters.  It imports
+TMDA, reads the configuration and parses the incoming filter once,
+and then listens on a Unix socket.  For each message it forks a
+child, which runs tmda-rfilter just as tmda-filter would, with the
+client's arguments, environment, working directory and standard
+input, and sends back the exit status and output.  The configuration
+and filters are read again when the files they came from change.
+
+The client side is kept to what tmda-filter-client needs, so that it
+starts quickly; the daemon imports the rest of TMDA as it starts.
+"""
+
+
+import marshal
+import os
+import socket
+import struct
+import sys
+
+
+# Where tmda-filterd listens, unless TMDA_FILTERD_SOCKET or the
+# --socket option says otherwise.
+SOCKET = '~/.tmda/filterd.sock'
+
+# Exit status when the daemon fails to answer, as MTA.MTA.EX_TEMPFAIL.
+# Like tmda-filter, use it with every MTA; qmail treats it as a
+# temporary failure too.
+EX_TEMPFAIL = 75
+
+
+def socket_path(path=None):
+    """Return the socket to use, given the --socket option if any."""
+    if not path:
+        path = os.environ.get('TMDA_FILTERD_SOCKET') or SOCKET
+    return os.path.expanduser(path)
+
+
+def encode(obj):
+    """Return obj as send() sends it, prefixed by its length."""
+    data = marshal.dumps(obj)
+    return struct.pack('!I', len(data)) + data
+
+
+def send(sock, obj):
+    """Send obj over sock, prefixed by its length."""
+    sock.sendall(encode(obj))
+
+
+def _receive_all(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError, 'connection closed'
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def receive(sock):
+    """Receive an object sent by send()."""
+    (size,) = struct.unpack('!I', _receive_all(sock, 4))
+    return marshal.loads(_receive_all(sock, size))
+
+
+def client(args, fallback):
+    """Filter the message on standard input through tmda-filterd, and
+    return tmda-rfilter's exit status.
+
+    args are the tmda-filter arguments, optionally preceded by
+    --socket=PATH.  If the daemon isn't running, the fallback program
+    (tmda-filter) is run in place of the client.
+    """
+    path = None
+    if args and args[0].startswith('--socket='):
+        path = args[0][len('--socket='):]
+        args = args[1:]
+    elif args and args[0] == '--socket' and len(args) > 1:
+        path = args[1]
+        args = args[2:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(path))
+    except socket.error:
+        os.execv(fallback, [fallback] + args)
+    try:
+        # The daemon reads the request before it forks, and the message
+        # in the child, so send the request before reading stdin.
+        send(sock, { 'argv'    : args,
+                     'environ' : dict(os.environ),
+                     'cwd'     : os.getcwd() })
+        send(sock, sys.stdin.read())
+        (status, stdout, stderr) = receive(sock)
+    except (socket.error, EOFError, ValueError, struct.error), e:
+        sys.stderr.write('tmda-filter-client: %s\n' % e)
+        return EX_TEMPFAIL
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return status
+
+
+def _exit_status(code):
+    """Return the exit status for sys.exit(code)."""
+    if code is None:
+        return 0
+    if isinstance(code, (int, long)):
+        return code
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+
+def _report_failure(tb):
+    """Record an uncaught exception the way tmda-filter does."""
+    import time
+    import traceback
+    fp = sys.stdout
+    try:
+        from TMDA.Defaults import LOGFILE_DEBUG
+        if not LOGFILE_DEBUG:
+            raise NameError, 'LOGFILE_DEBUG is not defined'
+        fp = open(LOGFILE_DEBUG, 'a')
+        print 'See', LOGFILE_DEBUG, 'for traceback'
+    except Exception:
+        try:
+            failure_file = os.path.expanduser('~/TMDA_DELIVERY_FAILURE')
+            fp = open(failure_file, 'a')
+            print 'See', failure_file, 'for traceback'
+        except Exception:
+            pass
+    fline = ('%s (%s):' %
+             ('Uncaught Python ' + sys.version.split()[0] + ' Exception',
+              time.ctime(time.time())))
+    fp.write('\n%s\n%s\n' % (fline, '-' * len(fline)))
+    traceback.print_exception(tb[0], tb[1], tb[2], file=fp)
+    if fp is not sys.stdout:
+        fp.close()
+
+
+def _clear_reload(module):
+    """Reload module into an empty namespace, so that nothing set by
+    the previous configuration survives."""
+    namespace = vars(module)
+    keep = {}
+    for name in ('__name__', '__file__', '__package__', '__builtins__'):
+        if namespace.has_key(name):
+            keep[name] = namespace[name]
+    namespace.clear()
+    namespace.update(keep)
+    reload(module)
+
+
+class DefaultsLoader:
+    """Import hook which gives a child the daemon's TMDA.Defaults.
+
+    tmda-rfilter may change the environment from its command line
+    before importing Defaults, so whether the configuration read by
+    the daemon still applies is only decided then.  If it doesn't,
+    the configuration is read afresh.
+    """
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def find_module(self, fullname, path=None):
+        if fullname == 'TMDA.Defaults':
+            return self
+        return None
+
+    def load_module(self, fullname):
+        sys.meta_path.remove(self)
+        module = self.daemon.defaults
+        sys.modules[fullname] = module
+        if not self.daemon.shared():
+            _clear_reload(module)
+        # Defaults.PID names the pending messages of this process.
+        module.PID = str(os.getpid())
+        return module
+
+
+class FilterDaemon:
+    """Serve tmda-rfilter runs over a Unix socket."""
+
+    def __init__(self, path, rfilter, reload_config=False):
+        """path is the socket, and rfilter the tmda-rfilter script.
+
+        If reload_config is true, every message has the configuration
+        read again, as for a configuration that depends on more than
+        its files and the environment.
+        """
+        self.path = path
+        self.rfilter = rfilter
+        self.reload_config = reload_config
+        self.code = None
+        self.mtime = None
+        self.defaults = None
+        self.stamp = None
+        self.shareable = False
+        self.children = 0
+        self.sock = None
+
+    def preload(self):
+        """Import what tmda-rfilter needs, reading the configuration
+        in the daemon's own environment."""
+        sys.argv[0] = self.rfilter
+        import email
+        import email.utils
+        import optparse
+        from TMDA import Defaults
+        from TMDA import Address, AutoResponse, Cookie, Deliver, Errors
+        from TMDA import FilterParser, MessageLogger, MTA, Util
+        from TMDA.Queue import Util as QueueUtil
+        from TMDA.Queue.Queue import Queue
+        Queue().init()
+        FilterParser.remember_filters()
+        self.defaults = Defaults
+        self.loaded()
+        self.refresh()
+
+    def loaded(self):
+        """Note what the configuration just read depends on."""
+        from TMDA import ConfigSnapshot
+        Defaults = self.defaults
+        self.stamp = ConfigSnapshot.stamp(Defaults._source,
+                                          Defaults.PARENTDIR, vars(Defaults))
+        # A child can't share a database connection with the others,
+        # but it can make its own with a DB_CONNECTION function.
+        db = Defaults.__dict__.get('DB_CONNECTION')
+        self.shareable = db is None or not hasattr(db, 'cursor')
+
+    def current(self):
+        """Return true if the configuration read by the daemon applies
+        in the present environment."""
+        from TMDA import ConfigSnapshot
+        Defaults = self.defaults
+        return (self.stamp is not None and
+                ConfigSnapshot.unchanged(self.stamp, Defaults._source,
+                                         Defaults.PARENTDIR))
+
+    def shared(self):
+        """Return true if a child can use the daemon's configuration."""
+        return self.shareable and not self.reload_config and self.current()
+
+    def refresh(self):
+        """Read the configuration, the incoming filter and tmda-rfilter
+        again if they have changed."""
+        from TMDA import FilterParser
+        Defaults = self.defaults
+        if not self.current():
+            try:
+                _clear_reload(Defaults)
+                self.loaded()
+            except Exception:
+                # The children read the configuration themselves, and
+                # report the error as tmda-rfilter would.
+                self.stamp = None
+                import traceback
+                traceback.print_exc()
+                return
+        if self.stamp is not None:
+            try:
+                infilter = FilterParser.FilterParser()
+                infilter.read(Defaults.FILTER_INCOMING)
+                infilter.preload()
+            except Exception:
+                pass
+        mtime = os.path.getmtime(self.rfilter)
+        if mtime != self.mtime:
+            self.code = compile(open(self.rfilter).read(), self.rfilter,
+                                'exec')
+            self.mtime = mtime
+
+    def serve(self):
+        """Accept connections until terminated."""
+        import select
+        import signal
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        self.listen()
+        try:
+            while True:
+                self.reap()
+                try:
+                    (readable, w, x) = select.select([self.sock], [], [],
+                                                     1.0)
+                except select.error:
+                    continue
+                if readable:
+                    self.accept()
+        finally:
+            self.sock.close()
+            os.unlink(self.path)
+
+    def listen(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except socket.error:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        else:
+            probe.close()
+            raise socket.error, '%s: already in use' % self.path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the user the daemon runs as may connect.
+        umask = os.umask(077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(socket.SOMAXCONN)
+
+    def reap(self):
+        while self.children:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                self.children = 0
+                break
+            if not pid:
+                break
+            self.children -= 1
+
+    def accept(self):
+        try:
+            (conn, addr) = self.sock.accept()
+        except socket.error:
+            return
+        try:
+            # Only the request is read here; the message, which may be
+            # large or slow to arrive, is read by the child.
+            conn.settimeout(10)
+            request = receive(conn)
+            conn.settimeout(None)
+            # Refresh in the environment of the message, so that the
+            # next message from the same MTA finds it all current.
+            os.environ.clear()
+            os.environ.update(request['environ'])
+            try:
+                os.chdir(request['cwd'])
+            except OSError:
+                pass
+            self.refresh()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            conn.close()
+            return
+        if pid:
+            self.children += 1
+            conn.close()
+            return
+        status = EX_TEMPFAIL
+        try:
+            try:
+                self.sock.close()
+                self.handle(conn, request)
+                status = 0
+            except Exception:
+                import traceback
+                traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def handle(self, conn, request):
+        """Read the message from conn, run tmda-rfilter for it and
+        request, in a child, and reply to the client over conn."""
+        import random
+        import signal
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        random.seed()
+        conn.settimeout(60)
+        message = receive(conn)
+        conn.settimeout(None)
+        stdin = os.tmpfile()
+        stdin.write(message)
+        stdin.seek(0)
+        stdout = os.tmpfile()
+        stderr = os.tmpfile()
+        os.dup2(stdin.fileno(), 0)
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        sys.argv = [self.rfilter] + request['argv']
+        status = self.run()
+        # Exit handlers, such as the SMTP connection pool's, run
+        # before the output is collected.
+        exitfunc = getattr(sys, 'exitfunc', None)
+        if exitfunc:
+            try:
+                exitfunc()
+            except Exception:
+                pass
+        sys.stdout.flush()
+        sys.stderr.flush()
+        stdout.seek(0)
+        stderr.seek(0)
+        send(conn, (status, stdout.read(), stderr.read()))
+
+    def run(self):
+        """Run tmda-rfilter as tmda-filter does, and return its exit
+        status."""
+        import TMDA
+        if hasattr(TMDA, 'Defaults'):
+            del TMDA.Defaults
+        sys.modules.pop('TMDA.Defaults', None)
+        sys.meta_path.insert(0, DefaultsLoader(self))
+        try:
+            exec self.code in { '__name__' : '__main__',
+                                '__file__' : self.rfilter }
+        except SystemExit, e:
+            return _exit_status(e.code)
+        except KeyboardInterrupt:
+            return 0
+        except:
+            _report_failure(sys.exc_info())
+            return EX_TEMPFAIL
+        return 0
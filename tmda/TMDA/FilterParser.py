@@ -33,10 +33,12 @@ import os
 import re
 import string
 import sys
+import threading
 import time
 import types
 
 import Defaults
+import SQL
 import Util
 
 
@@ -71,10 +73,36 @@ class MatchError(Error):
         Error.__init__(self, '[line %2d]: %s' % (lineno, errmsg))
 
 
+class Timeout(Error):
+    """Exception raised in firstmatch when a rule, or the filter as a
+    whole, takes longer than allowed."""
+
+
+class _Pattern:
+    """A regular expression which is compiled when it is first used.
+
+    The parser's patterns are only needed when a filter file is
+    actually parsed, not when a compiled filter is loaded.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self.regex = None
+
+    def __getattr__(self, name):
+        if self.regex is None:
+            self.regex = re.compile(self.pattern, self.flags)
+        # Keep the method, so later lookups don't come through here.
+        value = getattr(self.regex, name)
+        setattr(self, name, value)
+        return value
+
+
 class Macro:
     """Macro definition as parsed by the filter parser."""
 
-    macro_words = re.compile(r'([_a-zA-Z][_\w]*)')
+    macro_words = _Pattern(r'([_a-zA-Z][_\w]*)')
     macro_chars = '_' + string.digits + string.letters
 
     def __init__(self, name):
@@ -218,25 +246,25 @@ class _FilterFile:
 
 
 class FilterParser:
-    bol_comment = re.compile(r'\s*#')
+    bol_comment = _Pattern(r'\s*#')
 
-    most_sources = re.compile(r"""
+    most_sources = _Pattern(r"""
     ( (?:to|from)-(?:file|cdb|dbm|ezmlm|mailman|sql)
     | size | pipe-headers | pipe
     | (?:to|from) (?!-) )
     """, re.VERBOSE | re.IGNORECASE)
 
-    hdrbody_sources = re.compile(r"""
+    hdrbody_sources = _Pattern(r"""
     ( (?:body|headers)-file
     | (?:body|headers) (?!-) )
     """, re.VERBOSE | re.IGNORECASE)
 
-    matches = re.compile(r"""
+    matches = _Pattern(r"""
     (?: ([\'\"]) ( (?: \\\1 | . )+? ) \1
     | ( \S+ ) )
     """, re.VERBOSE)
 
-    tag_action = re.compile(r"""
+    tag_action = _Pattern(r"""
     ( [A-Za-z][-\w]+ )
     \s+
     (\w+\s*=\s*)?
@@ -246,20 +274,20 @@ class FilterParser:
     )
     """, re.VERBOSE)
 
-    in_action = re.compile(r"""
+    in_action = _Pattern(r"""
     ( drop | exit | stop
     | hold
     | (?: confirm | bounce | reject | deliver | ok | accept)(?:\s*=.*$)? )
     """, re.VERBOSE | re.IGNORECASE)
 
-    out_action = re.compile(r"""
+    out_action = _Pattern(r"""
     ( (?:(?:bare|sender|domain|dated)(?:=\S+)?)
     | (?:(?:exp(?:licit)?|as|ext(?:ension)?|kw|keyword|shell|python)=\S+)
     | default )""", re.VERBOSE | re.IGNORECASE)
 
-    arg_option = re.compile(r'(\w+)(=?)')
+    arg_option = _Pattern(r'(\w+)(=?)')
 
-    variable = re.compile(r'\$\{([_\w]+)\}')
+    variable = _Pattern(r'\$\{([_\w]+)\}')
 
     arguments = {
         'from'         : None,
@@ -268,29 +296,41 @@ class FilterParser:
         'to-file'      : ('autocdb', 'autodbm', 'optional'),
         'from-cdb'     : ('optional',),
         'to-cdb'       : ('optional',),
-        'from-dbm'     : ('optional',),
-        'to-dbm'       : ('optional',),
+        'from-dbm'     : ('optional', 'timeout'),
+        'to-dbm'       : ('optional', 'timeout'),
         'from-ezmlm'   : ('optional',),
         'to-ezmlm'     : ('optional',),
         'from-mailman' : ('attr', 'optional' ),
         'to-mailman'   : ('attr', 'optional' ),
-        'from-sql'     : ('action_column', 'addr_column', 'wildcards'),
-        'to-sql'       : ('action_column', 'addr_column', 'wildcards'),
-        'body'         : ('case',),
+        'from-sql'     : ('action_column', 'addr_column', 'wildcards',
+                          'timeout'),
+        'to-sql'       : ('action_column', 'addr_column', 'wildcards',
+                          'timeout'),
+        'body'         : ('case', 'maxbytes', 'text'),
         'headers'      : ('case',),
-        'body-file'    : ('case', 'optional'),
+        'body-file'    : ('case', 'optional', 'maxbytes', 'text'),
         'headers-file' : ('case', 'optional'),
         'size'         : None,
-        'pipe-headers' : None,
-        'pipe'         : None
+        'pipe-headers' : ('persistent', 'timeout'),
+        'pipe'         : ('persistent', 'timeout')
         }
 
 
+    # Bump this whenever the layout of the compiled filter changes.
+    compiled_version = 1
+    compiled_suffix = '.compiled'
+
     def __init__(self, db_instance=None):
         self.db_instance = db_instance
+        self.__queries = None
         self.macros = []
         self.files = []
         self.filterlist = []
+        # Files read (or found missing) and variables interpolated
+        # while parsing; these determine when a compiled filter is
+        # out-of-date.
+        self.depends = []
+        self.variables = {}
 
 
     def __pushfile(self, file):
@@ -326,6 +366,17 @@ class FilterParser:
         """Open and read the named filter file if it exists."""
         filename = os.path.abspath(filename)
         filename = os.path.normpath(filename)
+        # Only a fresh parser can use a compiled filter, since macros
+        # defined by earlier reads would otherwise be lost.
+        fresh = not self.files and not self.filterlist and not self.macros
+        usecompiled = Defaults.FILTER_COMPILE and fresh
+        usecached = _parsedcache is not None and fresh
+        if usecached and self.__usecompiled(_parsedcache.get(filename)):
+            return
+        if usecompiled and self.__loadcompiled(filename):
+            if usecached:
+                _parsedcache[filename] = self.__compiled()
+            return
         loadername = self.__loadedby(filename)
 
         if loadername:
@@ -337,11 +388,74 @@ class FilterParser:
 
         try:
             fp = open(filename)
+            self.depends.append(_filestamp(filename))
             self.__pushfile(_FilterFile(filename))
             self.__parse(fp)
             fp.close()
             self.__popfile()
         except IOError:
+            return
+        if usecached:
+            _parsedcache[filename] = self.__compiled()
+        if usecompiled:
+            self.__savecompiled(filename)
+
+
+    def __usecompiled(self, compiled):
+        """Take the filter list from compiled if it's up-to-date.
+
+        Return true if the filter list was loaded, or false if the
+        filter must be parsed.
+        """
+        if not compiled or compiled['version'] != self.compiled_version:
+            return False
+        for (pathname, stamp) in compiled['depends']:
+            if _filestamp(pathname) != (pathname, stamp):
+                return False
+        try:
+            for (var, sub) in compiled['variables'].items():
+                if self.__findvarsub(var) != sub:
+                    return False
+        except Error:
+            # Reparse, to report the error where the variable is used.
+            return False
+        self.filterlist = compiled['filterlist']
+        self.macros = compiled['macros']
+        self.depends = compiled['depends']
+        self.variables = compiled['variables']
+        return True
+
+
+    def __loadcompiled(self, filename):
+        """Load the compiled version of filename if it's up-to-date.
+
+        Return true if the filter list was loaded, or false if the
+        filter must be parsed.
+        """
+        try:
+            return self.__usecompiled(
+                Util.unpickle(filename + self.compiled_suffix))
+        except Exception:
+            # A missing, stale or corrupt compiled filter is simply
+            # rebuilt from the source.
+            return False
+
+
+    def __compiled(self):
+        """Return the parsed filter in the form of a compiled filter."""
+        return { 'version'    : self.compiled_version,
+                 'depends'    : self.depends,
+                 'variables'  : self.variables,
+                 'macros'     : self.macros,
+                 'filterlist' : self.filterlist }
+
+
+    def __savecompiled(self, filename):
+        """Store the parsed filter list next to filename."""
+        try:
+            Util.pickleit(self.__compiled(), filename + self.compiled_suffix)
+        except EnvironmentError:
+            # Can't write next to the filter; just parse it next time.
             pass
 
 
@@ -505,6 +619,7 @@ class FilterParser:
         if not sub:
             raise Error, "${%s} not found in the Defaults " \
                          "namespace nor the environment." % var
+        self.variables[var] = sub
         return sub
 
 
@@ -541,6 +656,10 @@ class FilterParser:
                 self.read(filename)
             elif not optional:
                 raise Error, '"%s": file not found' % filename
+            else:
+                # Remember the missing file so that creating it later
+                # invalidates a compiled filter.
+                self.depends.append(_filestamp(os.path.abspath(filename)))
             rule_line = None
         return rule_line
 
@@ -624,6 +743,14 @@ class FilterParser:
             match_line = string.lstrip(rule_line[mo.end():])
             args, match_line = self.__parseargs(self.arguments[source.lower()],
                                                 match_line)
+            if args.has_key('maxbytes') and \
+                   not (args['maxbytes'] or '').isdigit():
+                raise Error, '"maxbytes" takes a number of bytes'
+            if args.has_key('timeout'):
+                try:
+                    float(args['timeout'])
+                except (TypeError, ValueError):
+                    raise Error, '"timeout" takes a number of seconds'
             mo = self.matches.match(match_line)
             if not mo:
                 # missing match
@@ -689,16 +816,14 @@ class FilterParser:
 
     def __search_list(self, addrlist, keys, actions, source):
         """Search addrlist for match in field 1, optional action in 2."""
-        # This list comprehension splits each line in the list into
-        # two columns, lowercases the first column and stuffs the
-        # columns back together.  The result is the original list of
-        # lines from the file with the first field in each line
-        # lowercased.
-        addrlist = [' '.join(
-            apply(lambda f1, f2=None: f2 and [f1.lower(), f2]
-                                          or [f1.lower()],
-                  line.split(None, 1))) for line in addrlist]
-        found_match = Util.findmatch(addrlist, keys)
+        matcher = Util.AddressMatcher(_lowerfirst(addrlist))
+        return self.__search_matcher(matcher, keys, actions, source)
+
+
+    def __search_matcher(self, matcher, keys, actions, source):
+        """Search an AddressMatcher built by __search_list or
+        _filematcher."""
+        found_match = matcher.match(keys)
         if found_match:
             # The second column of the line may contain an
             # overriding action specification.
@@ -714,10 +839,10 @@ class FilterParser:
         """
         Search a text file for match in first column.
         """
-        return self.__search_list(Util.file_to_list(pathname),
-                                  keys,
-                                  actions,
-                                  source)
+        return self.__search_matcher(_filematcher(pathname),
+                                     keys,
+                                     actions,
+                                     source)
 
 
     def __search_cdb(self, pathname, keys, actions, source):
@@ -809,23 +934,10 @@ class FilterParser:
         return domains.keys()
 
 
-    def __create_sql_criteria(self, dbkeys, addresscolumn):
-        """Return condition string for insertion into SQL statement."""
-        if not dbkeys:
-            return ''
-        criteria = "("
-        for i in range(len(dbkeys)):
-            if i > 0:
-                criteria += " OR "
-            criteria += "%s = %%(criterion%d)s" % (addresscolumn, i)
-        criteria += ")"
-        return criteria
-
-
-    def __get_column_index(self, colname, cursor):
+    def __get_column_index(self, colname, description):
         """Return index of column named 'colname'."""
-        for i in range(len(cursor.description)):
-            if colname == cursor.description[i][0]:
+        for i in range(len(description)):
+            if colname == description[i][0]:
                 return i
         return -1
 
@@ -843,47 +955,87 @@ class FilterParser:
                                    recipient=_recipient,
                                    username=_username,
                                    hostname=_hostname)
-        cursor = self.db_instance.cursor()
-        try:
-            cursor.execute(selectstmt, params)
-            rows = cursor.fetchall()
-            if cursor.rowcount <= 0:
-                return 0
-            if args.has_key('wildcards'):
-                if len(cursor.description) > 1:
-                    dblist = [' '.join([row[0], row[1] or '']) for row in rows]
-                else:
-                    dblist = [row[0] for row in rows]
-                found_match = self.__search_list(dblist, keys, actions, source)
+        (description, rows) = SQL.query(self.db_instance, selectstmt, params,
+                                        self.__queries)
+        # Not every module gives a rowcount for a SELECT.
+        if not rows:
+            return 0
+        if args.has_key('wildcards'):
+            if len(description) > 1:
+                dblist = [' '.join([row[0], row[1] or '']) for row in rows]
             else:
-                action_column = args.get('action_column')
-                if action_column:
-                    actcolidx = self.__get_column_index(action_column, cursor)
+                dblist = [row[0] for row in rows]
+            found_match = self.__search_list(dblist, keys, actions, source)
+        else:
+            action_column = args.get('action_column')
+            if action_column:
+                actcolidx = self.__get_column_index(action_column, description)
+                if actcolidx == -1:
+                    actcolidx = self.__get_column_index(
+                        action_column.lower(), description)
                     if actcolidx == -1:
-                        actcolidx = self.__get_column_index(
-                            action_column.lower(), cursor)
-                        if actcolidx == -1:
-                            err = "no action column (%s)" % (action_column,)
-                            raise MatchError(lineno, err)
-                    action = rows[0][actcolidx]
-                    if action:
-                        actions.clear()
-                        actions.update(self.__buildactions(action, source))
-                found_match = 1
-        finally:
-            cursor.close()
+                        err = "no action column (%s)" % (action_column,)
+                        raise MatchError(lineno, err)
+                action = rows[0][actcolidx]
+                if action:
+                    actions.clear()
+                    actions.update(self.__buildactions(action, source))
+            found_match = 1
         return found_match
 
 
     def firstmatch(self, recipient, senders=None,
-                   msg_body=None, msg_headers=None, msg_size=None):
+                   msg_body=None, msg_headers=None, msg_size=None,
+                   timeout_action=None):
         """Iterate over each rule in the list looking for a match.  As
         soon as a match is found exit, returning the corresponding
         action dictionary and matching line.
+
+        If a rule takes longer than its -timeout or
+        FILTER_RULE_TIMEOUT, or the filter longer than FILTER_TIMEOUT,
+        the actions of timeout_action (such as FILTER_TIMEOUT_ACTION)
+        are returned instead, or Timeout raised if there are none.
         """
+        try:
+            return self.__firstmatch(recipient, senders,
+                                     msg_body, msg_headers, msg_size)
+        except Timeout, e:
+            if not timeout_action:
+                raise
+            actions = self.__buildactions(timeout_action,
+                                          'FILTER_TIMEOUT_ACTION')
+            return actions, 'timeout (%s)' % e._msg
+
+
+    def __firstmatch(self, recipient, senders,
+                     msg_body, msg_headers, msg_size):
         line = None
         found_match = None
-        for (source, args, match, actions, lineno) in self.filterlist:
+        # The parts of the body searched by body rules, by scan mode.
+        bodyviews = {}
+        # The results of the SQL queries made for the message.
+        self.__queries = {}
+        deadline = None
+        if Defaults.FILTER_TIMEOUT:
+            deadline = time.time() + Defaults.FILTER_TIMEOUT
+        # Slow rules further down the list, being looked up ahead of
+        # the rules before them, by index.
+        lookups = {}
+        ahead = []
+        if Defaults.FILTER_PREFETCH:
+            ahead = self.__prefetchable(recipient, senders,
+                                        msg_body, msg_headers)
+        for (index, rule) in enumerate(self.filterlist):
+            (source, args, match, actions, lineno) = rule
+            if deadline is not None and time.time() > deadline:
+                raise Timeout('[line %2d]: filter took longer than %s seconds'
+                              % (lineno, Defaults.FILTER_TIMEOUT))
+            while ahead and len(lookups) < Defaults.FILTER_PREFETCH:
+                (later, keys) = ahead.pop(0)
+                if later > index:
+                    lookups[later] = self.__lookup(
+                        self.filterlist[later], keys,
+                        msg_body, msg_headers, deadline)
             source = string.lower(source)
             # set up the keys for searching
             if source.startswith('from') and senders:
@@ -927,15 +1079,11 @@ class FilterParser:
                     break
             # DBM-style databases.
             if source in ('from-dbm', 'to-dbm'):
-                import anydbm
                 match = os.path.expanduser(match)
                 keys += self.__extract_domains(keys)
-                try:
-                    found_match = self.__search_dbm(match, keys,
-                                                    actions, source)
-                except anydbm.error, e:
-                    if not args.has_key('optional'):
-                        raise MatchError(lineno, str(e))
+                found_match = self.__slowmatch(rule, keys,
+                                               lookups.pop(index, None),
+                                               msg_body, msg_headers, deadline)
                 if found_match:
                     break
             # DJB's constant databases; see <http://cr.yp.to/cdb.html>.
@@ -1017,86 +1165,49 @@ class FilterParser:
             # wildcards in the database.  See the filter source documentation
             # for more information.
             if source in ('from-sql', 'to-sql'):
-                selectstmt = match
                 keys += self.__extract_domains(keys)
-                addr_column = args.get('addr_column')
-                if args.has_key('wildcards'):
-                    if addr_column:
-                        raise MatchError(lineno,
-                                         "-addr_column and -wildcards " +
-                                         "cannot be used together")
-                elif not addr_column:
-                    raise MatchError(lineno, "-addr_column must be specified")
-                else:
-                    criteria = self.__create_sql_criteria(keys, addr_column)
-                    selectstmt = selectstmt.replace('%(criteria)s', criteria)
-                found_match = self.__search_sql(
-                    selectstmt, args, keys, actions, source, lineno)
+                found_match = self.__slowmatch(rule, keys,
+                                               lookups.pop(index, None),
+                                               msg_body, msg_headers, deadline)
                 if found_match:
                     break
             # A match is found if the command exits with a zero exit
             # status.
-            if source == 'pipe-headers' and msg_headers:
-                (r, out, err) = Util.runcmd(match, msg_headers)
-
-                if r == 0:
-                    found_match = 1
-                    break
-                # raise an exception if the process exited due to
-                # a signal.
-                elif r < 0:
-                    raise Error('command "%s" abnormal exit signal %s (%s)' %
-                                (match, -r, err.strip()))
-            # A match is found if the command exits with a zero exit
-            # status.
-            if source == 'pipe' and msg_body and msg_headers:
-                (r, out, err) = Util.runcmd(match, msg_headers + '\n' +
-                                            msg_body)
-                if r == 0:
-                    found_match = 1
+            if source in ('pipe-headers', 'pipe'):
+                found_match = self.__slowmatch(rule, None,
+                                               lookups.pop(index, None),
+                                               msg_body, msg_headers, deadline)
+                if found_match:
                     break
-                # raise an exception if the process exited due to
-                # a signal.
-                elif r < 0:
-                    raise Error('command "%s" abnormal exit signal %s (%s)' %
-                                (match, -r, err.strip()))
             if source in ('body', 'headers'):
                 if source == 'body' and msg_body:
-                    content = msg_body
+                    content = self.__bodyview(msg_body, msg_headers, args,
+                                              bodyviews)
                 elif source == 'headers' and msg_headers:
                     content = msg_headers
                 else:
                     content = None
-                re_flags = re.MULTILINE
-                if not args.has_key('case'):
-                    re_flags = re_flags | re.IGNORECASE
-                if content and re.search(match,content,re_flags):
+                if content and \
+                       _regex(match, _searchflags(args)).search(content):
                     found_match = 1
                     break
             if source in ('body-file','headers-file'):
                 match = os.path.expanduser(match)
                 try:
-                    match_list = Util.file_to_list(match)
+                    patternset = _patternmatcher(match, _searchflags(args))
                 except IOError:
                     if not args.has_key('optional'):
                         raise
                 else:
                     if source == 'body-file' and msg_body:
-                        content = msg_body
+                        content = self.__bodyview(msg_body, msg_headers, args,
+                                                  bodyviews)
                     elif source == 'headers-file' and msg_headers:
                         content = msg_headers
                     else:
                         content = None
-                    re_flags = re.MULTILINE
-                    if not args.has_key('case'):
-                        re_flags = re_flags | re.IGNORECASE
-                    for line in match_list:
-                        mo = self.matches.match(line)
-                        if mo:
-                            expr = mo.group(2) or mo.group(3)
-                            if content and re.search(expr,content,re_flags):
-                                found_match = 1
-                                break
+                    if content and patternset.search(content):
+                        found_match = 1
                 if found_match:
                     break
             if source == 'size' and msg_size:
@@ -1117,6 +1228,781 @@ class FilterParser:
         return actions, line
 
 
+    def __slowmatch(self, rule, keys, lookup, msg_body, msg_headers,
+                    deadline):
+        """
+        Return true if rule, one with a source in _slowsources,
+        matches.  lookup is the rule's _Lookup if it was started ahead
+        of time, and None otherwise.  Raises Timeout if it takes longer
+        than the rule's -timeout or FILTER_RULE_TIMEOUT, or doesn't
+        finish before deadline.
+        """
+        (source, args, match, actions, lineno) = rule
+        try:
+            if lookup is None:
+                deadline = _ruledeadline(args, deadline)
+                if deadline is None or source in ('pipe-headers', 'pipe') \
+                       or (source in ('from-sql', 'to-sql') and
+                           not self.__sqlthreads()):
+                    # Pipe commands are killed when they run out of
+                    # time, and a database connection may only be
+                    # usable here.
+                    (found_match, found_actions) = self.__search_slow(
+                        rule, keys, msg_body, msg_headers, deadline)
+                else:
+                    lookup = self.__lookup(rule, keys, msg_body, msg_headers,
+                                           deadline)
+            if lookup is not None:
+                (found_match, found_actions) = lookup.result()
+        except Timeout, e:
+            raise Timeout('[line %2d]: %s' % (lineno, e._msg))
+        if found_match and found_actions != actions:
+            actions.clear()
+            actions.update(found_actions)
+        return found_match
+
+
+    def __lookup(self, rule, keys, msg_body, msg_headers, deadline):
+        """
+        Start a _Lookup of rule, a slow one, which has until the
+        earlier of deadline and its own time limit to finish.
+        """
+        deadline = _ruledeadline(rule[1], deadline)
+        return _Lookup(deadline, self.__search_slow, rule, keys,
+                       msg_body, msg_headers, deadline)
+
+
+    def __prefetchable(self, recipient, senders, msg_body, msg_headers):
+        """
+        Return the slow rules that can be looked up ahead of time, as
+        a list of (index, keys) tuples in filter order.
+        """
+        rules = []
+        for (index, rule) in enumerate(self.filterlist):
+            source = rule[0].lower()
+            if source not in _slowsources:
+                continue
+            if source in ('from-sql', 'to-sql') and \
+                   not self.__sqlthreads():
+                continue
+            keys = None
+            if source.startswith('from'):
+                if not senders:
+                    continue
+                keys = list(senders)
+            elif source.startswith('to'):
+                if not recipient:
+                    continue
+                keys = [recipient]
+            if keys is not None:
+                keys += self.__extract_domains(keys)
+            rules.append((index, keys))
+        return rules
+
+
+    def __sqlthreads(self):
+        """Return true if SQL rules can be checked in threads."""
+        try:
+            return SQL.threadsafe(SQL.connection(self.db_instance))
+        except Exception:
+            return False
+
+
+    def __search_slow(self, rule, keys, msg_body, msg_headers, deadline):
+        """
+        Check rule, a slow one, against keys and the message.  Return
+        whether it matched, and its actions, as a database may have
+        overridden them; the rule's own actions are left as they are.
+        A pipe command still running at deadline is killed.
+        """
+        (source, args, match, actions, lineno) = rule
+        actions = actions.copy()
+        found_match = 0
+        if source in ('from-dbm', 'to-dbm'):
+            import anydbm
+            try:
+                found_match = self.__search_dbm(os.path.expanduser(match),
+                                                keys, actions, source)
+            except anydbm.error, e:
+                if not args.has_key('optional'):
+                    raise MatchError(lineno, str(e))
+        elif source in ('from-sql', 'to-sql'):
+            selectstmt = match
+            addr_column = args.get('addr_column')
+            if args.has_key('wildcards'):
+                if addr_column:
+                    raise MatchError(lineno,
+                                     "-addr_column and -wildcards " +
+                                     "cannot be used together")
+            elif not addr_column:
+                raise MatchError(lineno, "-addr_column must be specified")
+            else:
+                selectstmt = _sqlstatement(selectstmt, addr_column, len(keys))
+            found_match = self.__search_sql(
+                selectstmt, args, keys, actions, source, lineno)
+        elif source in ('pipe-headers', 'pipe'):
+            if source == 'pipe-headers' and msg_headers:
+                data = msg_headers
+            elif source == 'pipe' and msg_body and msg_headers:
+                data = msg_headers + '\n' + msg_body
+            else:
+                return (0, actions)
+            (r, err) = _runpipe(match, args, data, deadline)
+            if r == 0:
+                found_match = 1
+            # raise an exception if the process exited due to
+            # a signal.
+            elif r < 0:
+                raise Error('command "%s" abnormal exit signal %s (%s)' %
+                            (match, -r, (err or '').strip()))
+        return (found_match, actions)
+
+
+    def __bodyview(self, msg_body, msg_headers, args, bodyviews):
+        """
+        Return the part of the message body that a body or body-file
+        rule with args searches: the decoded text parts only, with the
+        -text argument or FILTER_BODY_TEXT, and at most the first
+        -maxbytes or FILTER_BODY_MAXBYTES bytes of it.  bodyviews keeps
+        what was found for the other rules.
+        """
+        text = args.has_key('text') or Defaults.FILTER_BODY_TEXT
+        if args.has_key('maxbytes'):
+            maxbytes = int(args['maxbytes'])
+        else:
+            maxbytes = Defaults.FILTER_BODY_MAXBYTES
+        key = (bool(text), maxbytes)
+        if not bodyviews.has_key(key):
+            content = msg_body
+            if text and msg_headers is not None:
+                if maxbytes:
+                    # Only as much of the raw body is parsed as the
+                    # text wanted could take up once encoded.
+                    content = _textparts(msg_headers,
+                                         msg_body[:maxbytes * _encodedsize])
+                else:
+                    content = _textparts(msg_headers, msg_body)
+            if maxbytes:
+                content = content[:maxbytes]
+            bodyviews[key] = content
+        return bodyviews[key]
+
+
+    def preload(self):
+        """
+        Read the address lists searched by from-file and to-file
+        rules, compile the patterns of body and headers rules, and
+        start the commands of persistent pipe rules, so that
+        firstmatch() finds them already cached.
+        """
+        for (source, args, match, actions, lineno) in self.filterlist:
+            source = source.lower()
+            if source in ('body', 'headers'):
+                try:
+                    _regex(match, _searchflags(args))
+                except re.error:
+                    pass
+                continue
+            if source in ('body-file', 'headers-file'):
+                pathname = os.path.expanduser(match)
+                if os.path.exists(pathname):
+                    _patternmatcher(pathname, _searchflags(args))
+                continue
+            if source in ('pipe', 'pipe-headers'):
+                if args.has_key('persistent'):
+                    try:
+                        _coprocess(match)
+                    except OSError:
+                        pass
+                continue
+            if source not in ('from-file', 'to-file') or \
+                   args.has_key('autocdb') or args.has_key('autodbm'):
+                continue
+            pathname = os.path.expanduser(match)
+            if os.path.exists(pathname):
+                _filematcher(pathname)
+
+
+def _filestamp(pathname):
+    """
+    Return a (pathname, stamp) pair identifying the current version of
+    pathname.  stamp is None if the file doesn't exist.
+    """
+    try:
+        st = os.stat(pathname)
+    except OSError:
+        return (pathname, None)
+    return (pathname, (st.st_mtime, st.st_size))
+
+
+def _lowerfirst(addrlist):
+    """
+    Return addrlist with the first column of each line lowercased.
+    """
+    # This list comprehension splits each line in the list into two
+    # columns, lowercases the first column and stuffs the columns back
+    # together.
+    return [' '.join(
+        apply(lambda f1, f2=None: f2 and [f1.lower(), f2]
+                                      or [f1.lower()],
+              line.split(None, 1))) for line in addrlist]
+
+
+# Address lists read by from-file and to-file rules, kept for the life
+# of the process.  Maps a pathname to a (stamp, AddressMatcher) pair,
+# where stamp is the file's (mtime, size) when it was read.
+_listcache = {}
+
+def _filematcher(pathname):
+    """
+    Return an AddressMatcher for the address list in pathname, reading
+    the file only if it changed since it was last read.
+    """
+    (pathname, stamp) = _filestamp(os.path.abspath(pathname))
+    cached = _listcache.get(pathname)
+    if cached and stamp is not None and cached[0] == stamp:
+        return cached[1]
+    matcher = Util.AddressMatcher(_lowerfirst(Util.file_to_list(pathname)))
+    if stamp is not None:
+        _listcache[pathname] = (stamp, matcher)
+    return matcher
+
+
+# How many raw bytes of a message body are read for each byte of text
+# -text searches, to allow for encoding and the parts' own headers.
+_encodedsize = 4
+
+def _textparts(headers, body):
+    """
+    Return the text parts of the message made of headers and body,
+    decoded and joined.  Attachments and other non-text parts are left
+    out.
+    """
+    import email
+    msg = email.message_from_string(headers + '\n' + body)
+    texts = []
+    for part in msg.walk():
+        if part.get_content_maintype() != 'text':
+            continue
+        payload = part.get_payload(decode=True)
+        if payload:
+            texts.append(payload)
+    return '\n'.join(texts)
+
+
+def _searchflags(args):
+    """
+    Return the flags to compile the patterns of a body or headers
+    rule with, given its arguments.
+    """
+    if args.has_key('case'):
+        return re.MULTILINE
+    return re.MULTILINE | re.IGNORECASE
+
+
+# Patterns of body and headers rules, compiled once for the life of
+# the process.  Maps a (pattern, flags) pair to the compiled pattern.
+# Like re's own cache, it is emptied when it grows past _maxregexes.
+_regexcache = {}
+_maxregexes = 500
+
+def _regex(pattern, flags):
+    """
+    Return pattern compiled with flags, compiling it only once.
+    """
+    key = (pattern, flags)
+    regex = _regexcache.get(key)
+    if regex is None:
+        if len(_regexcache) >= _maxregexes:
+            _regexcache.clear()
+        regex = _regexcache[key] = re.compile(pattern, flags)
+    return regex
+
+
+# Pattern files read by body-file and headers-file rules, kept for the
+# life of the process.  Maps a (pathname, flags) pair to a (stamp,
+# _PatternSet) pair, where stamp is the file's (mtime, size) when it
+# was read.
+_patterncache = {}
+
+# Patterns which can't share an alternation with others, because they
+# set flags inline, or refer to groups by number or by name.
+_unmergeable = _Pattern(r'\(\?[iLmsux]+\)|\(\?P[<=]|\(\?\(|\\[1-9]')
+
+# Python's re module allows at most 100 groups in an expression.
+_maxgroups = 99
+
+# Shorter literals aren't worth looking for ahead of their patterns.
+_minliteral = 3
+
+
+def _literal(pattern, flags):
+    """
+    Return the longest run of ASCII characters that every match of
+    pattern contains, or None.
+    """
+    import sre_constants
+    import sre_parse
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except (re.error, sre_constants.error):
+        return None
+    best = run = ''
+    for (op, av) in parsed:
+        if op == sre_constants.LITERAL and av < 128:
+            run += chr(av)
+        else:
+            run = ''
+        if len(run) > len(best):
+            best = run
+    if len(best) < _minliteral:
+        return None
+    return best
+
+
+def _trie(words):
+    """
+    Return an expression matching any of words, arranged as a trie so
+    that words with a common prefix share its branch.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+    def build(node):
+        branches = []
+        for char in sorted(node.keys()):
+            if char:
+                branches.append(re.escape(char) + build(node[char]))
+        if not branches:
+            return ''
+        if len(branches) == 1 and not node.has_key(''):
+            return branches[0]
+        expr = '(?:%s)' % '|'.join(branches)
+        if node.has_key(''):
+            expr += '?'
+        return expr
+    return build(trie)
+
+
+class _PatternSet:
+    """
+    The patterns of a body-file or headers-file rule, compiled so that
+    a message is scanned once for all of them rather than once per
+    pattern.
+
+    Most patterns contain a literal string that any match must
+    include.  Those literals are looked for together, in a single pass
+    of one expression shaped as a trie, and only the patterns whose
+    literal turns up are searched for.  The other patterns are merged
+    into as few alternations as they allow.
+
+    A pattern that doesn't compile, and those after it, are left out.
+    Its error is raised by search() if none of the patterns before it
+    match, which is when it would be reached if they were searched for
+    in turn.
+    """
+
+    def __init__(self, patterns, flags):
+        self.ignorecase = flags & re.IGNORECASE
+        # literal -> the compiled patterns which need it
+        self.literals = {}
+        self.scanner = None
+        self.regexes = []
+        self.error = None
+        merged = []
+        groups = 0
+        for pattern in patterns:
+            # Compiled alone first, so that a bad pattern is reported
+            # as itself.
+            try:
+                regex = re.compile(pattern, flags)
+            except re.error, e:
+                self.error = e
+                break
+            if _unmergeable.search(pattern):
+                self.regexes.append(regex)
+                continue
+            literal = _literal(pattern, flags)
+            if literal is not None:
+                if self.ignorecase:
+                    literal = literal.lower()
+                self.literals.setdefault(literal, []).append(regex)
+                continue
+            if merged and groups + regex.groups > _maxgroups:
+                self.regexes.append(self.merge(merged, flags))
+                merged = []
+                groups = 0
+            merged.append(pattern)
+            groups += regex.groups
+        if merged:
+            self.regexes.append(self.merge(merged, flags))
+        if self.literals:
+            # The lookahead finds the longest literal starting at each
+            # position, overlapping ones included.
+            self.scanner = re.compile('(?=(%s))' % _trie(self.literals.keys()))
+
+    def merge(self, patterns, flags):
+        if len(patterns) == 1:
+            return re.compile(patterns[0], flags)
+        return re.compile('|'.join(['(?:%s)' % p for p in patterns]), flags)
+
+    def search(self, content):
+        """
+        Return true if any of the patterns matches content.
+        """
+        if self.scanner is not None:
+            text = content
+            if self.ignorecase:
+                text = content.lower()
+            found = {}
+            for match in self.scanner.findall(text):
+                found[match] = 1
+            # A literal is there if a longest literal found starts
+            # with it.
+            for (literal, regexes) in self.literals.items():
+                for match in found.keys():
+                    if match.startswith(literal):
+                        for regex in regexes:
+                            if regex.search(content):
+                                return True
+                        break
+        for regex in self.regexes:
+            if regex.search(content):
+                return True
+        if self.error is not None:
+            raise self.error
+        return False
+
+
+def _patternmatcher(pathname, flags):
+    """
+    Return a _PatternSet for the patterns in pathname, one per line,
+    reading the file only if it changed since it was last read.
+    """
+    (pathname, stamp) = _filestamp(os.path.abspath(pathname))
+    key = (pathname, flags)
+    cached = _patterncache.get(key)
+    if cached and stamp is not None and cached[0] == stamp:
+        return cached[1]
+    patterns = []
+    for line in Util.file_to_list(pathname):
+        mo = FilterParser.matches.match(line)
+        if mo:
+            patterns.append(mo.group(2) or mo.group(3))
+    patternset = _PatternSet(patterns, flags)
+    if stamp is not None:
+        _patterncache[key] = (stamp, patternset)
+    return patternset
+
+
+# Sources whose rules may wait on other processes, servers or disks.
+# They take a -timeout argument, and with FILTER_PREFETCH are looked up
+# ahead of the rules before them.
+_slowsources = ('from-dbm', 'to-dbm', 'from-sql', 'to-sql',
+                'pipe-headers', 'pipe')
+
+def _ruledeadline(args, deadline):
+    """
+    Return the time by which a slow rule with args, started now, has
+    to finish, given the filter's deadline.  None means no limit.
+    """
+    if args.has_key('timeout'):
+        timeout = float(args['timeout'])
+    else:
+        timeout = Defaults.FILTER_RULE_TIMEOUT
+    if timeout:
+        if deadline is None or time.time() + timeout < deadline:
+            return time.time() + timeout
+    return deadline
+
+
+class _Lookup:
+    """
+    A slow rule being checked in a thread of its own, so that
+    firstmatch() can start it early and give up waiting for it.
+    """
+    def __init__(self, deadline, func, *args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        thread = threading.Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.error = sys.exc_info()
+        self.done.set()
+
+    def result(self):
+        """
+        Return what func returned, or raise what it raised.  If it
+        isn't done by the deadline, it is left to finish unheeded and
+        Timeout raised.
+        """
+        if self.deadline is None:
+            self.done.wait()
+        else:
+            self.done.wait(max(self.deadline - time.time(), 0))
+        if not self.done.isSet():
+            raise Timeout('rule timed out')
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+def _runpipe(command, args, data, deadline=None):
+    """
+    Run the command of a pipe or pipe-headers rule with data as its
+    input, and return a tuple of (exit status, stderr text).  The
+    command is killed and Timeout raised if it is still running at
+    deadline.
+    """
+    timeout = None
+    if deadline is not None:
+        timeout = max(deadline - time.time(), 0)
+    if args.has_key('persistent'):
+        if timeout is None or Defaults.FILTER_PIPE_TIMEOUT < timeout:
+            timeout = Defaults.FILTER_PIPE_TIMEOUT
+        return (_runpersistent(command, data, timeout), '')
+    if timeout is None:
+        (r, out, err) = Util.runcmd(command, data)
+        return (r, err)
+    return (_runtimed(command, data, timeout), None)
+
+
+def _runtimed(command, data, timeout):
+    """
+    Run command with data as its input, as Util.runcmd() does, and
+    return its exit status.  If it takes more than timeout seconds, it
+    is killed along with anything the shell started for it, and
+    Timeout raised.
+    """
+    import signal
+    import subprocess
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                               preexec_fn=os.setpgrp)
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        process.communicate(data)
+    finally:
+        timer.cancel()
+    if killed and process.returncode == -signal.SIGKILL:
+        raise Timeout('command "%s" timed out' % command)
+    return process.returncode
+
+
+class _Coprocess:
+    """
+    The command of a persistent pipe or pipe-headers rule, started
+    once and then given one message after another.
+
+    Each message is written to the command's standard input as its
+    length in bytes, in decimal, on a line of its own, followed by
+    the message itself.  The command answers with a line holding the
+    exit status it would have exited with if it had been run for that
+    message alone.  It should exit when its standard input is closed.
+    """
+    def __init__(self, command):
+        import fcntl
+        import subprocess
+        self.command = command
+        self.owner = os.getpid()
+        self.process = subprocess.Popen(command, shell=True,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True,
+                                        preexec_fn=os.setpgrp)
+        self.stdin = self.process.stdin.fileno()
+        self.stdout = self.process.stdout.fileno()
+        flags = fcntl.fcntl(self.stdin, fcntl.F_GETFL)
+        fcntl.fcntl(self.stdin, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # Commands run later, such as those of other pipe rules, must
+        # not hold the pipes open, or the command never sees the end
+        # of its input.
+        for fd in (self.stdin, self.stdout):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        # Processes forked from this one (tmda-filterd's children)
+        # share the command, and take turns with it through this lock;
+        # threads take turns through the mutex.  The lock file also
+        # holds a flag set while a message and its answer are under
+        # way, so that if a process dies in the middle, the next one
+        # knows the command is out of step.
+        self.lock = os.tmpfile()
+        self.__mark('0')
+        self.mutex = threading.Lock()
+
+    def alive(self):
+        """Return false if the command is known to have exited."""
+        if self.owner != os.getpid():
+            return True
+        return self.process.poll() is None
+
+    def filter(self, data, timeout):
+        """
+        Return the command's exit status for data, or None if it exits
+        without answering.  If it takes more than timeout seconds, it
+        is killed and Timeout raised.
+        """
+        import fcntl
+        self.mutex.acquire()
+        fcntl.lockf(self.lock.fileno(), fcntl.LOCK_EX)
+        try:
+            if self.__marked():
+                # Part of a message, or an answer nobody read, may be
+                # left in the pipes.
+                self.kill()
+                return None
+            self.__mark('1')
+            deadline = time.time() + timeout
+            try:
+                self.__write('%d\n%s' % (len(data), data), deadline)
+                answer = self.__readline(deadline)
+            except (IOError, OSError):
+                # EPIPE: the command has exited.
+                return None
+            if answer:
+                self.__mark('0')
+        finally:
+            fcntl.lockf(self.lock.fileno(), fcntl.LOCK_UN)
+            self.mutex.release()
+        if not answer:
+            return None
+        try:
+            return int(answer)
+        except ValueError:
+            self.kill()
+            raise Error('command "%s" answered %r' % (self.command, answer))
+
+    def __mark(self, flag):
+        os.lseek(self.lock.fileno(), 0, 0)
+        os.write(self.lock.fileno(), flag)
+
+    def __marked(self):
+        os.lseek(self.lock.fileno(), 0, 0)
+        return os.read(self.lock.fileno(), 1) == '1'
+
+    def __wait(self, fd, deadline, writing=False):
+        import select
+        remaining = deadline - time.time()
+        if remaining > 0:
+            if writing:
+                ready = select.select([], [fd], [], remaining)[1]
+            else:
+                ready = select.select([fd], [], [], remaining)[0]
+            if ready:
+                return
+        self.kill()
+        raise Timeout('command "%s" timed out' % self.command)
+
+    def __write(self, data, deadline):
+        import errno
+        while data:
+            self.__wait(self.stdin, deadline, writing=True)
+            try:
+                data = data[os.write(self.stdin, data):]
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def __readline(self, deadline):
+        answer = ''
+        while not answer.endswith('\n'):
+            self.__wait(self.stdout, deadline)
+            c = os.read(self.stdout, 1)
+            if not c:
+                return ''
+            answer += c
+        return answer.strip()
+
+    def kill(self):
+        """Stop the command, which may be stuck, along with anything
+        the shell started for it."""
+        import signal
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        """Close the command's input and output, and reap it if this
+        process started it."""
+        if _coprocesses.get(self.command) is self:
+            del _coprocesses[self.command]
+        self.process.stdin.close()
+        self.process.stdout.close()
+        if self.owner == os.getpid():
+            self.process.wait()
+
+
+_coprocesses = {}
+_coprocesslock = threading.Lock()
+
+def _coprocess(command):
+    """
+    Return the _Coprocess for command, starting it if it isn't
+    running.
+    """
+    _coprocesslock.acquire()
+    try:
+        coprocess = _coprocesses.get(command)
+        if coprocess is not None and not coprocess.alive():
+            coprocess.close()
+            coprocess = None
+        if coprocess is None:
+            coprocess = _coprocesses[command] = _Coprocess(command)
+        return coprocess
+    finally:
+        _coprocesslock.release()
+
+def _runpersistent(command, data, timeout):
+    """
+    Return the exit status of the persistent command for data, which
+    has timeout seconds to answer.  A command that exits without
+    answering is started again, once.
+    """
+    for attempt in range(2):
+        coprocess = _coprocess(command)
+        status = coprocess.filter(data, timeout)
+        if status is not None:
+            return status
+        coprocess.close()
+    raise Error('command "%s" exited without answering' % command)
+
+
+# Filter files parsed by this process, once remember_filters() has
+# been called.  Maps a pathname to the parsed filter, in the form of a
+# compiled filter, which is used for as long as it's up-to-date.
+_parsedcache = None
+
+def remember_filters():
+    """
+    Keep the filter files parsed from now on in memory, for later
+    FilterParser instances to use while the files are unchanged.
+    """
+    global _parsedcache
+    if _parsedcache is None:
+        _parsedcache = {}
+
+
 def _rulestr(source, args, match, actions):
     """
     Build string from source, args, match and actions.
@@ -1182,6 +2068,27 @@ def splitaction(action):
     return tuple(parts)
 
 
+# from-sql and to-sql statements with their %(criteria)s filled in, by
+# (statement, address column, number of keys).
+_sqlcache = {}
+
+def _sqlstatement(selectstmt, addresscolumn, count):
+    """
+    Return selectstmt with %(criteria)s replaced by the condition that
+    addresscolumn is one of count keys, given as parameters
+    criterion0 to criterionN.
+    """
+    key = (selectstmt, addresscolumn, count)
+    if not _sqlcache.has_key(key):
+        criteria = ''
+        if count:
+            criteria = '(%s)' % ' OR '.join(
+                [ '%s = %%(criterion%d)s' % (addresscolumn, i)
+                  for i in range(count) ])
+        _sqlcache[key] = selectstmt.replace('%(criteria)s', criteria)
+    return _sqlcache[key]
+
+
 def create_sql_params(dbkeys=[], **kwargs):
     """Return dictionary of parameters for SQL statement."""
     params = kwargs.copy()
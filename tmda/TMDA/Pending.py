@@ -25,14 +25,19 @@
 
 
 from email.utils import parseaddr
+import collections
+import cPickle
 import email
 import os
 import sys
+import tempfile
+import threading
 import time
 
 import Defaults
 import Errors
 import FilterParser
+import SQL
 import Util
 from TMDA.Queue.Queue import Queue
 
@@ -43,6 +48,12 @@ Q = Q.init()
 
 class Queue:
     """A simple pending queue."""
+    # Send released messages through one Util.SendmailBatch.
+    batch_release = True
+    # Commit the DB_PENDING_*_APPEND rows through one SQL.InsertBatch.
+    batch_inserts = True
+    # Read messages ahead of the main loop with a pool of threads.
+    parallel_scan = True
 
     def __init__( self,
                   msgs = [],
@@ -131,18 +142,17 @@ class Queue:
     def _loadCache(self):
         """Load the message cache from disk."""
         if self.cache:
-            if os.path.exists(Defaults.PENDING_CACHE):
-                self.msgcache = Util.unpickle(Defaults.PENDING_CACHE)
-            else:
-                self.msgcache = []
+            self.msgcache = MessageCache(Defaults.PENDING_CACHE,
+                                         Defaults.PENDING_CACHE_LEN)
+
+    def _inCache(self, msgid):
+        """Return true if the message is already in the cache."""
+        return self.cache and msgid in self.msgcache
 
     def _addCache(self, msgid):
         """Add a message to the cache."""
         if self.cache:
-            if msgid in self.msgcache:
-                return 0
-            else:
-                self.msgcache.insert(0, msgid)
+            return self.msgcache.add(msgid)
         return 1
 
     def _delCache(self, msgid):
@@ -155,10 +165,7 @@ class Queue:
     def _saveCache(self):
         """Save the cache on disk."""
         if self.cache:
-            # Trim tail entries off if necessary, and then save the
-            # cache in ASCII format.
-            self.msgcache = self.msgcache[:Defaults.PENDING_CACHE_LEN]
-            Util.pickleit(self.msgcache, Defaults.PENDING_CACHE, 0)
+            self.msgcache.save()
 
     ## Threshold (-Y and -O options)
     def checkTreshold(self, msgid):
@@ -180,7 +187,7 @@ class Queue:
             return 0
         if not self.pretend:
             if self.dispose == 'release':
-                M.release()
+                M.release(self.batch)
             elif self.dispose == 'delete':
                 M.delete()
             elif self.dispose == 'whitelist':
@@ -218,18 +225,88 @@ class Queue:
 
         self._loadCache()
 
+        self.batch = None
+        self.failed = []
+        if self.batch_release and self.dispose == 'release' \
+               and not self.pretend:
+            self.batch = Util.SendmailBatch()
+        inserts = None
+        if self.batch_inserts and Defaults.DB_CONNECTION \
+               and self.dispose not in (None, 'pass', 'show') \
+               and not self.pretend:
+            inserts = SQL.InsertBatch(Defaults.DB_CONNECTION)
+        try:
+            self.processMessages()
+        finally:
+            try:
+                self.finishRelease()
+            finally:
+                if inserts is not None:
+                    inserts.finish()
+
+        self._saveCache()
+
+    def wantedHeaders(self):
+        """Return the headers needed to list the messages, or None if
+        all of them may be needed."""
+        if self.dispose not in (None, 'pass'):
+            return None
+        headers = []
+        if self.terse:
+            for hdr in Defaults.TERSE_SUMMARY_HEADERS:
+                if hdr in ('from_name', 'from_address'):
+                    hdr = 'from'
+                headers.append(hdr)
+        elif self.verbose:
+            headers.extend(Defaults.SUMMARY_HEADERS)
+        return headers
+
+    def loadMessage(self, msgid):
+        """Return the Message for msgid, or the MessageError raised."""
+        try:
+            M = Message(msgid, self.command_recipient, headers=self.headers)
+        except Errors.MessageError, obj:
+            return obj
+        if self.dispose in ('release', 'show') and not self.pretend:
+            M.loadBody()
+        return M
+
+    def processMessages(self):
+        """Process each message in turn."""
+        self.headers = None
+        if self.parallel_scan:
+            self.headers = self.wantedHeaders()
+        wanted = []
+        if self.parallel_scan and Q.concurrent_reads:
+            seen = set()
+            for msgid in self.msgs:
+                if not self.checkTreshold(msgid) or self._inCache(msgid):
+                    continue
+                # With the cache, a repeated message is only processed
+                # the first time.
+                if self.cache and msgid in seen:
+                    continue
+                seen.add(msgid)
+                wanted.append(msgid)
+        loader = MessageLoader(self.loadMessage, wanted,
+                               Defaults.PENDING_SCAN_THREADS)
+        try:
+            self.__processMessages(loader)
+        finally:
+            loader.close()
+
+    def __processMessages(self, loader):
         for msgid in self.msgs:
             self.count = self.count + 1
-            try:
-                M = Message(msgid, self.command_recipient)
-            except Errors.MessageError, obj:
-                self.cPrint(obj)
+            if not self.checkTreshold(msgid):
                 continue
-
-            if not self.checkTreshold(M.msgid):
+            if self._inCache(msgid):
                 continue
-            if not self._addCache(M.msgid):
+            M = loader.get(msgid)
+            if isinstance(M, Errors.MessageError):
+                self.cPrint(M)
                 continue
+            self._addCache(M.msgid)
 
             # Pass over the message if it lacks X-TMDA-Recipient and we
             # aren't using `-R'.
@@ -251,10 +328,21 @@ class Queue:
 
             self.endProcessMessage(M)
 
-        self._saveCache()
+    def finishRelease(self):
+        """Wait for batched releases and report the ones that failed."""
+        if self.batch is None:
+            return
+        for (msgid, error) in self.batch.finish():
+            self.failed.append(msgid)
+            self.Print('release %s failed: %s' % (msgid, error))
+        self.batch = None
 
 class InteractiveQueue(Queue):
     """An interactive pending queue."""
+    # Release each message as soon as it is chosen.
+    batch_release = False
+    batch_inserts = False
+    parallel_scan = False
     def __init__( self,
                   msgs = [],
                   cache = None,
@@ -352,16 +440,197 @@ class InteractiveQueue(Queue):
 
 
 
+class MessageCache:
+    """The ids of the messages seen by `tmda-pending --cache', oldest
+    first.  Only the newest `maxlen' ids are kept.
+
+    The file holds one id per line, oldest first; a line '-ID' drops
+    an earlier ID.  save() appends the changes made since the cache
+    was loaded, and rewrites the file only once it has grown to twice
+    maxlen lines.  The pickled list written by earlier versions is
+    read and replaced.
+    """
+    def __init__(self, path, maxlen):
+        self.path = path
+        self.maxlen = maxlen
+        self.ids = collections.OrderedDict()
+        self.changes = []
+        self.lines = 0
+        self.rewrite = False
+        if os.path.exists(path):
+            self.__load()
+        else:
+            self.rewrite = True
+        self.__trim()
+
+    def __load(self):
+        fp = open(self.path, 'rb')
+        data = fp.read()
+        fp.close()
+        if data[:1] in ('(', '\x80'):
+            # A pickled list, newest first.
+            for msgid in reversed(cPickle.loads(data)):
+                self.ids[msgid] = None
+            self.rewrite = True
+            return
+        for line in data.splitlines():
+            self.lines += 1
+            if line.startswith('-'):
+                self.ids.pop(line[1:], None)
+            elif line:
+                self.ids.pop(line, None)
+                self.ids[line] = None
+
+    def __trim(self):
+        while len(self.ids) > self.maxlen:
+            self.ids.popitem(last=False)
+
+    def __contains__(self, msgid):
+        return msgid in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, msgid):
+        """Add msgid as the newest id; return false if it is already
+        in the cache."""
+        if msgid in self.ids:
+            return 0
+        self.ids[msgid] = None
+        self.changes.append(msgid)
+        return 1
+
+    def remove(self, msgid):
+        """Remove msgid from the cache."""
+        del self.ids[msgid]
+        self.changes.append('-' + msgid)
+
+    def save(self):
+        """Write the changes to the file."""
+        self.__trim()
+        if self.rewrite or self.lines + len(self.changes) > 2 * self.maxlen:
+            (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            fp = os.fdopen(fd, 'w')
+            fp.writelines([msgid + '\n' for msgid in self.ids])
+            fp.close()
+            os.rename(tmpname, self.path)
+            self.lines = len(self.ids)
+            self.rewrite = False
+        elif self.changes:
+            fp = open(self.path, 'a')
+            fp.writelines([change + '\n' for change in self.changes])
+            fp.close()
+            self.lines += len(self.changes)
+        self.changes = []
+
+
+class MessageLoader:
+    """Load pending messages for the main loop.
+
+    The messages named in msgids are loaded in order by a few threads,
+    at most a window of messages ahead of the calls to get() that ask
+    for them.  Any other message is loaded when it is asked for.
+    """
+    def __init__(self, load, msgids, threads):
+        self.load = load
+        self.msgids = msgids
+        self.next = 0                   # index get() expects next
+        self.started = 0                # index of the next to load
+        self.window = threads * 8
+        self.results = {}
+        self.closed = False
+        self.cond = threading.Condition()
+        self.threads = []
+        if threads > 1 and len(msgids) > 1:
+            for i in range(threads):
+                t = threading.Thread(target=self.__work)
+                t.setDaemon(True)
+                t.start()
+                self.threads.append(t)
+
+    def __work(self):
+        self.cond.acquire()
+        try:
+            while True:
+                while (not self.closed and
+                       self.started < len(self.msgids) and
+                       self.started >= self.next + self.window):
+                    self.cond.wait()
+                if self.closed or self.started >= len(self.msgids):
+                    return
+                i = self.started
+                self.started += 1
+                self.cond.release()
+                try:
+                    result = (True, self.load(self.msgids[i]))
+                except:
+                    result = (False, sys.exc_info())
+                self.cond.acquire()
+                self.results[i] = result
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def get(self, msgid):
+        """Return load(msgid), raising whatever it raised."""
+        if not self.threads or self.next >= len(self.msgids) or \
+               self.msgids[self.next] != msgid:
+            return self.load(msgid)
+        self.cond.acquire()
+        try:
+            while not self.results.has_key(self.next):
+                self.cond.wait()
+            (ok, result) = self.results.pop(self.next)
+            self.next += 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        if ok:
+            return result
+        raise result[0], result[1], result[2]
+
+    def close(self):
+        """Stop reading ahead."""
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notifyAll()
+        self.cond.release()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.results = {}
+
+
 class Message:
     """A simple pending message class"""
     msg_size = 0
     bytes = 'bytes'
     confirm_accept_address = None
-    def __init__(self, msgid, recipient = None, fullParse = False):
+    # Headers used by every message, whatever else is wanted.
+    envelope_headers = ['x-tmda-recipient', 'return-path',
+                        'x-primary-address']
+
+    def __init__(self, msgid, recipient = None, fullParse = False,
+                 headers = None):
+        """Unless fullParse is true, only the message headers are read
+        at first; the body is read when the message is shown or
+        released.  If headers is a list of header names, only those
+        headers are guaranteed to be read."""
         self.msgid = msgid
         if not Q.find_message(self.msgid):
             raise Errors.MessageError, '%s not found!' % self.msgid
-        self.msgobj = Q.fetch_message(self.msgid, fullParse=fullParse)
+        self.fullParse = fullParse
+        if headers is not None:
+            headers = self.envelope_headers + headers
+        if fullParse:
+            self.msgobj = Q.fetch_message(self.msgid, fullParse=True)
+            self.body_loaded = True
+        else:
+            self.msgobj = Q.fetch_headers(self.msgid, headers)
+            self.body_loaded = False
         self.recipient = recipient
         if self.recipient is None:
             self.recipient = self.msgobj.get('x-tmda-recipient')
@@ -370,8 +639,13 @@ class Message:
         self.append_address = Util.confirm_append_address(
             self.x_primary_address, self.return_path)
 
-    def release(self):
-        """Release a message from the pending queue."""
+    def release(self, batch=None):
+        """Release a message from the pending queue.
+
+        If batch is a Util.SendmailBatch the message is submitted to
+        it rather than sent before returning.
+        """
+        self.loadBody()
         import Cookie
         if Defaults.PENDING_RELEASE_APPEND:
             Util.append_to_file(self.append_address,
@@ -411,7 +685,11 @@ class Message:
             del self.msgobj['X-TMDA-CGI']
             self.msgobj['X-TMDA-CGI'] = cgi_header
         # Reinject the message to the original envelope recipient.
-        Util.sendmail(self.show(), self.recipient, self.return_path)
+        if batch is None:
+            Util.sendmail(self.show(), self.recipient, self.return_path)
+        else:
+            batch.submit(self.show(), self.recipient, self.return_path,
+                         self.msgid)
 
     def delete(self):
         """Delete a message from the pending queue."""
@@ -476,12 +754,19 @@ class Message:
                 'PENDING_BLACKLIST_APPEND (or DB_CONNECTION+'
                 'DB_PENDING_BLACKLIST_APPEND) not defined!')
 
+    def loadBody(self):
+        """Read the whole message, if only its headers have been read."""
+        if not self.body_loaded:
+            self.msgobj = Q.fetch_message(self.msgid, fullParse=self.fullParse)
+            self.body_loaded = True
+
     def pager(self):
         Util.pager(self.show())
         return ''
 
     def show(self):
         """Return the string representation of a message."""
+        self.loadBody()
         return Util.msg_as_string(self.msgobj)
 
     def getDate(self):
@@ -531,7 +816,7 @@ class Message:
     def summary(self, count = 0, total = 0, mailto = 0):
         """Return summary header information."""
         if not self.msg_size:
-            self.msg_size = len(self.show())
+            self.msg_size = Q.fetch_size(self.msgid)
             if  self.msg_size == 1:
                 self.bytes =    self.bytes[:-1]
         str = self.msgid + " ("
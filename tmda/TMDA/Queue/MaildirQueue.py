@@ -25,7 +25,6 @@ http://en.wikipedia.org/wiki/Maildir
 """
 
 
-from email.utils import parseaddr
 from glob import glob
 
 
@@ -41,6 +40,7 @@ from TMDA import Defaults
 from TMDA import Errors
 from TMDA import Util
 from TMDA.Queue.Queue import Queue
+from TMDA.Queue.Util import delete_messages, expired_messages
 
 
 def alarm_handler(signum, frame):
@@ -86,43 +86,9 @@ class MaildirQueue(Queue):
     def cleanup(self):
         if not self.exists():
             return
-
-        lifetimesecs = Util.seconds(Defaults.PENDING_LIFETIME)
-        cwd = os.getcwd()
-        os.chdir(os.path.join(Defaults.PENDING_DIR, 'new'))
-        new_msgs = glob('1*.[0-9]*.*')
-        os.chdir(os.path.join(Defaults.PENDING_DIR, 'cur'))
-        cur_msgs = glob('1*.[0-9]*.*')
-        os.chdir(cwd)
-        msgs = new_msgs + cur_msgs
-
-        for msg in msgs:
-            now = '%d' % time.time()
-            min_time = int(now) - int(lifetimesecs)
-            msg_time = int(msg.split('.')[0])
-            if msg_time > min_time:
-                # skip this message
-                continue
-            # delete this message
-            for f in (os.path.join(Defaults.PENDING_DIR, 'new', msg),
-                      os.path.join(Defaults.PENDING_DIR, 'cur', msg)):
-                if os.path.exists(f):
-                    fpath = f
-                    break
-            if Defaults.PENDING_DELETE_APPEND:
-                try:
-                    msgobj = Util.msg_from_file(open(fpath, 'r'))
-                except IOError:
-                    # in case of concurrent cleanups
-                    pass
-                else:
-                    rp = parseaddr(msgobj.get('return-path'))[1]
-                    Util.append_to_file(rp, Defaults.PENDING_DELETE_APPEND)
-            try:
-                os.unlink(fpath)
-            except OSError:
-                # in case of concurrent cleanups
-                pass
+        delete_messages(expired_messages(
+            [os.path.join(Defaults.PENDING_DIR, 'new'),
+             os.path.join(Defaults.PENDING_DIR, 'cur')]))
 
 
     def fetch_ids(self):
@@ -151,50 +117,74 @@ class MaildirQueue(Queue):
 
 
     def fetch_message(self, mailid, fullParse=False):
-        msgs = (glob(os.path.join(Defaults.PENDING_DIR, 'new/')
-                     + '1*.[0-9]*.*')) + \
-                     (glob(os.path.join(Defaults.PENDING_DIR, 'cur/')
-                           + '1*.[0-9]*.*'))
-        for m in msgs:
-            if mailid in m:
-                msg = Util.msg_from_file(file(m, 'r'),fullParse=fullParse)
-                return msg
-        else:
+        m = self.__find_path(mailid)
+        if m is None:
             # couldn't find message, defer and retry until we find it
-            raise IOError, "couldn't locate %s, will retry" % m
+            raise IOError, "couldn't locate %s, will retry" % mailid
+        return Util.msg_from_file(file(m, 'r'), fullParse=fullParse)
+
+
+    def fetch_headers(self, mailid, names=None):
+        m = self.__find_path(mailid)
+        if m is None:
+            raise IOError, "couldn't locate %s, will retry" % mailid
+        f = open(m)
+        try:
+            return Util.headers_from_file(f)
+        finally:
+            f.close()
+
+
+    def fetch_size(self, mailid):
+        m = self.__find_path(mailid)
+        if m is None:
+            raise IOError, "couldn't locate %s" % mailid
+        return os.path.getsize(m)
 
 
     def delete_message(self, mailid):
-        msgs = (glob(os.path.join(Defaults.PENDING_DIR, 'new/')
-                     + '1*.[0-9]*.*')) + \
-                     (glob(os.path.join(Defaults.PENDING_DIR, 'cur/')
-                           + '1*.[0-9]*.*'))
-        for m in msgs:
-            if mailid in m:
-                os.unlink(m)
+        m = self.__find_path(mailid)
+        if m is not None:
+            os.unlink(m)
 
 
     def find_message(self, mailid):
-        cwd = os.getcwd()
-        os.chdir(Defaults.PENDING_DIR)
-        msgs = glob('new/1*.[0-9]*.*') + glob('cur/1*.[0-9]*.*')
-
         for i in range(5):
-            for m in msgs:
-                if mailid in m:
-                    os.chdir(cwd)
-                    return True
-            else:
-                # retry 5 times in case a MUA moved/renamed the
-                # message to cur/ in a non-atomic way.
-                time.sleep(0.1)
-                msgs = glob('new/1*.[0-9]*.*') + glob('cur/1*.[0-9]*.*')
-                continue
+            if self.__find_path(mailid) is not None:
+                return True
+            # retry 5 times in case a MUA moved/renamed the
+            # message to cur/ in a non-atomic way.
+            time.sleep(0.1)
         # give up; message is not there
-        os.chdir(cwd)
         return False
 
 
+    def __find_path(self, mailid):
+        """Return the pathname of the message with mailid, or None.
+
+        The file name we gave the message (see __deliver_maildir) is
+        tried first in new/ and cur/.  Only if it isn't there, e.g,
+        because a MUA added an info suffix or the host name changed,
+        are the directories scanned for a name starting with mailid.
+        """
+        filename = '%s.%s' % (mailid, socket.gethostname())
+        for subdir in ('new', 'cur'):
+            path = os.path.join(Defaults.PENDING_DIR, subdir, filename)
+            if os.path.exists(path):
+                return path
+        prefix = mailid + '.'
+        for subdir in ('new', 'cur'):
+            dirpath = os.path.join(Defaults.PENDING_DIR, subdir)
+            try:
+                names = os.listdir(dirpath)
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith(prefix):
+                    return os.path.join(dirpath, name)
+        return None
+
+
     def __deliver_maildir(self, message, time, pid, maildir):
         """Reliably deliver a mail message into a Maildir.
 
@@ -32,15 +32,13 @@ wish to monitor the contents of their pending queue.
 """
 
 
-from email.utils import parseaddr
-
 import glob
 import os
-import time
 
 from TMDA import Defaults
 from TMDA import Util
 from TMDA.Queue.Queue import Queue
+from TMDA.Queue.Util import delete_messages, expired_messages
 
 
 
@@ -69,36 +67,7 @@ class OriginalQueue(Queue):
     def cleanup(self):
         if not self.exists():
             return
-
-        lifetimesecs = Util.seconds(Defaults.PENDING_LIFETIME)
-        cwd = os.getcwd()
-        os.chdir(Defaults.PENDING_DIR)
-        msgs = glob.glob('*.*.msg')
-        os.chdir(cwd)
-
-        for msg in msgs:
-            now = '%d' % time.time()
-            min_time = int(now) - int(lifetimesecs)
-            msg_time = int(msg.split('.')[0])
-            if msg_time > min_time:
-                # skip this message
-                continue
-            # delete this message
-            fpath = os.path.join(Defaults.PENDING_DIR, msg)
-            if Defaults.PENDING_DELETE_APPEND:
-                try:
-                    msgobj = Util.msg_from_file(open(fpath, 'r'))
-                except IOError:
-                    # in case of concurrent cleanups
-                    pass
-                else:
-                    rp = parseaddr(msgobj.get('return-path'))[1]
-                    Util.append_to_file(rp, Defaults.PENDING_DELETE_APPEND)
-            try:
-                os.unlink(fpath)
-            except OSError:
-                # in case of concurrent cleanups
-                pass
+        delete_messages(expired_messages([Defaults.PENDING_DIR], '.msg'))
 
 
     def fetch_ids(self):
@@ -130,6 +99,20 @@ class OriginalQueue(Queue):
         return msg
 
 
+    def fetch_headers(self, mailid, names=None):
+        fpath = os.path.join(Defaults.PENDING_DIR, mailid + '.msg')
+        f = open(fpath)
+        try:
+            return Util.headers_from_file(f)
+        finally:
+            f.close()
+
+
+    def fetch_size(self, mailid):
+        fpath = os.path.join(Defaults.PENDING_DIR, mailid + '.msg')
+        return os.path.getsize(fpath)
+
+
     def delete_message(self, mailid):
         fpath = os.path.join(Defaults.PENDING_DIR, mailid + '.msg')
         os.unlink(fpath)
@@ -29,9 +29,13 @@ currently comes from a timestamp and the Python process id.
 
 from TMDA import Defaults
 from TMDA import Errors
+from TMDA import Util
 
 
 class Queue:
+    # True if messages may be fetched from several threads at once.
+    concurrent_reads = True
+
     def __init__(self):
         self.format = "not defined"
 
@@ -113,6 +117,27 @@ class Queue:
         pass
 
 
+    # Subclasses may override the following methods if their format
+    # allows a faster implementation.
+
+    def fetch_headers(self, mailid, names=None):
+        """
+        Fetch the headers of a message in the queue, without reading
+        its body where the format allows it.  names is a list of the
+        header names wanted, or None for all of them.  Should return an
+        email.message like object that has at least those headers; the
+        default is the whole message.
+        """
+        return self.fetch_message(mailid)
+
+
+    def fetch_size(self, mailid):
+        """
+        Return the size in bytes of a message in the queue.
+        """
+        return len(Util.msg_as_string(self.fetch_message(mailid)))
+
+
     # Subclasses should not override this method.
 
     def init(self):
@@ -123,6 +148,9 @@ class Queue:
         if qformat.lower() == 'maildir':
             from MaildirQueue import MaildirQueue
             return MaildirQueue()
+        if qformat.lower() == 'sqlite':
+            from SQLiteQueue import SQLiteQueue
+            return SQLiteQueue()
         else:
             raise Errors.ConfigError, \
                 "Unknown PENDING_QUEUE_FORMAT: " + '"%s"' % qformat
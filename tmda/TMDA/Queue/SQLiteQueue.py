@@ -0,0 +1,243 @@
+# -*- python -*-
+#
+# Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""SQLite pending queue format.
+
+Messages are stored in a single database, PENDING_DIR/pending.db,
+together with the columns needed to list and expire them without
+parsing each message.  Headers are read from the stored message, up
+to its first blank line.
+"""
+
+
+from cStringIO import StringIO
+from email.utils import parseaddr
+
+import os
+import sqlite3
+import time
+
+
+from TMDA import Defaults
+from TMDA import Util
+from TMDA.Queue.Queue import Queue
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    mailid      TEXT PRIMARY KEY,
+    timestamp   INTEGER NOT NULL,
+    return_path TEXT,
+    message     BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+"""
+
+# The end of the header block, as an SQL blob literal.
+BLANK_LINE = "X'0A0A'"
+
+# Connections opened by a parent process.
+_inherited = []
+
+
+class SQLiteQueue(Queue):
+    # A connection can only be used by the thread that opened it.
+    concurrent_reads = False
+
+    def __init__(self):
+        Queue.__init__(self)
+        self.format = "sqlite"
+        self.dbname = os.path.join(Defaults.PENDING_DIR, 'pending.db')
+        self.__db = None
+        self.__pid = None
+        # Whether PENDING_DIR was looked at for messages to convert.
+        self.__checked = False
+
+
+    def exists(self):
+        if os.path.exists(self.dbname):
+            return True
+        # Messages left by another format are converted as soon as the
+        # queue is used, so that they can be found before anything new
+        # is inserted.
+        if not self.__checked:
+            self.__checked = True
+            for q in self.__legacy_queues():
+                if q.fetch_ids():
+                    self._create()
+                    return True
+        return False
+
+
+    def _create(self):
+        if not os.path.exists(Defaults.PENDING_DIR):
+            os.makedirs(Defaults.PENDING_DIR, 0700)
+        created = not os.path.exists(self.dbname)
+        self.__connect()
+        if created:
+            os.chmod(self.dbname, 0600)
+            self._convert()
+
+
+    def _convert(self):
+        """
+        Move any messages left in PENDING_DIR by the 'original' or
+        'maildir' formats into the database.
+        """
+        db = self.__connect()
+        for q in self.__legacy_queues():
+            for mailid in q.fetch_ids():
+                if not self.find_message(mailid):
+                    self.__insert(mailid, q.fetch_message(mailid))
+                    db.commit()
+                q.delete_message(mailid)
+
+
+    def cleanup(self):
+        if not self.exists():
+            return
+
+        lifetimesecs = Util.seconds(Defaults.PENDING_LIFETIME)
+        now = '%d' % time.time()
+        min_time = int(now) - int(lifetimesecs)
+        # A negative LIMIT means no limit.
+        limit = Defaults.PENDING_CLEANUP_BATCH or -1
+        db = self.__connect()
+        expired = db.execute('SELECT mailid, return_path FROM messages'
+                             ' WHERE timestamp <= ? ORDER BY timestamp'
+                             ' LIMIT ?', (min_time, limit)).fetchall()
+        for (mailid, rp) in expired:
+            if Defaults.PENDING_DELETE_APPEND:
+                Util.append_to_file(rp or '', Defaults.PENDING_DELETE_APPEND)
+            db.execute('DELETE FROM messages WHERE mailid = ?', (mailid,))
+        db.commit()
+
+
+    def fetch_ids(self):
+        if not self.exists():
+            return []
+        cursor = self.__connect().execute('SELECT mailid FROM messages'
+                                          ' ORDER BY timestamp, mailid')
+        return [mailid for (mailid,) in cursor]
+
+
+    def insert_message(self, msg, mailid, recipient):
+        # Create ~/.tmda/pending/pending.db if necessary.
+        self._create()
+        # X-TMDA-Recipient is used by release_pending()
+        del msg['X-TMDA-Recipient']
+        msg['X-TMDA-Recipient'] = recipient
+        self.__insert(mailid, msg)
+        self.__connect().commit()
+        del msg['X-TMDA-Recipient']
+
+
+    def fetch_message(self, mailid, fullParse=False):
+        row = self.__fetchone('SELECT message FROM messages WHERE mailid = ?',
+                              mailid)
+        return Util.msg_from_file(StringIO(str(row[0])), fullParse=fullParse)
+
+
+    def fetch_headers(self, mailid, names=None):
+        # Read the message only up to its first blank line.
+        row = self.__fetchone('SELECT CASE instr(message, %s)'
+                              ' WHEN 0 THEN message'
+                              ' ELSE substr(message, 1, instr(message, %s)) END'
+                              ' FROM messages WHERE mailid = ?'
+                              % (BLANK_LINE, BLANK_LINE), mailid)
+        return Util.msg_from_file(StringIO(str(row[0])))
+
+
+    def fetch_size(self, mailid):
+        row = self.__fetchone('SELECT length(message) FROM messages'
+                              ' WHERE mailid = ?', mailid)
+        return row[0]
+
+
+    def delete_message(self, mailid):
+        db = self.__connect()
+        db.execute('DELETE FROM messages WHERE mailid = ?', (mailid,))
+        db.commit()
+
+
+    def find_message(self, mailid):
+        if not self.exists():
+            return False
+        cursor = self.__connect().execute('SELECT 1 FROM messages'
+                                          ' WHERE mailid = ?', (mailid,))
+        if cursor.fetchone():
+            return True
+        else:
+            return False
+
+
+    def __legacy_queues(self):
+        """Return the queues of the other formats found in PENDING_DIR."""
+        if not os.path.isdir(Defaults.PENDING_DIR):
+            return []
+        from OriginalQueue import OriginalQueue
+        from MaildirQueue import MaildirQueue
+        queues = [OriginalQueue()]
+        if (os.path.isdir(os.path.join(Defaults.PENDING_DIR, 'new')) and
+            os.path.isdir(os.path.join(Defaults.PENDING_DIR, 'cur'))):
+            queues.append(MaildirQueue())
+        return queues
+
+
+    def __connect(self):
+        """Return the database connection, opening it if necessary.
+        A process forked from the one which opened it, such as the one
+        schedule_cleanup() starts, opens its own."""
+        if self.__db is not None and self.__pid != os.getpid():
+            # SQLite connections can't be used, or even closed, in a
+            # child process, so it is kept from being collected.
+            _inherited.append(self.__db)
+            self.__db = None
+        if self.__db is None:
+            db = sqlite3.connect(self.dbname, timeout=60)
+            # Headers and messages may contain 8-bit data.
+            db.text_factory = str
+            db.executescript(SCHEMA)
+            self.__db = db
+            self.__pid = os.getpid()
+        return self.__db
+
+
+    def __fetchone(self, query, mailid):
+        """Return the single row for mailid, or raise IOError."""
+        row = None
+        if self.exists():
+            row = self.__connect().execute(query, (mailid,)).fetchone()
+        if row is None:
+            raise IOError, "couldn't locate %s" % mailid
+        return row
+
+
+    def __insert(self, mailid, msg):
+        """Store msg, which already has its X-TMDA-Recipient header."""
+        return_path = msg.get('return-path')
+        if return_path is not None:
+            return_path = parseaddr(return_path)[1]
+        self.__connect().execute(
+            'INSERT OR REPLACE INTO messages (mailid, timestamp, return_path,'
+            ' message) VALUES (?, ?, ?, ?)',
+            (mailid, int(mailid.split('.')[0]), return_path,
+             sqlite3.Binary(Util.msg_as_string(msg))))
@@ -22,3 +22,158 @@
 """General purpose (Pending Queue related) functions."""
 
 
+
+
+from email.utils import parseaddr
+
+import errno
+import fcntl
+import heapq
+import os
+import re
+import time
+
+from TMDA import Defaults
+from TMDA import Util
+
+
+# Message file names start with the mailid, <time>.<pid>.
+_stamped = re.compile(r'(\d+)\.\d+\.')
+
+
+def expired_messages(dirnames, suffix=''):
+    """Return the pathnames of the expired messages in dirnames,
+    oldest first.
+
+    Only file names starting with a mailid and ending with suffix are
+    considered, and at most Defaults.PENDING_CLEANUP_BATCH pathnames
+    are returned.
+    """
+    lifetimesecs = Util.seconds(Defaults.PENDING_LIFETIME)
+    min_time = int(time.time()) - int(lifetimesecs)
+    expired = []
+    for dirname in dirnames:
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            continue
+        for name in names:
+            mo = _stamped.match(name)
+            if mo and name.endswith(suffix):
+                msg_time = int(mo.group(1))
+                if msg_time <= min_time:
+                    expired.append((msg_time, name,
+                                    os.path.join(dirname, name)))
+    if Defaults.PENDING_CLEANUP_BATCH:
+        expired = heapq.nsmallest(Defaults.PENDING_CLEANUP_BATCH, expired)
+    else:
+        expired.sort()
+    return [path for (msg_time, name, path) in expired]
+
+
+def delete_messages(paths):
+    """Delete the message files in paths, appending their senders to
+    Defaults.PENDING_DELETE_APPEND if it's set."""
+    for fpath in paths:
+        if Defaults.PENDING_DELETE_APPEND:
+            try:
+                rp = return_path(fpath)
+            except IOError:
+                # in case of concurrent cleanups
+                pass
+            else:
+                Util.append_to_file(rp, Defaults.PENDING_DELETE_APPEND)
+        try:
+            os.unlink(fpath)
+        except OSError:
+            # in case of concurrent cleanups
+            pass
+
+
+def return_path(fpath):
+    """Return the Return-Path address of the message in fpath.  Only
+    the header block of the file is read."""
+    fp = open(fpath, 'r')
+    try:
+        msg = Util.headers_from_file(fp)
+    finally:
+        fp.close()
+    return parseaddr(msg.get('return-path'))[1]
+
+
+def _cleanup_file(suffix=''):
+    return os.path.join(Defaults.PENDING_DIR, '.cleanup' + suffix)
+
+
+def cleanup_due():
+    """Return true if PENDING_CLEANUP_INTERVAL has passed since the
+    last cleanup started, or if no interval is set."""
+    if not Defaults.PENDING_CLEANUP_INTERVAL:
+        return True
+    try:
+        last = os.path.getmtime(_cleanup_file())
+    except OSError:
+        return True
+    interval = Util.seconds(Defaults.PENDING_CLEANUP_INTERVAL)
+    return time.time() - last >= interval
+
+
+def sweep(queue):
+    """Clean up queue if it's due, unless another process is already
+    doing so.  Return true if the cleanup was done.
+
+    A lock on PENDING_DIR/.cleanup.lock is held during the cleanup,
+    and the modification time of PENDING_DIR/.cleanup records when
+    the last cleanup started.
+    """
+    if not queue.exists():
+        return False
+    fp = open(_cleanup_file('.lock'), 'a')
+    try:
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        # Another process may have finished a cleanup since we
+        # checked.
+        if not cleanup_due():
+            return False
+        open(_cleanup_file(), 'w').close()
+        queue.cleanup()
+        return True
+    finally:
+        # Closing the file releases the lock.
+        fp.close()
+
+
+def schedule_cleanup(queue, detach=True):
+    """Clean up queue if PENDING_CLEANUP_INTERVAL has passed since the
+    last cleanup.
+
+    If detach is true, the cleanup runs in a separate process that
+    doesn't hold on to our standard input and output, so our caller
+    (and the MTA waiting for its exit status) isn't delayed by it.
+    """
+    if not queue.exists() or not cleanup_due():
+        return
+    if not detach:
+        sweep(queue)
+        return
+    pid = os.fork()
+    if pid:
+        # Reap the intermediate child; the sweep runs in its child.
+        os.waitpid(pid, 0)
+        return
+    # Any exception is discarded by exiting in the finally clause.
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        sweep(queue)
+    finally:
+        os._exit(0)
@@ -31,7 +31,11 @@ Copyright (C) 1998,1999,2000,2001 by the Free Software Foundation, Inc.,
 and licensed under the GNU General Public License version 2.
 """
 
+import atexit
+import os
 import smtplib
+import socket
+import threading
 
 import Defaults
 
@@ -40,11 +44,13 @@ import Defaults
 class Connection:
     def __init__(self):
         self.__conn = None
+        self.__used = False
 
     def __connect(self):
         self.__conn = smtplib.SMTP()
         self.__conn.connect(Defaults.SMTPHOST)
         self.__numsessions = Defaults.SMTP_MAX_SESSIONS_PER_CONNECTION
+        self.__used = False
         # Optional TLS (SSL) mode.
         if Defaults.SMTPSSL:
             self.__conn.starttls(Defaults.SMTPSSL_KEYFILE,
@@ -54,7 +60,19 @@ class Connection:
             self.__conn.login(Defaults.SMTPAUTH_USERNAME,
                               Defaults.SMTPAUTH_PASSWORD)
 
+    def __alive(self):
+        """Return true if the server still accepts commands on this
+        connection."""
+        try:
+            return self.__conn.rset()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
     def sendmail(self, envsender, recips, msgtext):
+        # A connection left open by an earlier session may have been
+        # closed by the server since.
+        if self.__conn is not None and self.__used and not self.__alive():
+            self.close()
         if self.__conn is None:
             self.__connect()
         try:
@@ -66,6 +84,7 @@ class Connection:
             self.quit()
             raise
         # This session has been successfully completed.
+        self.__used = True
         self.__numsessions -= 1
         # By testing exactly for equality to 0, we automatically
         # handle the case for SMTP_MAX_SESSIONS_PER_CONNECTION <= 0
@@ -80,7 +99,77 @@ class Connection:
             return
         try:
             self.__conn.quit()
-        except smtplib.SMTPException:
+        except (smtplib.SMTPException, socket.error):
             pass
         self.__conn = None
 
+    def close(self):
+        """Drop the connection without saying goodbye to the server."""
+        if self.__conn is None:
+            return
+        self.__conn.close()
+        self.__conn = None
+
+
+# Keep connections open for reuse across messages sent by a process.
+class Pool:
+    def __init__(self, size=4):
+        # At most size idle connections are kept.
+        self.size = size
+        self.__idle = []
+        self.__pid = os.getpid()
+        self.__lock = threading.Lock()
+
+    def __inherited(self):
+        """Forget connections inherited from our parent process; they
+        are still in use there.  Call with the lock held."""
+        if self.__pid != os.getpid():
+            self.__idle = []
+            self.__pid = os.getpid()
+
+    def __get(self):
+        self.__lock.acquire()
+        try:
+            self.__inherited()
+            if self.__idle:
+                return self.__idle.pop()
+        finally:
+            self.__lock.release()
+        return Connection()
+
+    def __put(self, conn):
+        self.__lock.acquire()
+        try:
+            if self.__pid == os.getpid() and len(self.__idle) < self.size:
+                self.__idle.append(conn)
+                return
+        finally:
+            self.__lock.release()
+        conn.quit()
+
+    def sendmail(self, envsender, recips, msgtext):
+        conn = self.__get()
+        try:
+            results = conn.sendmail(envsender, recips, msgtext)
+        except:
+            conn.quit()
+            raise
+        self.__put(conn)
+        return results
+
+    def close(self):
+        """Close the idle connections."""
+        self.__lock.acquire()
+        try:
+            self.__inherited()
+            idle = self.__idle
+            self.__idle = []
+        finally:
+            self.__lock.release()
+        for conn in idle:
+            conn.quit()
+
+
+# The connections used by Util.sendmail().
+pool = Pool()
+atexit.register(pool.close)
@@ -0,0 +1,275 @@
+# -*- python -*-
+#
+# Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""Python DB API access for the SQL filter sources and appends.
+
+DB_CONNECTION is either a DB API connection, which is used as it is,
+or a function that returns a new one.  Given a function, TMDA connects
+when it first needs to and keeps the connection for as long as the
+process runs.  A connection that has been idle for DB_CHECK_INTERVAL
+seconds is checked before it is used again, and one that fails, or
+was made before the process forked, is replaced.
+
+Statements are written with %(name)s parameters, and are rewritten
+for modules with another paramstyle, such as sqlite3.
+"""
+
+
+import os
+import re
+import sys
+import threading
+import time
+
+import Defaults
+
+
+def module(connection):
+    """Return the DB API module that connection comes from."""
+    return sys.modules.get(type(connection).__module__.split('.')[0])
+
+
+def threadsafe(connection):
+    """Return true if the DB API module of connection lets threads
+    share connections (its threadsafety is 2 or more)."""
+    return getattr(module(connection), 'threadsafety', 0) >= 2
+
+
+# Connections made by DB_CONNECTION functions, by function, as
+# [pid, connection, time last used] lists.
+_connections = {}
+_connectionslock = threading.Lock()
+
+def connection(db=None):
+    """Return the connection to use for db, which defaults to
+    DB_CONNECTION.  None means there is no database."""
+    if db is None:
+        db = Defaults.DB_CONNECTION
+    if db is None or hasattr(db, 'cursor'):
+        return db
+    _connectionslock.acquire()
+    try:
+        now = time.time()
+        entry = _connections.get(db)
+        if entry and entry[0] == os.getpid():
+            if now - entry[2] < Defaults.DB_CHECK_INTERVAL or \
+                   _healthy(entry[1]):
+                entry[2] = now
+                return entry[1]
+            _close(entry[1])
+        # A connection made before a fork belongs to the parent, and is
+        # left alone.
+        _connections[db] = [os.getpid(), db(), now]
+        return _connections[db][1]
+    finally:
+        _connectionslock.release()
+
+
+def discard(db, conn):
+    """Stop using conn, db's connection, after it failed."""
+    _connectionslock.acquire()
+    try:
+        entry = _connections.get(db)
+        if entry and entry[1] is conn:
+            del _connections[db]
+            if entry[0] == os.getpid():
+                _close(conn)
+    finally:
+        _connectionslock.release()
+
+
+def _healthy(conn):
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        finally:
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+_parameter = re.compile(r'%\((\w+)\)s|%%')
+
+# Statements rewritten for a paramstyle, by (paramstyle, statement), as
+# (text, parameter names) tuples.
+_statements = {}
+
+def prepare(conn, statement):
+    """Return statement, written with %(name)s parameters, rewritten
+    for the paramstyle of conn's module.  The result is a tuple of the
+    text and the names of the parameters it takes in order, which is
+    None for the paramstyles that take them by name."""
+    paramstyle = getattr(module(conn), 'paramstyle', 'pyformat')
+    key = (paramstyle, statement)
+    if not _statements.has_key(key):
+        if paramstyle in ('format', 'pyformat'):
+            _statements[key] = (statement, None)
+        else:
+            names = []
+            def replace(mo):
+                if mo.group(1) is None:
+                    return '%'
+                names.append(mo.group(1))
+                if paramstyle == 'named':
+                    return ':' + mo.group(1)
+                elif paramstyle == 'numeric':
+                    return ':%d' % len(names)
+                return '?'
+            text = _parameter.sub(replace, statement)
+            if paramstyle == 'named':
+                names = None
+            _statements[key] = (text, names)
+    return _statements[key]
+
+
+def _execute(conn, cursor, statement, params):
+    (text, names) = prepare(conn, statement)
+    if names is not None:
+        params = tuple([ params[name] for name in names ])
+    cursor.execute(text, params)
+
+
+def query(db, statement, params, results=None):
+    """Run the SELECT statement with params over db's connection, and
+    return a tuple of the result's description and rows.
+
+    results, if given, is a dictionary of the queries already run for
+    the message at hand, so that rules making the same query share one
+    round trip to the database.  If a connection made by a
+    DB_CONNECTION function stops working, the query is tried once more
+    over a new one.
+    """
+    if db is None:
+        db = Defaults.DB_CONNECTION
+    if results is not None:
+        key = (statement, tuple(sorted(params.items())))
+        if results.has_key(key):
+            return results[key]
+    for attempt in range(2):
+        conn = connection(db)
+        try:
+            cursor = conn.cursor()
+            try:
+                _execute(conn, cursor, statement, params)
+                result = (cursor.description, cursor.fetchall())
+            finally:
+                cursor.close()
+            break
+        except module(conn).Error:
+            # Only a connection that no longer works is replaced.
+            if conn is db or attempt or _healthy(conn):
+                raise
+            discard(db, conn)
+    if results is not None:
+        results[key] = result
+    return result
+
+
+# The open InsertBatch for each DB_CONNECTION.
+_batches = {}
+
+def insert(db, statement, params):
+    """Run the INSERT statement with params over db's connection, and
+    commit it, unless an InsertBatch is open for db.  Database errors,
+    such as for a row that is already there, are ignored."""
+    if db is None:
+        db = Defaults.DB_CONNECTION
+    if _batches.has_key(db):
+        _batches[db].insert(statement, params)
+    else:
+        _commit(connection(db), statement, params)
+
+
+def _commit(conn, statement, params):
+    cursor = conn.cursor()
+    try:
+        try:
+            _execute(conn, cursor, statement, params)
+            conn.commit()
+        except module(conn).DatabaseError:
+            pass
+    finally:
+        cursor.close()
+
+
+class InsertBatch:
+    """While open, have insert() for db, as Util.db_insert() does,
+    commit its rows together when the batch is finished rather than
+    one at a time.
+
+    If a row fails, the batch so far is rolled back and its rows
+    inserted one at a time, so that, as before, only the failing row
+    is lost.
+    """
+    def __init__(self, db=None):
+        if db is None:
+            db = Defaults.DB_CONNECTION
+        self.db = db
+        # Connected for the first row, and kept for the whole batch.
+        self.conn = None
+        self.rows = []
+        _batches[db] = self
+
+    def insert(self, statement, params):
+        if self.conn is None:
+            self.conn = connection(self.db)
+        cursor = self.conn.cursor()
+        try:
+            try:
+                _execute(self.conn, cursor, statement, params)
+            except module(self.conn).DatabaseError:
+                self.__replay()
+                return
+        finally:
+            cursor.close()
+        self.rows.append((statement, params))
+
+    def __replay(self):
+        try:
+            self.conn.rollback()
+        except module(self.conn).DatabaseError:
+            pass
+        for (statement, params) in self.rows:
+            _commit(self.conn, statement, params)
+        self.rows = []
+
+    def finish(self):
+        """Commit the rows inserted so far, and close the batch."""
+        try:
+            if self.rows:
+                try:
+                    self.conn.commit()
+                except module(self.conn).DatabaseError:
+                    self.__replay()
+                self.rows = []
+        finally:
+            if _batches.get(self.db) is self:
+                del _batches[self.db]
@@ -23,25 +23,27 @@
 
 
 from cStringIO import StringIO
-import cPickle
 import email
 import email.utils
-import fileinput
-import fnmatch
 import os
-import subprocess
-from subprocess import PIPE, STDOUT # Make these available in Util
 import re
 import socket
 import stat
 import sys
-import tempfile
 import textwrap
 import time
 import optparse
 
 import Errors
 
+# subprocess, tempfile, fileinput, fnmatch and cPickle are imported by
+# the functions that use them; most tmda-rfilter runs need none of them.
+
+
+# subprocess.PIPE and subprocess.STDOUT, available without importing
+# subprocess.
+PIPE = -1
+STDOUT = -2
 
 MODE_EXEC = 01
 MODE_READ = 04
@@ -350,6 +352,7 @@ def make_date(timesecs=None):
 
 def file_to_dict(file, dict):
     """Process and add then each line of a textfile to a dictionary."""
+    import fileinput
     for line in fileinput.input(file):
         line = line.strip()
         # Comment or blank line?
@@ -366,6 +369,7 @@ def file_to_dict(file, dict):
 
 def file_to_list(file):
     """Process and then append each line of file to list."""
+    import fileinput
     list = []
     for line in fileinput.input(file):
         line = line.strip()
@@ -384,6 +388,7 @@ def runcmd(cmd, instr=None, stdout=None, stderr=None):
     pass as input. stdout and stderr can take the same forms as their
     subprocess.Popen equivalents.
     """
+    import subprocess
     use_shell = False
     if isinstance(cmd, basestring):
         use_shell = True
@@ -420,6 +425,7 @@ def writefile(contents, fullpathname):
 
 def append_to_file(str, fullpathname):
     """Append a string to a text file if it isn't already in there."""
+    import fileinput
     if os.path.exists(fullpathname):
         for line in fileinput.input(fullpathname):
             line = line.strip().lower()
@@ -541,6 +547,17 @@ def msg_from_file(fp, fullParse=False):
     return msg
 
 
+def headers_from_file(fp):
+    """Read only the header block of a message file, and parse it
+    into a Message object with an empty payload."""
+    lines = []
+    for line in fp:
+        if line in ('\n', '\r\n'):
+            break
+        lines.append(line)
+    return msg_from_file(StringIO(''.join(lines)))
+
+
 def msg_as_string(msg, maxheaderlen=False, mangle_from_=False, unixfrom=False):
     """A more flexible replacement for Message.as_string().  The default
     is a textual representation of the message where the headers are
@@ -570,16 +587,8 @@ def msg_as_string(msg, maxheaderlen=False, mangle_from_=False, unixfrom=False):
     return fp.getvalue()
 
 
-def sendmail(msgstr, envrecip, envsender):
-    """Send e-mail via direct SMTP, or by opening a pipe to the
-    sendmail program.
-
-    msgstr is an rfc2822 message as a string.
-
-    envrecip is the envelope recipient address.
-
-    envsender is the envelope sender address.
-    """
+def _envelope_sender(envsender):
+    """Return envsender in the form expected by the mail transport."""
     import Defaults
     # Sending mail with a null envelope sender address <> is not done
     # the same way across the different supported MTAs, nor across the
@@ -601,24 +610,116 @@ def sendmail(msgstr, envrecip, envsender):
            Defaults.MAIL_TRANSFER_AGENT in ('postfix', 'qmail') and \
            Defaults.MAIL_TRANSPORT == 'sendmail':
         envsender = ''
+    return envsender
+
+
+def _sendmail_command(envrecip, envsender):
+    """Return the SENDMAIL_PROGRAM command line for one message."""
+    import Defaults
+    # You can avoid the shell by passing a tuple of arguments as
+    # the command instead of a string.  This will cause the
+    # subprocess.Popen() code to execvp() "/usr/bin/sendmail" with
+    # these arguments exactly, with no trip through any shell.
+    return (Defaults.SENDMAIL_PROGRAM, '-i', '-f', envsender, '--', envrecip)
+
+
+def sendmail(msgstr, envrecip, envsender):
+    """Send e-mail via direct SMTP, or by opening a pipe to the
+    sendmail program.
+
+    msgstr is an rfc2822 message as a string.
+
+    envrecip is the envelope recipient address.
+
+    envsender is the envelope sender address.
+    """
+    import Defaults
+    envsender = _envelope_sender(envsender)
     if Defaults.MAIL_TRANSPORT == 'sendmail':
-        # You can avoid the shell by passing a tuple of arguments as
-        # the command instead of a string.  This will cause the
-        # subprocess.Popen() code to execvp() "/usr/bin/sendmail" with
-        # these arguments exactly, with no trip through any shell.
-        cmd = (Defaults.SENDMAIL_PROGRAM, '-i',
-               '-f', envsender, '--', envrecip)
-        runcmd_checked(cmd, msgstr)
+        runcmd_checked(_sendmail_command(envrecip, envsender), msgstr)
     elif Defaults.MAIL_TRANSPORT == 'smtp':
         import SMTP
-        server = SMTP.Connection()
-        server.sendmail(envsender, envrecip, msgstr)
-        server.quit()
+        SMTP.pool.sendmail(envsender, envrecip, msgstr)
     else:
         raise Errors.ConfigError, \
               "Invalid MAIL_TRANSPORT method: " + Defaults.MAIL_TRANSPORT
 
 
+class SendmailBatch:
+    """Send a series of messages like sendmail(), without waiting for
+    each one in turn.
+
+    With the sendmail transport up to `workers' SENDMAIL_PROGRAM
+    processes run at once.  With the SMTP transport the messages go
+    out one after another over the pooled connection.  A failure only
+    affects its own message; finish() returns the failures as a list
+    of (tag, error) tuples, in submission order.
+    """
+    def __init__(self, workers=None):
+        import Defaults
+        if workers is None:
+            workers = Defaults.PENDING_RELEASE_WORKERS
+        self.workers = max(1, int(workers))
+        self.running = []
+        self.failures = []
+        self.submitted = 0
+
+    def submit(self, msgstr, envrecip, envsender, tag=None):
+        """Queue msgstr for delivery; tag identifies it in failures."""
+        import Defaults
+        seq = self.submitted
+        self.submitted += 1
+        envsender = _envelope_sender(envsender)
+        if Defaults.MAIL_TRANSPORT != 'sendmail':
+            try:
+                sendmail(msgstr, envrecip, envsender)
+            except (Errors.ConfigError, KeyboardInterrupt):
+                raise
+            except Exception, e:
+                self.failures.append((seq, tag, e))
+            return
+        while len(self.running) >= self.workers:
+            self.__reap()
+        import subprocess
+        cmd = _sendmail_command(envrecip, envsender)
+        try:
+            process = subprocess.Popen(cmd, stdin=PIPE)
+        except OSError, e:
+            self.failures.append((seq, tag, e))
+            return
+        try:
+            process.stdin.write(msgstr)
+            process.stdin.close()
+        except IOError, e:
+            # sendmail exited without reading the whole message.
+            process.wait()
+            self.failures.append((seq, tag, e))
+            return
+        self.running.append((seq, tag, cmd, process))
+
+    def __reap(self):
+        """Wait for the oldest sendmail process and record its status."""
+        (seq, tag, cmd, process) = self.running.pop(0)
+        r = process.wait()
+        if r > 0:
+            self.failures.append(
+                (seq, tag, StandardError('command %r exited with error %d'
+                                         % (cmd, r))))
+        elif r < 0:
+            self.failures.append(
+                (seq, tag, StandardError('command %r exited with signal %d'
+                                         % (cmd, -r))))
+
+    def finish(self):
+        """Wait for all submitted messages and return the failures."""
+        while self.running:
+            self.__reap()
+        self.failures.sort()
+        failures = [(tag, e) for (seq, tag, e) in self.failures]
+        self.failures = []
+        return failures
+
+
 def decode_header(str):
     """Accept a possibly encoded message header as a string, and
     return a decoded string if it can be decoded.
@@ -672,6 +773,55 @@ def body_as_raw_string(msg):
     return msgtext[idx+2:]
 
 
+class RawMessage:
+    """A message read once from a string, keeping the original text.
+
+    Only the header block is parsed; the body is a single slice of the
+    text and becomes the payload of the Message object, msg.  The raw
+    headers, raw body and size are available without regenerating the
+    message through email.generator, and as_string() returns the
+    original text unless the headers or payload have been changed.
+    """
+    _blankline = re.compile(r'^\r?\n', re.MULTILINE)
+
+    def __init__(self, text):
+        self.text = text
+        mo = self._blankline.search(text)
+        if mo:
+            (hdrend, bodystart) = mo.span()
+        else:
+            hdrend = bodystart = len(text)
+        msg = msg_from_file(StringIO(text[:hdrend]))
+        if msg.get_payload():
+            # Something in the header block isn't a header, so let the
+            # parser decide where the body starts.
+            msg = msg_from_file(StringIO(text))
+            hdrend = len(text) - len(msg.get_payload())
+        else:
+            msg.set_payload(text[bodystart:])
+        # A leading From_ line is not part of the headers.
+        if msg.get_unixfrom() is not None:
+            self.start = text.find('\n') + 1
+        else:
+            self.start = 0
+        self.msg = msg
+        self.headers = text[self.start:hdrend]
+        self.body = msg.get_payload()
+        self.size = len(text) - self.start
+        self.__items = msg.items()
+
+    def modified(self):
+        """Return true if the headers or payload of msg have changed."""
+        return (self.msg.items() != self.__items
+                or self.msg.get_payload() is not self.body)
+
+    def as_string(self):
+        """Return the message as a string, without a From_ line."""
+        if self.modified():
+            return msg_as_string(self.msg)
+        return self.text[self.start:]
+
+
 
 def rename_headers(msg, old, new):
     """Rename all occurances of a message header in a Message object.
@@ -719,6 +869,7 @@ def purge_headers(msg, headers):
 def build_cdb(filename):
     """Build a cdb file from a text file."""
     import cdb
+    import tempfile
     try:
         cdbname = filename + '.cdb'
         tempfile.tempdir = os.path.dirname(filename)
@@ -743,6 +894,7 @@ def build_dbm(filename):
     """Build a DBM file from a text file."""
     import anydbm
     import glob
+    import tempfile
     try:
         dbmpath, dbmname = os.path.split(filename)
         dbmname += '.db'
@@ -787,9 +939,10 @@ def pickleit(object, file, proto=2):
 
     default is 2, since we must support Python 2.3 and above.
     """
-    tempfile.tempdir = os.path.dirname(file)
-    tmpname = tempfile.mkstemp()[1]
-    fp = open(tmpname, 'w')
+    import cPickle
+    import tempfile
+    (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(file))
+    fp = os.fdopen(fd, 'w')
     cPickle.dump(object, fp, proto)
     fp.close()
     os.rename(tmpname, file)
@@ -798,6 +951,7 @@ def pickleit(object, file, proto=2):
 
 def unpickle(file):
     """Retrieve and return object from file."""
+    import cPickle
     fp = open(file, 'r')
     object = cPickle.load(fp)
     fp.close()
@@ -806,48 +960,143 @@ def unpickle(file):
 
 def db_insert(db, insert_sql, params):
     """Insert (using the 'insert_sql' SQL) an address into a SQL DB."""
-    dbmodule = sys.modules[db.__module__]
-    DatabaseError = getattr(dbmodule, 'DatabaseError')
-    cursor = db.cursor()
-    try:
-        try:
-            cursor.execute(insert_sql, params)
-            db.commit()
-        except DatabaseError:
-            pass
-    finally:
-        cursor.close()
+    import SQL
+    SQL.insert(db, insert_sql, params)
 
 
 def findmatch(list, addrs):
     """Determine whether any of the passed e-mail addresses match a
     Unix shell-style wildcard pattern contained in list.  The
     comparison is case-insensitive.  Also, return the second half of
-    the string if it exists (for exp and ext addresses only)."""
+    the string if it exists (for exp and ext addresses only).
+
+    A list of more than one pattern is indexed with AddressMatcher;
+    a single pattern, as for a plain from or to rule, is simply
+    checked with fnmatch."""
+    if len(list) != 1:
+        return AddressMatcher(list).match(addrs)
+    parsed = _addresspattern(list[0])
+    if parsed is None:
+        return None
+    (patterns, value) = parsed
+    import fnmatch
     for address in addrs:
         if address:
             address = address.lower()
-            for p in list:
-                stringparts = p.split()
-                p = stringparts[0]
-                # Handle special @=domain.dom syntax.
-                try:
-                    at = p.rindex('@')
-                    atequals = p[at+1] == '='
-                except (ValueError, IndexError):
-                    atequals = None
-                if atequals:
-                    p1 = p[:at+1] + p[at+2:]
-                    p2 = p[:at+1] + '*.' + p[at+2:]
-                    match = (fnmatch.fnmatch(address,p1)
-                             or fnmatch.fnmatch(address,p2))
-                else:
-                    match = fnmatch.fnmatch(address,p)
-                if match:
-                    try:
-                        return stringparts[1]
-                    except IndexError:
-                        return 1
+            for pattern in patterns:
+                if fnmatch.fnmatch(address, pattern):
+                    return value
+
+
+def _addresspattern(entry):
+    """Split an entry of an address list into the fnmatch patterns it
+    stands for and its second column, or 1 if it has none.  Return
+    None for a blank entry."""
+    stringparts = entry.split()
+    if not stringparts:
+        return None
+    try:
+        value = stringparts[1]
+    except IndexError:
+        value = 1
+    p = stringparts[0]
+    # Handle special @=domain.dom syntax.
+    try:
+        at = p.rindex('@')
+        atequals = p[at+1] == '='
+    except (ValueError, IndexError):
+        atequals = None
+    if atequals:
+        return ((p[:at+1] + p[at+2:], p[:at+1] + '*.' + p[at+2:]), value)
+    return ((p,), value)
+
+
+class AddressMatcher:
+    """A prebuilt index of the patterns in an address list.
+
+    The list has the same form findmatch() accepts: one pattern per
+    entry, optionally followed by whitespace and a second column.
+    Plain addresses are hash lookups, patterns containing a single `*'
+    (e.g, *@domain.dom, or the user@*.domain.dom half of the special
+    @=domain.dom syntax) are looked up by prefix and suffix, and any
+    other wildcards are compiled into a few combined regular
+    expressions.  match() gives exactly the same result as checking
+    each pattern in turn with fnmatch, but is independent of the
+    length of the list.
+    """
+    # Python's re module is limited to 100 groups per expression.
+    _chunksize = 99
+
+    def __init__(self, list):
+        self.values = []
+        self.exact = {}
+        # (len(prefix), len(suffix)) -> {(prefix, suffix): index}
+        self.affixes = {}
+        self.wildcards = []
+        wildcards = []
+        for p in list:
+            parsed = _addresspattern(p)
+            if parsed is None:
+                continue
+            (patterns, value) = parsed
+            index = len(self.values)
+            self.values.append(value)
+            for pattern in patterns:
+                self.__add(pattern, index, wildcards)
+        for i in range(0, len(wildcards), self._chunksize):
+            chunk = wildcards[i:i+self._chunksize]
+            regex = '|'.join(['(%s)' % expr for (index, expr) in chunk])
+            self.wildcards.append((chunk[0][0],
+                                   re.compile(regex, re.MULTILINE | re.DOTALL),
+                                   [index for (index, expr) in chunk]))
+
+    def __add(self, pattern, index, wildcards):
+        """Index a single fnmatch pattern."""
+        if '?' in pattern or '[' in pattern or pattern.count('*') > 1:
+            import fnmatch
+            expr = fnmatch.translate(pattern)
+            # Strip the trailing flags; they are applied to the
+            # combined expression instead.
+            if expr.endswith('(?ms)'):
+                expr = expr[:-len('(?ms)')]
+            wildcards.append((index, expr))
+        elif '*' in pattern:
+            (prefix, suffix) = pattern.split('*')
+            affix = self.affixes.setdefault((len(prefix), len(suffix)), {})
+            affix.setdefault((prefix, suffix), index)
+        else:
+            self.exact.setdefault(pattern, index)
+
+    def __lookup(self, address):
+        """Return the index of the first pattern matching address."""
+        best = self.exact.get(address)
+        length = len(address)
+        for ((plen, slen), affix) in self.affixes.items():
+            if plen + slen > length:
+                continue
+            index = affix.get((address[:plen], address[length-slen:]))
+            if index is not None and (best is None or index < best):
+                best = index
+        for (first, regex, indexes) in self.wildcards:
+            if best is not None and first > best:
+                break
+            mo = regex.match(address)
+            if mo:
+                index = indexes[mo.lastindex - 1]
+                if best is None or index < best:
+                    best = index
+                break
+        return best
+
+    def match(self, addrs):
+        """Return the second column of the first pattern matching the
+        first matching address, 1 if that pattern has no second
+        column, or None if nothing matches."""
+        for address in addrs:
+            if address:
+                index = self.__lookup(address.lower())
+                if index is not None:
+                    return self.values[index]
 
 
 def wraptext(text, column=70):
@@ -22,7 +22,8 @@
 """Various versioning information."""
 
 
-import platform
+import os
+import sys
 
 
 # TMDA version = x.y.z.yyyymmdd.rel_for_day
@@ -33,10 +34,13 @@ TMDA = '1.1.13.20190604.0'
 CODENAME = 'Nikka-TMDAretro'
 
 # Python version
-PYTHON = platform.python_version()
+PYTHON = sys.version.split()[0]
 
-# Platform identifier
-PLATFORM = platform.platform()
+# Platform identifier, e.g, Linux-2.6.32-x86_64.  This is what
+# platform.platform() starts with, without the cost of importing
+# platform every time TMDA starts.
+(_sysname, _nodename, _release, _version, _machine) = os.uname()
+PLATFORM = '%s-%s-%s' % (_sysname, _release, _machine)
 
 # Summary of all the version identifiers
 # e.g, TMDA/1.1.0 "Aberfeldy" (Python/2.3.2 on Darwin-6.8-Power_Macintosh-powerpc-32bit)
@@ -86,6 +86,8 @@ This version/package results:
     scripts = [ 'bin/tmda-address',
                 'bin/tmda-check-address',
                 'bin/tmda-filter',
+                'bin/tmda-filter-client',
+                'bin/tmda-filterd',
                 'bin/tmda-inject',
                 'bin/tmda-keygen',
                 'bin/tmda-ofmipd',
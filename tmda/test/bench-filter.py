@@ -0,0 +1,65 @@
+'''
+Compare the time needed to parse a large filter with the time needed to
+load its compiled copy (FILTER_COMPILE).
+'''
+
+import os
+import shutil
+import tempfile
+import timeit
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import FilterParser
+
+rules = 3000
+includes = 10
+repeat = 20
+
+def makeFilters(tmpdir):
+    incoming = os.path.join(tmpdir, 'incoming')
+    f = open(incoming, 'w')
+    f.write('macro FRIEND(addr) from addr ok\n')
+    f.write('macro FOE(addr) from addr drop\n')
+    f.write('macro LIST(name) to ${USERNAME}-name@nowhere.com ok\n')
+    for i in range(includes):
+        included = os.path.join(tmpdir, 'included%d' % i)
+        f.write('include %s\n' % included)
+        inc = open(included, 'w')
+        for j in range(rules / includes):
+            if j % 3 == 0:
+                inc.write('FRIEND(friend%d.%d@example.com)\n' % (i, j))
+            elif j % 3 == 1:
+                inc.write('FOE(*@spammer%d-%d.com)\n' % (i, j))
+            else:
+                inc.write('LIST(list%d%d)\n' % (i, j))
+        inc.close()
+    f.close()
+    return incoming
+
+def read(filename):
+    FilterParser.FilterParser().read(filename)
+
+def main():
+    tmpdir = tempfile.mkdtemp(prefix='bench-filter.')
+    try:
+        incoming = makeFilters(tmpdir)
+
+        Defaults.FILTER_COMPILE = False
+        parse = timeit.Timer(lambda: read(incoming)).timeit(repeat) / repeat
+
+        Defaults.FILTER_COMPILE = True
+        read(incoming)
+        load = timeit.Timer(lambda: read(incoming)).timeit(repeat) / repeat
+
+        print '%d rules in %d included files' % (rules, includes)
+        print 'parse: %8.2f ms' % (parse * 1000)
+        print 'load:  %8.2f ms' % (load * 1000)
+        print 'speedup: %.1fx' % (parse / load)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+Compare a linear scan of a large address list with a lookup in a prebuilt
+Util.AddressMatcher.
+'''
+
+import fnmatch
+import timeit
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Util
+
+entries = 50000
+repeat = 200
+
+def linear_findmatch(list, addrs):
+    '''The original, linear findmatch.'''
+    for address in addrs:
+        if address:
+            address = address.lower()
+            for p in list:
+                stringparts = p.split()
+                p = stringparts[0]
+                try:
+                    at = p.rindex('@')
+                    atequals = p[at+1] == '='
+                except (ValueError, IndexError):
+                    atequals = None
+                if atequals:
+                    p1 = p[:at+1] + p[at+2:]
+                    p2 = p[:at+1] + '*.' + p[at+2:]
+                    match = (fnmatch.fnmatch(address,p1)
+                             or fnmatch.fnmatch(address,p2))
+                else:
+                    match = fnmatch.fnmatch(address,p)
+                if match:
+                    try:
+                        return stringparts[1]
+                    except IndexError:
+                        return 1
+
+def makeList():
+    addrlist = []
+    for i in range(entries):
+        if i % 10 == 0:
+            addrlist.append('*@domain%d.com' % i)
+        elif i % 10 == 1:
+            addrlist.append('*@=domain%d.org ok' % i)
+        elif i % 100 == 2:
+            addrlist.append('user%d?@*.example.net' % i)
+        else:
+            addrlist.append('user%d@example.com' % i)
+    return addrlist
+
+def main():
+    addrlist = makeList()
+    # A miss is the worst case for the linear scan.
+    keys = ['nobody@nowhere.com', 'nowhere.com']
+
+    linear = timeit.Timer(lambda: linear_findmatch(addrlist, keys)).timeit(1)
+    build = timeit.Timer(lambda: Util.AddressMatcher(addrlist)).timeit(1)
+    matcher = Util.AddressMatcher(addrlist)
+    lookup = timeit.Timer(lambda: matcher.match(keys)).timeit(repeat) / repeat
+
+    print '%d entries, %d keys, no match' % (entries, len(keys))
+    print 'linear scan:    %10.2f ms' % (linear * 1000)
+    print 'matcher build:  %10.2f ms' % (build * 1000)
+    print 'matcher lookup: %10.2f us' % (lookup * 1000000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Compare the time a body-file rule takes to scan a large message body,
+with its patterns searched for together, against searching the body
+once per pattern as each one is read.
+'''
+
+import os
+import re
+import shutil
+import tempfile
+import timeit
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import FilterParser
+
+patterns = 300
+bodysize = 1024 * 1024
+repeat = 5
+
+def makeFilter(tmpdir):
+    words = os.path.join(tmpdir, 'spamwords')
+    f = open(words, 'w')
+    for i in range(patterns):
+        if i % 3 == 0:
+            f.write('spamword%d\n' % i)
+        elif i % 3 == 1:
+            f.write('"cheap (pills|meds)%d"\n' % i)
+        else:
+            f.write('"^X-Offer-%d: .*free"\n' % i)
+    f.close()
+    incoming = os.path.join(tmpdir, 'incoming')
+    f = open(incoming, 'w')
+    f.write('body-file %s drop\n' % words)
+    f.close()
+    return (incoming, words)
+
+def makeBody():
+    line = 'An ordinary line of text, with nothing in it to match.\n'
+    return line * (bodysize / len(line))
+
+def together(incoming, body):
+    parser = FilterParser.FilterParser()
+    parser.read(incoming)
+    return parser.firstmatch('nobody@nowhere.com', ['x@example.com'],
+                             body, 'Subject: hello\n')
+
+def perpattern(words, body):
+    for line in FilterParser.Util.file_to_list(words):
+        mo = FilterParser.FilterParser.matches.match(line)
+        expr = mo.group(2) or mo.group(3)
+        if re.search(expr, body, re.MULTILINE | re.IGNORECASE):
+            return True
+    return False
+
+def main():
+    tmpdir = tempfile.mkdtemp(prefix='bench-patterns.')
+    try:
+        (incoming, words) = makeFilter(tmpdir)
+        body = makeBody()
+
+        together(incoming, body)
+        new = timeit.Timer(lambda: together(incoming, body)).timeit(repeat)
+        old = timeit.Timer(lambda: perpattern(words, body)).timeit(repeat)
+
+        print '%d patterns, %d KB body' % (patterns, len(body) / 1024)
+        print 'per pattern: %8.1f ms' % (old / repeat * 1000)
+        print 'together:    %8.1f ms' % (new / repeat * 1000)
+        print 'speedup: %.1fx' % (old / new)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''
+Measure the cold-start cost of a delivery through tmda-rfilter: the
+time spent importing each module on the way to a decision, and the
+wall-clock time of whole tmda-rfilter runs for a message that is
+simply accepted by the incoming filter.
+
+Usage: bench-startup.py [runs]
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import lib.util
+lib.util.testPrep()
+
+runs = 20
+top = 15
+
+# Run in a fresh interpreter, with the hook installed before anything
+# from TMDA is imported.  It prints one line per module: the module
+# name, the time spent importing it including the modules it imported
+# in turn, and the time excluding them.
+importtime = r'''
+import sys, time
+import __builtin__
+_import = __builtin__.__import__
+stack = []
+times = {}
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    before = set(sys.modules)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        # Charge the time to the module asked for, if it was new.
+        new = set(sys.modules) - before
+        wanted = [name]
+        if fromlist:
+            wanted = [name + '.' + attr for attr in fromlist] + wanted
+        for module in wanted:
+            found = [m for m in new if sys.modules[m] is not None and
+                     (m == module or m.endswith('.' + module))]
+            if found:
+                times[found[0]] = (elapsed, elapsed - nested)
+                break
+__builtin__.__import__ = timed_import
+sys.argv = ['tmda-rfilter']
+execfile(%r, {'__name__': 'rfilter'})
+__builtin__.__import__ = _import
+for (module, (cumulative, own)) in times.items():
+    print module, cumulative, own
+'''
+
+def rfilterPath():
+    return os.path.abspath(os.path.join(lib.util.rootDir, 'bin',
+                                        'tmda-rfilter'))
+
+def environment(tmpdir):
+    env = dict(os.environ)
+    env['HOME'] = os.path.abspath(lib.util.userDir)
+    env['PYTHONPATH'] = os.path.abspath(lib.util.rootDir)
+    env['SENDER'] = 'friend@example.com'
+    env['RECIPIENT'] = 'testuser@nowhere.com'
+    env['EXT'] = ''
+    env['TMDA_FILTER_INCOMING'] = os.path.join(tmpdir, 'incoming')
+    return env
+
+def measureImports(env, message):
+    '''Import tmda-rfilter's modules, without running main().'''
+    p = subprocess.Popen([sys.executable, '-c', importtime % rfilterPath()],
+                         env=env, stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE)
+    out = p.communicate(message)[0]
+    times = []
+    for line in out.splitlines():
+        (module, cumulative, own) = line.split()
+        times.append((float(cumulative), float(own), module))
+    times.sort()
+    times.reverse()
+    return times
+
+def measureRuns(env, message):
+    '''Return the mean wall-clock time of a tmda-rfilter run.'''
+    start = time.time()
+    for i in range(runs):
+        p = subprocess.Popen([sys.executable, rfilterPath(), '-I',
+                              env['TMDA_FILTER_INCOMING']], env=env,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        p.communicate(message)
+        if p.returncode != 0:
+            raise RuntimeError('tmda-rfilter exited with %d' % p.returncode)
+    return (time.time() - start) / runs
+
+def main():
+    global runs
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+    tmpdir = tempfile.mkdtemp(prefix='bench-startup.')
+    try:
+        f = open(os.path.join(tmpdir, 'incoming'), 'w')
+        f.write('from friend@example.com ok\n')
+        f.close()
+        env = environment(tmpdir)
+        message = ('From: friend@example.com\n'
+                   'To: testuser@nowhere.com\n'
+                   'Subject: hello\n\nbody\n')
+
+        times = measureImports(env, message)
+        total = sum([own for (cumulative, own, module) in times])
+        print '%d modules imported, %.1f ms' % (len(times), total * 1000)
+        print '%10s %10s  module' % ('cumul. ms', 'self ms')
+        for (cumulative, own, module) in times[:top]:
+            print '%10.2f %10.2f  %s' % (cumulative * 1000, own * 1000,
+                                         module)
+        print
+
+        elapsed = measureRuns(env, message)
+        print 'tmda-rfilter, accepted message: %.1f ms per run (%d runs)' \
+              % (elapsed * 1000, runs)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import AutoResponse
+from TMDA import Defaults
+
+class ResponseRecordTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-autoresponse.')
+        self.response_dir = Defaults.RESPONSE_DIR
+        Defaults.RESPONSE_DIR = os.path.join(self.tmpdir, 'responses')
+
+    def tearDown(self):
+        Defaults.RESPONSE_DIR = self.response_dir
+        shutil.rmtree(self.tmpdir)
+
+    def writeResponses(self, name, ages):
+        now = int(time.time())
+        f = open(os.path.join(Defaults.RESPONSE_DIR, name), 'w')
+        for age in ages:
+            f.write('%d\n' % (now - age))
+        f.close()
+
+    def testCount(self):
+        self.assertEqual(AutoResponse.responses_sent('x@example.com'), 0)
+        AutoResponse.record_response('x@example.com')
+        AutoResponse.record_response('X@Example.com')
+        AutoResponse.record_response('y@example.com')
+        self.assertEqual(AutoResponse.responses_sent('x@example.com'), 2)
+        self.assertEqual(AutoResponse.responses_sent('y@example.com'), 1)
+
+    def testOldResponsesForgotten(self):
+        AutoResponse.record_response('x@example.com')
+        day = 24 * 60 * 60
+        self.writeResponses('x@example.com', [day + 60, day + 1, 60])
+        self.assertEqual(AutoResponse.responses_sent('x@example.com'), 1)
+
+        AutoResponse.record_response('x@example.com')
+        self.assertEqual(AutoResponse.responses_sent('x@example.com'), 2)
+        f = open(os.path.join(Defaults.RESPONSE_DIR, 'x@example.com'))
+        self.assertEqual(len(f.readlines()), 2)
+        f.close()
+
+    def testExpireSenders(self):
+        AutoResponse.record_response('x@example.com')
+        self.writeResponses('old@example.com', [2 * 24 * 60 * 60])
+        # A file in the format used by earlier versions.
+        self.writeResponses('1000000000.1234.legacy@example.com', [])
+        earlier = time.time() - 2 * 24 * 60 * 60
+        for name in ('old@example.com', '1000000000.1234.legacy@example.com',
+                     '.expired'):
+            os.utime(os.path.join(Defaults.RESPONSE_DIR, name),
+                     (earlier, earlier))
+
+        AutoResponse.record_response('y@example.com')
+        self.assertEqual(sorted(os.listdir(Defaults.RESPONSE_DIR)),
+                         ['.expired', 'x@example.com', 'y@example.com'])
+
+    def testOddSenders(self):
+        for sender in ('', '.', '..', '.expired'):
+            AutoResponse.record_response(sender)
+            self.assertEqual(AutoResponse.responses_sent(sender), 1)
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
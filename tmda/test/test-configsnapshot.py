@@ -0,0 +1,111 @@
+import unittest
+import marshal
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import lib.util
+lib.util.testPrep()
+
+class ConfigSnapshotTests(unittest.TestCase):
+    '''
+    Each test imports TMDA.Defaults in fresh processes, using a config
+    file which records every time it is read.
+    '''
+
+    config = '''
+open(%(runs)r, 'a').write('x')
+CRYPT_KEY_FILE = %(key)r
+USERNAME = 'testuser'
+HOSTNAME = 'nowhere.com'
+CONFIG_SNAPSHOT = %(snapshot)s
+'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-configsnapshot.')
+        self.tmdarc = os.path.join(self.tmpdir, 'config')
+        self.snapshot = self.tmdarc + '.snapshot'
+        self.runs = os.path.join(self.tmpdir, 'runs')
+        self.key = os.path.join(self.tmpdir, 'crypt_key')
+        shutil.copy(os.path.join(lib.util.userDir, '.tmda', 'crypt_key'),
+                    self.key)
+        os.chmod(self.key, 0600)
+        self.writeConfig(True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeConfig(self, snapshot):
+        f = open(self.tmdarc, 'w')
+        f.write(self.config % {'runs': self.runs, 'key': self.key,
+                               'snapshot': snapshot})
+        f.close()
+
+    def importDefaults(self, **environ):
+        env = dict(os.environ)
+        env['TMDARC'] = self.tmdarc
+        env['PYTHONPATH'] = lib.util.rootDir
+        env.update(environ)
+        code = ('from TMDA import Defaults; '
+                'print Defaults._snapshot is not None, '
+                'Defaults.HOSTNAME, Defaults.CRYPT_KEY.encode("hex")')
+        p = subprocess.Popen([sys.executable, '-c', code], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = p.communicate()
+        self.assertEqual(p.returncode, 0, err)
+        (loaded, hostname, key) = out.split()
+        self.assertEqual(hostname, 'nowhere.com')
+        self.assertEqual(key, open(self.key).read().strip())
+        return loaded == 'True'
+
+    def configRuns(self):
+        return len(open(self.runs).read())
+
+    def testReuse(self):
+        self.assertFalse(self.importDefaults())
+        self.assertEqual(os.stat(self.snapshot).st_mode & 0777, 0600)
+        variables = marshal.load(open(self.snapshot, 'rb'))[2]
+        self.assertFalse('progpath' in variables)
+        self.assertFalse('PID' in variables)
+        self.assertTrue(self.importDefaults())
+        self.assertTrue(self.importDefaults())
+        self.assertEqual(self.configRuns(), 1)
+
+    def testConfigChanged(self):
+        self.importDefaults()
+        later = os.stat(self.tmdarc).st_mtime + 10
+        os.utime(self.tmdarc, (later, later))
+        self.assertFalse(self.importDefaults())
+        self.assertTrue(self.importDefaults())
+        self.assertEqual(self.configRuns(), 2)
+
+    def testEnvironmentChanged(self):
+        self.importDefaults()
+        self.assertFalse(self.importDefaults(TMDA_FILTER_INCOMING='x'))
+        self.assertEqual(self.configRuns(), 2)
+
+    def testKeyModeChecked(self):
+        self.importDefaults()
+        os.chmod(self.key, 0644)
+        env = dict(os.environ, TMDARC=self.tmdarc,
+                   PYTHONPATH=lib.util.rootDir)
+        p = subprocess.Popen([sys.executable, '-c', 'from TMDA import Defaults'],
+                             env=env, stderr=subprocess.PIPE)
+        err = p.communicate()[1]
+        self.assertNotEqual(p.returncode, 0)
+        self.assertTrue('must be chmod 400 or 600' in err)
+
+    def testDisabled(self):
+        self.importDefaults()
+        self.writeConfig(False)
+        self.assertFalse(self.importDefaults())
+        self.assertFalse(os.path.exists(self.snapshot))
+        self.assertFalse(self.importDefaults())
+        self.assertEqual(self.configRuns(), 3)
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
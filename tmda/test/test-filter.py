@@ -0,0 +1,579 @@
+import unittest
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import FilterParser
+
+class FilterTestMixin(object):
+    '''
+    Provides a scratch directory for filter files.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-filter.')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeFile(self, name, lines):
+        path = os.path.join(self.tmpdir, name)
+        f = open(path, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        return path
+
+    def touchLater(self, path):
+        # Make sure a rewrite is detected even on coarse mtime filesystems.
+        later = os.stat(path).st_mtime + 10
+        os.utime(path, (later, later))
+
+class CompiledFilterTests(FilterTestMixin, unittest.TestCase):
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        Defaults.FILTER_COMPILE = True
+
+    def tearDown(self):
+        Defaults.FILTER_COMPILE = False
+        FilterTestMixin.tearDown(self)
+
+    def makeFilter(self):
+        self.include = self.writeFile('included', [
+            'macro FRIEND(addr) from addr ok',
+            'FRIEND(friend@example.com)',
+        ])
+        return self.writeFile('incoming', [
+            '# A comment',
+            'include %s' % self.include,
+            'include -optional %s' % os.path.join(self.tmpdir, 'missing'),
+            'to ${USERNAME}@nowhere.com hold',
+            'FRIEND(pal@example.com)',
+            'from *@spam.com drop',
+        ])
+
+    def parse(self, filename):
+        parser = FilterParser.FilterParser()
+        parser.read(filename)
+        return parser
+
+    def testCompiledFile(self):
+        filename = self.makeFilter()
+        parsed = self.parse(filename)
+        self.assertTrue(os.path.exists(filename + '.compiled'))
+
+        loaded = self.parse(filename)
+        self.assertEqual(loaded.filterlist, parsed.filterlist)
+        self.assertEqual(len(loaded.filterlist), 4)
+
+        (actions, line) = loaded.firstmatch('other@nowhere.com',
+                                            ['pal@example.com'])
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+
+    def testNotParsedWhenCompiled(self):
+        filename = self.makeFilter()
+        self.parse(filename)
+
+        # The stored filter list is used as-is, so tampering with it shows
+        # that the source was not reparsed.
+        compiled = FilterParser.Util.unpickle(filename + '.compiled')
+        compiled['filterlist'] = compiled['filterlist'][:1]
+        FilterParser.Util.pickleit(compiled, filename + '.compiled')
+        self.assertEqual(len(self.parse(filename).filterlist), 1)
+
+    def testRebuildOnChange(self):
+        filename = self.makeFilter()
+        self.parse(filename)
+
+        self.writeFile('incoming', ['from *@spam.com drop'])
+        self.touchLater(filename)
+        self.assertEqual(len(self.parse(filename).filterlist), 1)
+
+    def testRebuildOnIncludeChange(self):
+        filename = self.makeFilter()
+        self.parse(filename)
+
+        self.writeFile('included', [
+            'macro FRIEND(addr) from addr ok',
+            'from a@b.c drop',
+            'from d@e.f drop',
+        ])
+        self.touchLater(self.include)
+        self.assertEqual(len(self.parse(filename).filterlist), 5)
+
+    def testRebuildOnOptionalInclude(self):
+        filename = self.makeFilter()
+        self.parse(filename)
+
+        self.writeFile('missing', ['from a@b.c drop'])
+        self.assertEqual(len(self.parse(filename).filterlist), 5)
+
+    def testRebuildOnVariableChange(self):
+        filename = self.makeFilter()
+        self.parse(filename)
+
+        saved = Defaults.USERNAME
+        try:
+            Defaults.USERNAME = 'someoneelse'
+            parser = self.parse(filename)
+            self.assertEqual(parser.filterlist[1][2], 'someoneelse@nowhere.com')
+        finally:
+            Defaults.USERNAME = saved
+
+    def testCorruptCompiledFile(self):
+        filename = self.makeFilter()
+        self.writeFile('incoming.compiled', ['garbage'])
+        self.assertEqual(len(self.parse(filename).filterlist), 4)
+
+    def testDisabled(self):
+        Defaults.FILTER_COMPILE = False
+        filename = self.makeFilter()
+        self.parse(filename)
+        self.assertFalse(os.path.exists(filename + '.compiled'))
+
+class ListCacheTests(FilterTestMixin, unittest.TestCase):
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        self.reads = []
+        self.file_to_list = FilterParser.Util.file_to_list
+        def file_to_list(pathname):
+            self.reads.append(pathname)
+            return self.file_to_list(pathname)
+        FilterParser.Util.file_to_list = file_to_list
+
+    def tearDown(self):
+        FilterParser.Util.file_to_list = self.file_to_list
+        FilterTestMixin.tearDown(self)
+
+    def makeFilter(self):
+        self.whitelist = self.writeFile('whitelist', [
+            'Friend@Example.COM',
+            '*@Trusted.com',
+            'pal@example.com drop',
+        ])
+        return self.writeFile('incoming', [
+            'from-file %s ok' % self.whitelist,
+            'to-file %s hold' % self.whitelist,
+            'from-file %s bounce' % self.whitelist,
+        ])
+
+    def firstmatch(self, filename, sender):
+        parser = FilterParser.FilterParser()
+        parser.read(filename)
+        return parser.firstmatch('nobody@nowhere.com', [sender])[0]
+
+    def testReadOnce(self):
+        filename = self.makeFilter()
+        self.assertEqual(self.firstmatch(filename, 'x@elsewhere.com'), {})
+        self.assertEqual(self.firstmatch(filename, 'friend@example.com'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(self.firstmatch(filename, 'x@trusted.com'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(self.firstmatch(filename, 'pal@example.com'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.reads, [self.whitelist])
+
+    def testRereadOnChange(self):
+        filename = self.makeFilter()
+        self.assertEqual(self.firstmatch(filename, 'new@example.com'), {})
+
+        self.writeFile('whitelist', ['New@example.com'])
+        self.touchLater(self.whitelist)
+        self.assertEqual(self.firstmatch(filename, 'new@example.com'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(self.reads, [self.whitelist, self.whitelist])
+
+    def testMissingFile(self):
+        filename = self.writeFile('incoming', [
+            'from-file -optional %s ok' % os.path.join(self.tmpdir, 'missing'),
+            'from-file %s ok' % os.path.join(self.tmpdir, 'missing'),
+        ])
+        self.assertRaises(IOError, self.firstmatch,
+                          filename, 'x@example.com')
+
+class PatternFileTests(FilterTestMixin, unittest.TestCase):
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        self.reads = []
+        self.file_to_list = FilterParser.Util.file_to_list
+        def file_to_list(pathname):
+            self.reads.append(pathname)
+            return self.file_to_list(pathname)
+        FilterParser.Util.file_to_list = file_to_list
+
+    def tearDown(self):
+        FilterParser.Util.file_to_list = self.file_to_list
+        FilterTestMixin.tearDown(self)
+
+    def makeFilter(self, patterns):
+        self.patterns = self.writeFile('patterns', patterns)
+        return self.writeFile('incoming', [
+            'body-file %s drop' % self.patterns,
+            'headers-file -case %s hold' % self.patterns,
+            'body "^Subject: (cheap|free) (\\w+)" bounce',
+        ])
+
+    def firstmatch(self, filename, body, headers='X-Nothing: here'):
+        parser = FilterParser.FilterParser()
+        parser.read(filename)
+        return parser.firstmatch('nobody@nowhere.com', ['x@example.com'],
+                                 body, headers)[0]
+
+    def testMerged(self):
+        filename = self.makeFilter(['viagra', '"cheap (meds|pills)"',
+                                    '"(\\w+) \\1 again"', 'Rolex'])
+        self.assertEqual(self.firstmatch(filename, 'Nothing to see.'), {})
+        self.assertEqual(self.firstmatch(filename, 'Buy VIAGRA now'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(filename, 'cheap meds'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(filename, 'now now again'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(filename, 'now then again'), {})
+        # Case matters for the headers-file rule.
+        self.assertEqual(self.firstmatch(filename, 'x', 'X-Spam: rolex'), {})
+        self.assertEqual(self.firstmatch(filename, 'x', 'X-Spam: Rolex'),
+                         {'incoming': ('hold', None)})
+        self.assertEqual(self.firstmatch(filename, 'Subject: free stuff'),
+                         {'incoming': ('bounce', None)})
+        # Once for each rule's flags.
+        self.assertEqual(self.reads, [self.patterns, self.patterns])
+
+    def testOverlappingLiterals(self):
+        filename = self.makeFilter(['"abcde\\d"', 'cdefg',
+                                    '"spamword\\d"', 'spam'])
+        # cdefg starts inside abcde, whose pattern doesn't match.
+        self.assertEqual(self.firstmatch(filename, 'xabcdefgx'),
+                         {'incoming': ('drop', None)})
+        # spam is a prefix of spamword.
+        self.assertEqual(self.firstmatch(filename, 'spamwordz'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(filename, 'abcdex spa'), {})
+
+    def testManyGroups(self):
+        # More groups than one expression can hold.
+        patterns = ['"(word%d) (\\w+)"' % i for i in range(200)]
+        filename = self.makeFilter(patterns)
+        self.assertEqual(self.firstmatch(filename, 'a word150 here'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(filename, 'word200 x'), {})
+
+    def testRereadOnChange(self):
+        filename = self.makeFilter(['viagra'])
+        self.assertEqual(self.firstmatch(filename, 'casino'), {})
+
+        self.writeFile('patterns', ['viagra', 'casino'])
+        self.touchLater(self.patterns)
+        self.assertEqual(self.firstmatch(filename, 'casino'),
+                         {'incoming': ('drop', None)})
+
+    def testBadPattern(self):
+        filename = self.makeFilter(['viagra', 'bad(pattern'])
+        self.assertRaises(FilterParser.re.error, self.firstmatch,
+                          filename, 'text')
+        # As before, a pattern ahead of the bad one can still match.
+        self.assertEqual(self.firstmatch(filename, 'viagra'),
+                         {'incoming': ('drop', None)})
+
+    def testRegexCacheBounded(self):
+        for i in range(FilterParser._maxregexes + 10):
+            FilterParser._regex('word%d' % i, 0)
+        self.assertTrue(len(FilterParser._regexcache)
+                        <= FilterParser._maxregexes)
+
+class BodyScanTests(FilterTestMixin, unittest.TestCase):
+    headers = ('MIME-Version: 1.0\n'
+               'Content-Type: multipart/mixed; boundary="XX"\n')
+    body = ('--XX\n'
+            'Content-Type: text/plain\n'
+            'Content-Transfer-Encoding: base64\n'
+            '\n'
+            'Q2hlYXAgcGlsbHMgaGVyZQ==\n'
+            '--XX\n'
+            'Content-Type: application/octet-stream\n'
+            '\n'
+            'attachment jackpot\n'
+            '--XX--\n')
+
+    def tearDown(self):
+        Defaults.FILTER_BODY_MAXBYTES = None
+        Defaults.FILTER_BODY_TEXT = False
+        FilterTestMixin.tearDown(self)
+
+    def firstmatch(self, rules, body=None, headers=None):
+        parser = FilterParser.FilterParser()
+        parser.read(self.writeFile('incoming', rules))
+        return parser.firstmatch('nobody@nowhere.com', ['x@example.com'],
+                                 body or self.body, headers or self.headers)[0]
+
+    def testMaxBytes(self):
+        body = 'x' * 100 + 'spam'
+        self.assertEqual(self.firstmatch(['body -maxbytes=100 spam drop'],
+                                         body), {})
+        self.assertEqual(self.firstmatch(['body -maxbytes=104 spam drop'],
+                                         body), {'incoming': ('drop', None)})
+        Defaults.FILTER_BODY_MAXBYTES = 100
+        self.assertEqual(self.firstmatch(['body spam drop'], body), {})
+        self.assertEqual(self.firstmatch(['body -maxbytes=0 spam drop'],
+                                         body), {'incoming': ('drop', None)})
+
+    def testMaxBytesFile(self):
+        patterns = self.writeFile('patterns', ['spam'])
+        rules = ['body-file -maxbytes=100 %s drop' % patterns]
+        self.assertEqual(self.firstmatch(rules, 'x' * 100 + 'spam'), {})
+        self.assertEqual(self.firstmatch(rules, 'x' * 96 + 'spam'),
+                         {'incoming': ('drop', None)})
+
+    def testBadMaxBytes(self):
+        self.assertRaises(FilterParser.Error, self.firstmatch,
+                          ['body -maxbytes=lots spam drop'])
+
+    def testText(self):
+        # The encoded text part is searched and the attachment isn't.
+        self.assertEqual(self.firstmatch(['body "cheap pills" drop']), {})
+        self.assertEqual(self.firstmatch(['body -text "cheap pills" drop']),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(['body jackpot drop']),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(['body -text jackpot drop']), {})
+        # The window applies to the decoded text.
+        self.assertEqual(self.firstmatch(['body -text -maxbytes=5 pills drop']),
+                         {})
+        # Only the start of the raw body is parsed for it.
+        body = self.body.replace('attachment jackpot\n', 'x' * 100000)
+        parsed = []
+        textparts = FilterParser._textparts
+        FilterParser._textparts = (lambda headers, body:
+                                   parsed.append(len(body)) or
+                                   textparts(headers, body))
+        try:
+            self.assertEqual(self.firstmatch(['body -text -maxbytes=40'
+                                              ' "cheap pills" drop'], body),
+                             {'incoming': ('drop', None)})
+        finally:
+            FilterParser._textparts = textparts
+        self.assertEqual(parsed, [160])
+        Defaults.FILTER_BODY_TEXT = True
+        self.assertEqual(self.firstmatch(['body "cheap pills" drop']),
+                         {'incoming': ('drop', None)})
+
+    def testTextNotMime(self):
+        self.assertEqual(self.firstmatch(['body -text plain drop'],
+                                         'Just plain text.\n',
+                                         'Subject: hi\n'),
+                         {'incoming': ('drop', None)})
+
+class PersistentPipeTests(FilterTestMixin, unittest.TestCase):
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        self.pids = os.path.join(self.tmpdir, 'pids')
+        command = '%s %s %s' % (sys.executable,
+                                os.path.abspath('bin/classifier'), self.pids)
+        self.filename = self.writeFile('incoming', [
+            'pipe-headers -persistent "%s" hold' % command,
+            'pipe -persistent "%s" drop' % command,
+        ])
+        self.parser = FilterParser.FilterParser()
+        self.parser.read(self.filename)
+
+    def tearDown(self):
+        Defaults.FILTER_PIPE_TIMEOUT = 30
+        for coprocess in FilterParser._coprocesses.values():
+            coprocess.kill()
+        FilterTestMixin.tearDown(self)
+
+    def firstmatch(self, body, headers='Subject: hello\n'):
+        return self.parser.firstmatch('nobody@nowhere.com', ['x@example.com'],
+                                      body, headers)[0]
+
+    def classifiers(self):
+        return open(self.pids).read().split()
+
+    def testPersistent(self):
+        self.assertEqual(self.firstmatch('ham'), {})
+        self.assertEqual(self.firstmatch('spam'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch('ham', 'Subject: spam\n'),
+                         {'incoming': ('hold', None)})
+        pids = self.classifiers()
+        self.assertEqual(len(pids), 5)
+        self.assertEqual(len(set(pids)), 1)
+
+    def testRespawn(self):
+        self.assertEqual(self.firstmatch('ham'), {})
+        self.assertRaises(FilterParser.Error, self.firstmatch, 'die')
+        self.assertEqual(self.firstmatch('spam'),
+                         {'incoming': ('drop', None)})
+        # The first, which dies, the one it is retried with, which dies
+        # too, and the one started for the last message.
+        self.assertEqual(len(set(self.classifiers())), 3)
+
+    def testTimeout(self):
+        Defaults.FILTER_PIPE_TIMEOUT = 1
+        self.assertRaises(FilterParser.Error, self.firstmatch, 'hang')
+        self.assertEqual(self.firstmatch('spam'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(len(set(self.classifiers())), 2)
+
+    def testInterrupted(self):
+        # A forked process dies while the classifier is working on its
+        # message; the answer it leaves behind isn't taken for the next
+        # message's.
+        Defaults.FILTER_PIPE_TIMEOUT = 10
+        self.parser.preload()
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(1)
+            try:
+                self.firstmatch('hang')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        start = time.time()
+        self.assertEqual(self.firstmatch('spam'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch('ham'), {})
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(len(set(self.classifiers())), 2)
+
+    def testNotInherited(self):
+        # A command run by another rule doesn't keep the pipes open.
+        import fcntl
+        self.firstmatch('ham')
+        for coprocess in FilterParser._coprocesses.values():
+            for fd in (coprocess.stdin, coprocess.stdout):
+                self.assertTrue(fcntl.fcntl(fd, fcntl.F_GETFD) &
+                                fcntl.FD_CLOEXEC)
+
+    def testPreload(self):
+        self.parser.preload()
+        self.assertEqual(len(FilterParser._coprocesses), 1)
+        self.assertEqual(self.firstmatch('spam'),
+                         {'incoming': ('drop', None)})
+
+class SlowRuleTests(FilterTestMixin, unittest.TestCase):
+    # Given to firstmatch as FILTER_TIMEOUT_ACTION is by tmda-rfilter.
+    action = None
+
+    def tearDown(self):
+        Defaults.FILTER_TIMEOUT = None
+        Defaults.FILTER_RULE_TIMEOUT = None
+        Defaults.FILTER_PREFETCH = 0
+        FilterTestMixin.tearDown(self)
+
+    def parse(self, rules):
+        parser = FilterParser.FilterParser()
+        parser.read(self.writeFile('incoming', rules))
+        return parser
+
+    def firstmatch(self, parser):
+        return parser.firstmatch('nobody@nowhere.com', ['x@example.com'],
+                                 'body', 'Subject: hello\n', None,
+                                 self.action)
+
+    def timed(self, parser):
+        start = time.time()
+        actions = self.firstmatch(parser)[0]
+        return (actions, time.time() - start)
+
+    def slowdbm(self, parser, seconds):
+        # Make from-dbm lookups take their time, and match.
+        def search_dbm(pathname, keys, actions, source):
+            time.sleep(seconds)
+            return 1
+        parser._FilterParser__search_dbm = search_dbm
+
+    def testRuleTimeout(self):
+        parser = self.parse(['pipe -timeout=0.5 "sleep 10" drop',
+                             'from x@example.com ok'])
+        start = time.time()
+        self.assertRaises(FilterParser.Timeout, self.firstmatch, parser)
+        self.assertTrue(time.time() - start < 5)
+        self.action = 'hold'
+        (actions, line) = self.firstmatch(parser)
+        self.assertEqual(actions, {'incoming': ('hold', None)})
+        self.assertTrue(line.startswith('timeout ([line  1]: '))
+
+    def testDefaultRuleTimeout(self):
+        Defaults.FILTER_RULE_TIMEOUT = 0.5
+        self.action = 'hold'
+        parser = self.parse(['pipe "sleep 10" drop'])
+        (actions, elapsed) = self.timed(parser)
+        self.assertEqual(actions, {'incoming': ('hold', None)})
+        self.assertTrue(elapsed < 5)
+        # A quicker command is left alone.
+        parser = self.parse(['pipe "exit 0" drop'])
+        self.assertEqual(self.firstmatch(parser)[0],
+                         {'incoming': ('drop', None)})
+
+    def testDbmTimeout(self):
+        self.action = 'hold'
+        parser = self.parse(['from-dbm -timeout=0.5 /nonexistent drop'])
+        self.slowdbm(parser, 3)
+        (actions, elapsed) = self.timed(parser)
+        self.assertEqual(actions, {'incoming': ('hold', None)})
+        self.assertTrue(elapsed < 2)
+
+    def testFilterTimeout(self):
+        Defaults.FILTER_TIMEOUT = 1
+        self.action = 'confirm'
+        # Each rule is quick enough, but not all three together.
+        parser = self.parse(['pipe "sleep 0.6; exit 1" drop',
+                             'pipe "sleep 0.6; exit 1" drop',
+                             'pipe "sleep 0.6; exit 1" drop',
+                             'from x@example.com ok'])
+        (actions, elapsed) = self.timed(parser)
+        self.assertEqual(actions, {'incoming': ('confirm', None)})
+        self.assertTrue(elapsed < 1.5)
+
+    def testPrefetch(self):
+        rules = ['pipe "sleep 1; exit 1" drop'] * 3 + \
+                ['from x@example.com ok']
+        Defaults.FILTER_PREFETCH = 3
+        (actions, elapsed) = self.timed(self.parse(rules))
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+        self.assertTrue(elapsed < 2.5)
+
+    def testPrefetchFirstMatch(self):
+        Defaults.FILTER_PREFETCH = 4
+        # The second rule answers first, but the first one decides.
+        parser = self.parse(['pipe "sleep 0.5; exit 0" hold',
+                             'pipe "exit 0" drop',
+                             'from-dbm /nonexistent bounce'])
+        self.assertEqual(self.firstmatch(parser)[0],
+                         {'incoming': ('hold', None)})
+        # An error in a rule that wasn't reached doesn't count.
+        parser = self.parse(['pipe "exit 0" ok',
+                             'from-dbm /nonexistent bounce'])
+        self.assertEqual(self.firstmatch(parser)[0],
+                         {'incoming': ('ok', None)})
+        parser = self.parse(['pipe "exit 1" ok',
+                             'from-dbm /nonexistent bounce'])
+        self.assertRaises(FilterParser.MatchError, self.firstmatch, parser)
+
+    def testPrefetchTimeout(self):
+        Defaults.FILTER_PREFETCH = 2
+        Defaults.FILTER_RULE_TIMEOUT = 1
+        self.action = 'hold'
+        # The lookup started ahead has its time counted from its start.
+        parser = self.parse(['pipe "sleep 0.8; exit 1" drop',
+                             'from-dbm /nonexistent bounce'])
+        self.slowdbm(parser, 3)
+        (actions, elapsed) = self.timed(parser)
+        self.assertEqual(actions, {'incoming': ('hold', None)})
+        self.assertTrue(elapsed < 1.8)
+
+    def testBadTimeout(self):
+        self.assertRaises(FilterParser.Error, self.parse,
+                          ['pipe -timeout=soon "exit 0" drop'])
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
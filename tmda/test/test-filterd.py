@@ -0,0 +1,162 @@
+import unittest
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import lib.util
+lib.util.testPrep()
+
+class FilterDaemonTests(unittest.TestCase):
+    '''
+    Messages filtered through tmda-filterd by tmda-filter-client, run
+    with -p so that a delivered message is printed and a dropped one
+    exits with 99.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-filterd.')
+        self.home = os.path.join(self.tmpdir, 'home')
+        shutil.copytree(lib.util.userDir, self.home)
+        self.tmda = os.path.join(self.home, '.tmda')
+        self.filterfile = os.path.join(self.tmda, 'filters', 'incoming')
+        os.mkdir(os.path.dirname(self.filterfile))
+        self.writeFilter('from friend@example.com ok\n'
+                         'from foe@example.com drop\n')
+        self.config = open(os.path.join(self.tmda, 'config')).read()
+        self.writeConfig('')
+        self.socket = os.path.join(self.tmpdir, 'filterd.sock')
+        self.env = dict(os.environ)
+        self.env['HOME'] = self.home
+        self.env['PYTHONPATH'] = os.path.abspath(lib.util.rootDir)
+        self.env['RECIPIENT'] = 'testuser@nowhere.com'
+        self.env['EXT'] = ''
+        self.daemon = None
+
+    def tearDown(self):
+        if self.daemon:
+            self.daemon.terminate()
+            self.daemon.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def writeFilter(self, rules):
+        f = open(self.filterfile, 'w')
+        f.write(rules)
+        f.close()
+
+    def writeConfig(self, extra):
+        f = open(os.path.join(self.tmda, 'config'), 'w')
+        f.write(self.config)
+        f.write('FILTER_INCOMING = %r\n' % self.filterfile)
+        f.write('PENDING_CLEANUP_ODDS = 0\n')
+        f.write(extra)
+        f.close()
+
+    def program(self, name):
+        return os.path.abspath(os.path.join(lib.util.rootDir, 'bin', name))
+
+    def startDaemon(self):
+        log = open(os.path.join(self.tmpdir, 'filterd.log'), 'w')
+        self.daemon = subprocess.Popen([sys.executable,
+                                        self.program('tmda-filterd'),
+                                        '--socket', self.socket],
+                                       env=self.env, stderr=log)
+        for i in range(100):
+            if os.path.exists(self.socket):
+                return
+            time.sleep(0.1)
+        self.fail('tmda-filterd did not start')
+
+    def filter(self, sender, program='tmda-filter-client'):
+        message = 'From: %s\nSubject: test\n\nbody\n' % sender
+        args = [self.program(program)]
+        if program == 'tmda-filter-client':
+            args.append('--socket=' + self.socket)
+        env = dict(self.env, SENDER=sender)
+        p = subprocess.Popen([sys.executable] + args + ['-p'], env=env,
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+        out = p.communicate(message)[0]
+        return (p.returncode, out == message)
+
+    def testSameAsFilter(self):
+        self.startDaemon()
+        for sender in ('friend@example.com', 'foe@example.com',
+                       'other@example.com'):
+            self.assertEqual(self.filter(sender),
+                             self.filter(sender, 'tmda-filter'))
+        self.assertEqual(self.filter('friend@example.com'), (0, True))
+        self.assertEqual(self.filter('foe@example.com'), (99, False))
+
+    def testFilterChanged(self):
+        self.startDaemon()
+        self.assertEqual(self.filter('friend@example.com'), (0, True))
+        self.writeFilter('from friend@example.com drop\n')
+        self.assertEqual(self.filter('friend@example.com'), (99, False))
+
+    def testConfigChanged(self):
+        self.startDaemon()
+        self.assertEqual(self.filter('other@example.com'), (99, False))
+        self.writeConfig('ACTION_INCOMING = "ok"\n')
+        self.assertEqual(self.filter('other@example.com'), (0, True))
+        self.writeConfig('ACTION_INCOMING = "exit"\n')
+        self.assertEqual(self.filter('other@example.com'), (99, False))
+
+    def testConfigError(self):
+        self.startDaemon()
+        self.writeConfig('ACTION_INCOMING = \n')
+        self.assertEqual(self.filter('friend@example.com'), (75, False))
+        self.writeConfig('')
+        self.assertEqual(self.filter('friend@example.com'), (0, True))
+
+    def testPersistentPipe(self):
+        # The children share the classifier the daemon started.
+        pids = os.path.join(self.tmpdir, 'pids')
+        self.writeFilter('pipe -persistent "%s %s %s" drop\n'
+                         'from friend@example.com ok\n' %
+                         (sys.executable, os.path.abspath('bin/classifier'),
+                          pids))
+        self.startDaemon()
+        for i in range(3):
+            self.assertEqual(self.filter('spam@example.com'), (99, False))
+        self.assertEqual(self.filter('friend@example.com'), (0, True))
+        self.assertEqual(len(set(open(pids).read().split())), 1)
+
+    def testPipeTimeout(self):
+        # Deferred (qmail's 111) without the tmda-filter wrapper's
+        # traceback.
+        self.writeFilter('pipe -timeout=0.5 "sleep 10" drop\n')
+        self.assertEqual(self.filter('friend@example.com', 'tmda-rfilter'),
+                         (111, False))
+        self.assertEqual(self.filter('friend@example.com', 'tmda-filter'),
+                         (111, False))
+        self.failIf(os.path.exists(os.path.join(self.tmda, 'logs')))
+
+    def testSlowClient(self):
+        # A client still reading its message holds up no one else.
+        self.startDaemon()
+        env = dict(self.env, SENDER='friend@example.com')
+        slow = subprocess.Popen([sys.executable,
+                                 self.program('tmda-filter-client'),
+                                 '--socket=' + self.socket, '-p'],
+                                env=env, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        time.sleep(0.5)
+        start = time.time()
+        self.assertEqual(self.filter('friend@example.com'), (0, True))
+        self.failUnless(time.time() - start < 10)
+        message = 'From: friend@example.com\nSubject: test\n\nbody\n'
+        self.assertEqual(slow.communicate(message)[0], message)
+        self.assertEqual(slow.returncode, 0)
+
+    def testNoDaemon(self):
+        # tmda-filter-client runs tmda-filter instead.
+        self.assertEqual(self.filter('friend@example.com'), (0, True))
+        self.assertEqual(self.filter('foe@example.com'), (99, False))
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
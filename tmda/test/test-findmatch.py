@@ -0,0 +1,124 @@
+import unittest
+import fnmatch
+import random
+
+import lib.util
+lib.util.testPrep()
+
+import TMDA.Util as Util
+
+def linear_findmatch(list, addrs):
+    '''The original, linear findmatch, used as a reference.'''
+    for address in addrs:
+        if address:
+            address = address.lower()
+            for p in list:
+                stringparts = p.split()
+                p = stringparts[0]
+                try:
+                    at = p.rindex('@')
+                    atequals = p[at+1] == '='
+                except (ValueError, IndexError):
+                    atequals = None
+                if atequals:
+                    p1 = p[:at+1] + p[at+2:]
+                    p2 = p[:at+1] + '*.' + p[at+2:]
+                    match = (fnmatch.fnmatch(address,p1)
+                             or fnmatch.fnmatch(address,p2))
+                else:
+                    match = fnmatch.fnmatch(address,p)
+                if match:
+                    try:
+                        return stringparts[1]
+                    except IndexError:
+                        return 1
+
+class FindMatch(unittest.TestCase):
+    patterns = [
+        'exact@example.com',
+        'override@example.com confirm',
+        '*@wild.com drop',
+        '*@=sub.com ok',
+        'user@=host.org bounce',
+        'pre*@example.net',
+        '*.example.org',
+        '*@*.deep.com hold',
+        'a?c@example.com',
+        '[xy]z@example.com drop',
+        '*foo*@example.com',
+        'broken[@example.com',
+        '*',
+    ]
+
+    def check(self, patterns, addrs):
+        expected = linear_findmatch(patterns, addrs)
+        self.assertEqual(Util.findmatch(patterns, addrs), expected,
+                         '%r vs %r' % (addrs, patterns))
+        self.assertEqual(Util.AddressMatcher(patterns).match(addrs), expected)
+
+    def testExamples(self):
+        addrs = [
+            'exact@example.com', 'EXACT@Example.COM', 'override@example.com',
+            'x@wild.com', 'x@wild.comm', 'x@sub.com', 'x@a.sub.com',
+            'x@asub.com', 'user@host.org', 'user@mx.host.org',
+            'other@host.org', 'prefix@example.net', 'pr@example.net',
+            'x@example.org', 'x@deep.com', 'x@a.deep.com', 'abc@example.com',
+            'xz@example.com', 'zz@example.com', 'afoob@example.com',
+            'broken[@example.com', 'nothing@nowhere.net', '', None,
+        ]
+        # Without the catch-all pattern so that misses are exercised.
+        for addr in addrs:
+            self.check(self.patterns[:-1], [addr])
+        for addr in addrs:
+            self.check(self.patterns, [addr])
+        self.check(self.patterns[:-1], addrs)
+
+    def testSinglePattern(self):
+        # A lone pattern is checked directly rather than indexed.
+        addrs = ['x@wild.com', 'x@a.sub.com', 'user@mx.host.org',
+                 'abc@example.com', 'nothing@nowhere.net', '']
+        for pattern in self.patterns:
+            self.check([pattern], addrs)
+            for addr in addrs:
+                self.check([pattern], [addr])
+
+    def testFirstPatternWins(self):
+        patterns = ['*@example.com first', 'x@example.com second']
+        self.assertEqual(Util.findmatch(patterns, ['x@example.com']), 'first')
+        patterns.reverse()
+        self.assertEqual(Util.findmatch(patterns, ['x@example.com']), 'second')
+
+    def testFirstAddressWins(self):
+        patterns = ['a@example.com first', 'b@example.com second']
+        self.assertEqual(Util.findmatch(patterns, ['b@example.com',
+                                                   'a@example.com']),
+                         'second')
+
+    def testManyWildcards(self):
+        # Enough general wildcards to need several combined expressions.
+        patterns = ['w%d?@example.com w%d' % (i, i) for i in range(500)]
+        patterns.insert(300, 'w42x@example.com early')
+        for addr in ('w42x@example.com', 'w499y@example.com',
+                     'w1@example.com'):
+            self.check(patterns, [addr])
+
+    def testRandom(self):
+        rand = random.Random(12345)
+        parts = ['a', 'b', 'ab', '*', '?', '.', '@', '=', '[ab]']
+        for i in range(200):
+            patterns = []
+            for j in range(rand.randint(1, 8)):
+                p = ''.join([rand.choice(parts)
+                             for k in range(rand.randint(1, 6))])
+                if rand.random() < 0.5:
+                    p += ' action%d' % j
+                patterns.append(p)
+            addrs = [''.join([rand.choice('ab.@')
+                              for k in range(rand.randint(1, 7))])
+                     for j in range(3)]
+            self.check(patterns, addrs)
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
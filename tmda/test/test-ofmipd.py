@@ -1,8 +1,12 @@
 import unittest
+import base64
 import hmac
 import sys
 from hashlib import md5
 import os
+import socket
+import subprocess
+import time
 
 import lib.util
 lib.util.testPrep()
@@ -260,6 +264,11 @@ class SslSendV4Test(SslSendTestMixin, unittest.TestCase):
 class TlsSendV4Test(TlsSendTestMixin, unittest.TestCase):
     client_addr = 'v4'
 
+class NoReverseDnsSendTest(SendTestMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendTestMixin.serverAddOptions(self)
+        self.server.addOptions('--no-reverse-dns')
+
 
 class QuotaTest(SendMailMixin, unittest.TestCase):
     def serverAddOptions(self):
@@ -284,6 +293,173 @@ class QuotaTest(SendMailMixin, unittest.TestCase):
     def testOverQuota(self):
         self.sendMessage('overquota', 'quotapassword', 450)
 
+class InjectionTest(SendMailMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendMailMixin.serverAddOptions(self)
+        self.server.addOptions(['--workers', '1'])
+
+    def sendMessage(self, expectedCode):
+        self.beginSend()
+        self.sendLine('X-Test: Injection')
+        self.sendLine('')
+        self.sendLine('Short message.')
+        self.finishSend(expectedCode)
+
+    def testSeveral(self):
+        # The one worker injects each message in turn.
+        self.client.signOn()
+        for i in range(3):
+            self.sendMessage(250)
+
+    def testFailure(self):
+        # overquota has no TMDA configuration, so tmda-inject fails.
+        self.client.signOn('overquota', 'quotapassword')
+        self.sendMessage(451)
+        self.sendMessage(451)
+        (code, lines) = self.client.exchange('NOOP\r\n')
+        self.assertEqual(code, 250)
+
+class WorkerTest(SendMailMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendMailMixin.serverAddOptions(self)
+        self.server.addOptions(['--throttle-script', 'bin/workerthrottle'])
+
+    def testNewProgram(self):
+        # The worker holds nothing of the server's, such as its
+        # sessions or keys.
+        self.client.signOn()
+        self.beginSend()
+        self.sendLine('X-Test: Worker')
+        self.sendLine('')
+        self.sendLine('Short message.')
+        self.finishSend(250)
+
+# The throttle script takes three seconds to refuse a message from overquota.
+class ConcurrencyTest(SendMailMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendMailMixin.serverAddOptions(self)
+        self.server.addOptions(['--throttle-script', 'bin/slowthrottle',
+                                '--workers', '2'])
+
+    def sendMessage(self, client, end):
+        for line in ('MAIL FROM: testuser@nowhere.com',
+                     'RCPT TO: fakeuser@fake.com',
+                     'DATA'):
+            (code, lines) = client.exchange(line + '\r\n')
+            self.assertTrue(code in (250, 354))
+        client.send('X-Test: Concurrency\r\n\r\nShort message.\r\n' + end)
+
+    def testOtherSession(self):
+        self.client.signOn('overquota', 'quotapassword')
+        self.sendMessage(self.client, '')
+        start = time.time()
+        self.client.send('.\r\n')
+
+        other = self.server.makeClient(self.client_addr)
+        other.signOn()
+        self.sendMessage(other, '')
+        (code, lines) = other.exchange('.\r\n')
+        self.assertEqual(code, 250)
+        self.assertTrue(time.time() - start < 3)
+
+        (code, lines) = self.client.exchange('')
+        self.assertEqual(code, 450)
+
+    def testPipelined(self):
+        # The NOOP is answered after the message.
+        self.client.signOn('overquota', 'quotapassword')
+        self.sendMessage(self.client, '.\r\nNOOP\r\n')
+        replies = self.client.receiveUntil(lambda data: data.count('\r\n') >= 2)
+        self.assertEqual([line[:3] for line in replies.split('\r\n')],
+                         ['450', '250', ''])
+
+    def testSplitCommand(self):
+        # The start of a RSET arrives while the message is processed,
+        # and the rest of it later.
+        self.client.signOn('overquota', 'quotapassword')
+        self.sendMessage(self.client, '.\r\nNOOP\r\nRS')
+        time.sleep(0.5)
+        self.client.send('ET\r\n')
+        replies = self.client.receiveUntil(lambda data: data.count('\r\n') >= 3)
+        self.assertEqual([line[:3] for line in replies.split('\r\n')],
+                         ['450', '250', '250', ''])
+
+    def testPipelinedData(self):
+        # The next message follows without waiting for any reply.
+        self.client.signOn('overquota', 'quotapassword')
+        self.client._sock.settimeout(20)
+        self.sendMessage(self.client,
+                         '.\r\nMAIL FROM: testuser@nowhere.com\r\n'
+                         'RCPT TO: fakeuser@fake.com\r\nDATA\r\n'
+                         'X-Test: Concurrency\r\n\r\nAnother.\r\n.\r\n')
+        replies = self.client.receiveUntil(lambda data: data.count('\r\n') >= 5)
+        self.assertEqual([line[:3] for line in replies.split('\r\n')],
+                         ['450', '250', '250', '354', '450', ''])
+
+class OneSessionTest(unittest.TestCase):
+    def setUp(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.client = socket.create_connection(listener.getsockname())
+        (conn, addr) = listener.accept()
+        listener.close()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = lib.util.rootDir
+        env['TMDA_TEST_HOME'] = lib.util.userDir
+        self.server = subprocess.Popen(
+            [sys.executable,
+             os.path.join(lib.util.rootDir, 'bin', 'tmda-ofmipd'),
+             '--one-session', '--configdir=home',
+             '--authfile=%s' % os.path.join(lib.util.filesDir,
+                                            'test-ofmipd.auth')],
+            stdin=conn.fileno(), stdout=conn.fileno(), env=env)
+        conn.close()
+        self.client.settimeout(20)
+        self.replies = self.client.makefile()
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.kill()
+            self.server.wait()
+        self.client.close()
+
+    def testExits(self):
+        # The server, and its worker, exit with the session.
+        self.assertEqual(self.replies.readline()[:3], '220')
+        self.client.sendall('QUIT\r\n')
+        self.assertEqual(self.replies.readline()[:3], '221')
+        for i in range(100):
+            if self.server.poll() is not None:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.server.returncode, 0)
+
+    def exchange(self, line):
+        self.client.sendall(line + '\r\n')
+        lines = []
+        while True:
+            lines.append(self.replies.readline())
+            if lines[-1][3:4] == ' ':
+                return lines
+
+    def testPeerName(self):
+        # The name is looked up before the Received header is added.
+        self.replies.readline()
+        self.exchange('EHLO test')
+        auth = base64.b64encode('\0testuser\0testpassword')
+        self.assertEqual(self.exchange('AUTH PLAIN ' + auth)[-1][:3], '235')
+        self.exchange('MAIL FROM: testuser@nowhere.com')
+        self.exchange('RCPT TO: fakeuser@fake.com')
+        self.assertEqual(self.exchange('DATA')[-1][:3], '354')
+        # The fake sendmail prints the message, with its headers, to
+        # the connection.
+        lines = self.exchange('X-Test: One session\r\n\r\nShort.\r\n.')
+        self.assertEqual(lines[-1][:3], '250')
+        received = [line for line in lines if line.startswith('Received:')]
+        self.failUnless('(%s [127.0.0.1])' % socket.getfqdn('127.0.0.1')
+                        in received[0], received)
+
 # Test for the undocumented ipauthmap file.
 class IpAuthMapTest(unittest.TestCase):
     def setUp(self):
@@ -435,6 +611,71 @@ class IpAuthMapTest(unittest.TestCase):
 # XXX Add tests:
 # Dupes and syntax errors
 
+class ReverseResolverTest(unittest.TestCase):
+    def setUp(self):
+        module = {}
+        ofmipd = os.path.join(lib.util.rootDir, 'bin', 'tmda-ofmipd')
+        execfile(ofmipd, module)
+        self.ReverseResolver = module['ReverseResolver']
+        self.lookups = []
+        self.delay = 0
+        self.gethostbyaddr = socket.gethostbyaddr
+        socket.gethostbyaddr = self.fakeGethostbyaddr
+
+    def tearDown(self):
+        socket.gethostbyaddr = self.gethostbyaddr
+
+    def fakeGethostbyaddr(self, ip):
+        self.lookups.append(ip)
+        time.sleep(self.delay)
+        if ip == '192.0.2.1':
+            return ('client', ['client.example.com'], [ip])
+        raise socket.herror(1, 'Unknown host')
+
+    def name(self, resolver, ip, timeout=5):
+        return resolver.name(ip, time.time() + timeout)
+
+    def testCached(self):
+        resolver = self.ReverseResolver(3600, 300)
+        self.assertEqual(self.name(resolver, '192.0.2.1'),
+                         'client.example.com')
+        self.assertEqual(self.name(resolver, '192.0.2.1'),
+                         'client.example.com')
+        self.assertEqual(self.lookups, ['192.0.2.1'])
+
+    def testNegative(self):
+        resolver = self.ReverseResolver(3600, 300)
+        self.assertEqual(self.name(resolver, '192.0.2.2'), '192.0.2.2')
+        self.assertEqual(self.name(resolver, '192.0.2.2'), '192.0.2.2')
+        self.assertEqual(self.lookups, ['192.0.2.2'])
+
+    def testExpired(self):
+        resolver = self.ReverseResolver(0, 0)
+        self.name(resolver, '192.0.2.1')
+        self.name(resolver, '192.0.2.2')
+        self.name(resolver, '192.0.2.1')
+        self.assertEqual(len(self.lookups), 3)
+
+    def testTimeout(self):
+        resolver = self.ReverseResolver(3600, 300)
+        self.delay = 0.5
+        self.assertEqual(self.name(resolver, '192.0.2.1', 0.1), '192.0.2.1')
+        # The answer is cached once it arrives.
+        self.assertEqual(self.name(resolver, '192.0.2.1'),
+                         'client.example.com')
+        self.assertEqual(self.lookups, ['192.0.2.1'])
+
+    def testNoWait(self):
+        # Without a deadline, as in the event loop, the IP address is
+        # used until the answer is in.
+        resolver = self.ReverseResolver(3600, 300)
+        self.delay = 0.5
+        start = time.time()
+        self.assertEqual(resolver.name('192.0.2.1'), '192.0.2.1')
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(self.name(resolver, '192.0.2.1'),
+                         'client.example.com')
+
 if __name__ == '__main__':
     if '-v' in sys.argv:
         verbose = True
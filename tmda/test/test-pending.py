@@ -1,5 +1,7 @@
 import unittest
+import shutil
 import sys
+import tempfile
 import time
 import os
 import cStringIO as StringIO
@@ -45,9 +47,11 @@ test_messages = {
 
 class MockMailQueue(object):
     parser = Parser()
+    concurrent_reads = True
 
     def __init__(self):
         self._msgs = {}
+        self.fetched = []
 
         for (msgid, body) in test_messages.items():
             self._msgs[msgid] = '\r\n'.join(body)
@@ -65,9 +69,17 @@ class MockMailQueue(object):
         return msgid in self._msgs
 
     def fetch_message(self, msgid, fullParse=False):
+        self.fetched.append(msgid)
         headers_only = not fullParse
         return self.parser.parsestr(self._msgs[msgid], headers_only)
 
+    def fetch_headers(self, msgid, names=None):
+        headers = self._msgs[msgid].split('\r\n\r\n')[0]
+        return self.parser.parsestr(headers, True)
+
+    def fetch_size(self, msgid):
+        return len(self._msgs[msgid])
+
     def delete_message(self, msgid):
         self._msgs.pop(msgid, None)
 
@@ -279,7 +291,7 @@ class QueueLoopTestAppendingMixin(QueueLoopTestMixin):
 
         queue.mainLoop()
         # Make sure the cached IDs are as expected.
-        self.assertEqual(queue.msgcache, list(reversed(cache_ids)))
+        self.assertEqual(list(queue.msgcache), cache_ids)
 
         # Revisit the loop, this time expected only the non-cached IDs to be
         # handled.
@@ -367,6 +379,148 @@ class QueueLoopShowTest(QueueLoopTestMixin, unittest.TestCase):
     def expectedDbInserts(self):
         return []
 
+class MessageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-pending.')
+        self.path = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testPersist(self):
+        cache = Pending.MessageCache(self.path, 10)
+        for msgid in ('1.1', '2.2', '3.3'):
+            self.assertTrue(cache.add(msgid))
+        self.assertFalse(cache.add('2.2'))
+        cache.remove('1.1')
+        cache.save()
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+
+        cache = Pending.MessageCache(self.path, 10)
+        self.assertEqual(list(cache), ['2.2', '3.3'])
+        cache.add('1.1')
+        cache.remove('2.2')
+        cache.save()
+        self.assertEqual(list(Pending.MessageCache(self.path, 10)),
+                         ['3.3', '1.1'])
+
+    def testTrim(self):
+        cache = Pending.MessageCache(self.path, 3)
+        for i in range(5):
+            cache.add('%d.1' % i)
+            cache.save()
+        cache = Pending.MessageCache(self.path, 3)
+        self.assertEqual(list(cache), ['2.1', '3.1', '4.1'])
+        # The file was rewritten rather than growing without bound.
+        self.assertTrue(len(open(self.path).readlines()) <= 6)
+
+    def testMigratePickle(self):
+        # Earlier versions pickled a list, newest first.
+        Util.pickleit(['3.3', '2.2', '1.1'], self.path, 0)
+        cache = Pending.MessageCache(self.path, 2)
+        self.assertEqual(list(cache), ['2.2', '3.3'])
+        cache.save()
+        self.assertEqual(open(self.path).read(), '2.2\n3.3\n')
+
+class MessageTest(unittest.TestCase):
+    def setUp(self):
+        Pending.Q = MockMailQueue()
+
+    def testLazyBody(self):
+        M = Pending.Message('1303349951.12346')
+        self.assertEqual(M.terse()[1:], ['None', 'Test message number TWO!'])
+        self.assertEqual(M.getConfirmAddress().split('-')[:2],
+                         ['testuser', 'confirm'])
+        self.assertEqual(Pending.Q.fetched, [])
+        self.assertTrue(M.show().endswith('This is another test message.'))
+        M.show()
+        self.assertEqual(Pending.Q.fetched, ['1303349951.12346'])
+
+    def testFullParse(self):
+        M = Pending.Message('1303349951.12346', fullParse=True)
+        self.assertEqual(Pending.Q.fetched, ['1303349951.12346'])
+        self.assertTrue(M.msgobj.get_payload().endswith(
+            'This is another test message.'))
+        M.show()
+        self.assertEqual(Pending.Q.fetched, ['1303349951.12346'])
+
+class QueueScanTest(unittest.TestCase):
+    def setUp(self):
+        Pending.Q = MockMailQueue()
+        self.threads = Defaults.PENDING_SCAN_THREADS
+
+    def tearDown(self):
+        Defaults.PENDING_SCAN_THREADS = self.threads
+
+    def listing(self, **kwargs):
+        queue = Pending.Queue(dispose='pass', **kwargs)
+        queue.stdout = StringIO.StringIO()
+        queue.initQueue()
+        queue.mainLoop()
+        return queue.stdout.getvalue()
+
+    def testOrder(self):
+        for threads in (1, 3):
+            Defaults.PENDING_SCAN_THREADS = threads
+            for descending in (False, True):
+                ids = sorted(test_messages.keys(), reverse=descending)
+                lines = self.listing(terse=True, verbose=False,
+                                     descending=descending).splitlines()
+                self.assertEqual([line.split('\t')[0] for line in lines], ids)
+                self.assertEqual(lines[0].split('\t')[2],
+                                 Pending.Q.fetch_message(ids[0])['subject'])
+
+    def testSummarySize(self):
+        Defaults.PENDING_SCAN_THREADS = 3
+        output = self.listing(msgs=['1303349951.12346'], verbose=True)
+        size = len('\r\n'.join(test_messages['1303349951.12346']))
+        self.assertTrue('1303349951.12346 (1 of 1 / %d bytes)' % size
+                        in output)
+
+class BatchReleaseTest(QueueLoopReleaseTest):
+    # Delivery to the -extension address fails.
+    sendmail_script = """#!/bin/sh
+case "$5" in
+  *-extension@*) exit 75 ;;
+esac
+cat > `mktemp %s/sent.XXXXXX`
+"""
+
+    def setUp(self):
+        QueueLoopReleaseTest.setUp(self)
+        self.tmpdir = tempfile.mkdtemp(prefix='test-pending.')
+        program = os.path.join(self.tmpdir, 'sendmail')
+        f = open(program, 'w')
+        f.write(self.sendmail_script % self.tmpdir)
+        f.close()
+        os.chmod(program, 0700)
+        Defaults.SENDMAIL_PROGRAM = program
+        Defaults.PENDING_RELEASE_WORKERS = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        QueueLoopReleaseTest.tearDown(self)
+
+    def testFailures(self):
+        queue = Pending.Queue(dispose=self.dispose, verbose=verbose)
+        queue.stdout = StringIO.StringIO()
+        queue.initQueue()
+
+        queue.mainLoop()
+        self.assertEqual(queue.failed, ['1303433207.12347'])
+        self.assertTrue('release 1303433207.12347 failed'
+                        in queue.stdout.getvalue())
+        sent = [open(os.path.join(self.tmpdir, name)).read()
+                for name in os.listdir(self.tmpdir)
+                if name.startswith('sent.')]
+        self.assertEqual(len(sent), 2)
+        for msg in sent:
+            self.assertTrue('X-TMDA-Confirm-Done:' in msg)
+            self.assertTrue('This is' in msg)
+        # The appends happen in order, failed messages included.
+        self.assertEqual(self.file_appends, self.expectedFileAppends())
+        self.assertEqual(self.db_inserts, self.expectedDbInserts())
+
 
 if __name__ == '__main__':
     if '-v' in sys.argv:
@@ -0,0 +1,293 @@
+import unittest
+import fcntl
+import os
+import shutil
+import socket
+import tempfile
+import time
+from email.message import Message
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import Util
+from TMDA.Queue.MaildirQueue import MaildirQueue
+from TMDA.Queue.OriginalQueue import OriginalQueue
+from TMDA.Queue.SQLiteQueue import SQLiteQueue
+from TMDA.Queue import Util as QueueUtil
+
+class QueueTestMixin(object):
+    '''
+    Points PENDING_DIR at a scratch directory for the queue under test.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-queue.')
+        self.pending_dir = Defaults.PENDING_DIR
+        Defaults.PENDING_DIR = os.path.join(self.tmpdir, 'pending')
+
+    def tearDown(self):
+        Defaults.PENDING_DIR = self.pending_dir
+        shutil.rmtree(self.tmpdir)
+
+    def makeMessage(self, subject):
+        msg = Message()
+        msg['Return-Path'] = '<sender@example.com>'
+        msg['Subject'] = subject
+        msg.set_payload('A test message.\n')
+        return msg
+
+class MaildirQueueTests(QueueTestMixin, unittest.TestCase):
+    def setUp(self):
+        QueueTestMixin.setUp(self)
+        self.queue = MaildirQueue()
+        self.queue.insert_message(self.makeMessage('one'),
+                                  '1300000000.111', 'testuser@nowhere.com')
+        self.queue.insert_message(self.makeMessage('two'),
+                                  '1300000001.11', 'testuser@nowhere.com')
+
+    def path(self, subdir, mailid, suffix=''):
+        return os.path.join(Defaults.PENDING_DIR, subdir,
+                            '%s.%s%s' % (mailid, socket.gethostname(), suffix))
+
+    def testFetch(self):
+        self.assertTrue(self.queue.find_message('1300000001.11'))
+        msg = self.queue.fetch_message('1300000001.11')
+        self.assertEqual(msg['subject'], 'two')
+        self.assertEqual(msg['x-tmda-recipient'], 'testuser@nowhere.com')
+
+    def testNoSubstringMatch(self):
+        # '1300000000.11' is a prefix of another message's id.
+        self.assertFalse(self.queue.find_message('1300000000.11'))
+        self.assertRaises(IOError, self.queue.fetch_message, '1300000000.11')
+        self.queue.delete_message('1300000000.11')
+        self.assertTrue(self.queue.find_message('1300000000.111'))
+
+    def testMovedToCur(self):
+        # A MUA moved the message to cur/ and added an info suffix.
+        os.rename(self.path('new', '1300000000.111'),
+                  self.path('cur', '1300000000.111', ':2,S'))
+        self.assertTrue(self.queue.find_message('1300000000.111'))
+        self.assertEqual(self.queue.fetch_message('1300000000.111')['subject'],
+                         'one')
+        self.queue.delete_message('1300000000.111')
+        self.assertFalse(self.queue.find_message('1300000000.111'))
+
+    def testFetchHeaders(self):
+        msg = self.queue.fetch_headers('1300000001.11', ['subject'])
+        self.assertEqual(msg['subject'], 'two')
+        self.assertEqual(msg['x-tmda-recipient'], 'testuser@nowhere.com')
+        self.assertEqual(msg.get_payload(), '')
+
+    def testSize(self):
+        self.assertEqual(self.queue.fetch_size('1300000001.11'),
+                         os.path.getsize(self.path('new', '1300000001.11')))
+
+    def testDelete(self):
+        self.queue.delete_message('1300000001.11')
+        self.assertFalse(self.queue.find_message('1300000001.11'))
+        self.assertEqual(self.queue.fetch_ids(), ['1300000000.111'])
+
+class SQLiteQueueTests(QueueTestMixin, unittest.TestCase):
+    def setUp(self):
+        QueueTestMixin.setUp(self)
+        self.queue = SQLiteQueue()
+
+    def insert(self, queue, mailid, subject):
+        msg = self.makeMessage(subject)
+        msg['From'] = 'Some One <someone@example.com>'
+        queue.insert_message(msg, mailid, 'testuser@nowhere.com')
+
+    def testEmpty(self):
+        self.assertFalse(self.queue.exists())
+        self.assertEqual(self.queue.fetch_ids(), [])
+        self.assertFalse(self.queue.find_message('1300000000.1'))
+        self.assertRaises(IOError, self.queue.fetch_message, '1300000000.1')
+        self.queue.cleanup()
+
+    def testInsertFetch(self):
+        self.insert(self.queue, '1300000001.2', 'two')
+        self.insert(self.queue, '1300000000.1', 'one \xe9')
+        self.assertTrue(self.queue.exists())
+        self.assertEqual(self.queue.fetch_ids(),
+                         ['1300000000.1', '1300000001.2'])
+        self.assertTrue(self.queue.find_message('1300000000.1'))
+
+        msg = self.queue.fetch_message('1300000000.1')
+        self.assertEqual(msg['subject'], 'one \xe9')
+        self.assertEqual(msg['x-tmda-recipient'], 'testuser@nowhere.com')
+        self.assertEqual(msg.get_payload(), 'A test message.\n')
+
+        self.assertEqual(self.queue.fetch_size('1300000000.1'),
+                         len(Util.msg_as_string(msg)))
+
+        self.queue.delete_message('1300000000.1')
+        self.assertFalse(self.queue.find_message('1300000000.1'))
+        self.assertEqual(self.queue.fetch_ids(), ['1300000001.2'])
+
+    def testFetchHeaders(self):
+        self.insert(self.queue, '1300000000.1', 'one')
+        msg = self.queue.fetch_headers('1300000000.1', ['From', 'subject'])
+        self.assertEqual(msg['from'], 'Some One <someone@example.com>')
+        self.assertEqual(msg['subject'], 'one')
+        self.assertEqual(msg['return-path'], '<sender@example.com>')
+        self.assertEqual(msg.get_payload(), '')
+        msg = self.queue.fetch_headers('1300000000.1')
+        self.assertEqual(msg.items(),
+                         self.queue.fetch_message('1300000000.1').items())
+        self.assertEqual(msg.get_payload(), '')
+
+    def testCleanup(self):
+        self.insert(self.queue, '1000000000.1', 'old')
+        self.insert(self.queue, '%d.2' % time.time(), 'new')
+        appended = os.path.join(self.tmpdir, 'deleted')
+        saved = Defaults.PENDING_DELETE_APPEND
+        try:
+            Defaults.PENDING_DELETE_APPEND = appended
+            self.queue.cleanup()
+        finally:
+            Defaults.PENDING_DELETE_APPEND = saved
+        self.assertEqual(len(self.queue.fetch_ids()), 1)
+        self.assertFalse(self.queue.find_message('1000000000.1'))
+        self.assertEqual(open(appended).read(), 'sender@example.com\n')
+
+    def testConvert(self):
+        self.insert(MaildirQueue(), '1300000001.2', 'maildir')
+        self.insert(OriginalQueue(), '1300000000.1', 'original')
+        self.insert(self.queue, '1300000002.3', 'sqlite')
+        self.assertEqual(self.queue.fetch_ids(),
+                         ['1300000000.1', '1300000001.2', '1300000002.3'])
+        self.assertEqual(self.queue.fetch_message('1300000001.2')['subject'],
+                         'maildir')
+        self.assertEqual(OriginalQueue().fetch_ids(), [])
+        self.assertEqual(MaildirQueue().fetch_ids(), [])
+
+    def testForked(self):
+        self.insert(self.queue, '1300000000.1', 'one')
+        db = self.queue._SQLiteQueue__connect()
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ids = self.queue.fetch_ids()
+                own = self.queue._SQLiteQueue__connect() is not db
+                os.write(w, repr((ids, own)))
+            finally:
+                os._exit(0)
+        os.close(w)
+        result = os.read(r, 1024)
+        os.waitpid(pid, 0)
+        self.assertEqual(result, repr((['1300000000.1'], True)))
+        self.assertTrue(self.queue._SQLiteQueue__connect() is db)
+
+    def testConvertBeforeInsert(self):
+        self.insert(MaildirQueue(), '1300000001.2', 'maildir')
+        self.insert(OriginalQueue(), '1300000000.1', 'original')
+        self.assertTrue(self.queue.find_message('1300000001.2'))
+        self.assertEqual(SQLiteQueue().fetch_ids(),
+                         ['1300000000.1', '1300000001.2'])
+        self.assertEqual(OriginalQueue().fetch_ids(), [])
+
+class CleanupTestMixin(QueueTestMixin):
+    '''
+    Cleanup tests run against each queue format.
+    '''
+
+    def setUp(self):
+        QueueTestMixin.setUp(self)
+        self.saved = (Defaults.PENDING_CLEANUP_BATCH,
+                      Defaults.PENDING_DELETE_APPEND)
+        self.appended = os.path.join(self.tmpdir, 'deleted')
+        Defaults.PENDING_DELETE_APPEND = self.appended
+        self.queue = self.queueclass()
+        self.now = int(time.time())
+        for (mailid, sender) in (('1000000002.1', 'b@example.com'),
+                                 ('1000000001.1', 'a@example.com'),
+                                 ('1000000003.1', 'c@example.com'),
+                                 ('%d.1' % self.now, 'new@example.com')):
+            msg = self.makeMessage(mailid)
+            msg.replace_header('Return-Path', '<%s>' % sender)
+            self.queue.insert_message(msg, mailid, 'testuser@nowhere.com')
+
+    def tearDown(self):
+        (Defaults.PENDING_CLEANUP_BATCH,
+         Defaults.PENDING_DELETE_APPEND) = self.saved
+        QueueTestMixin.tearDown(self)
+
+    def testBatches(self):
+        Defaults.PENDING_CLEANUP_BATCH = 2
+        self.queue.cleanup()
+        self.assertEqual(sorted(self.queue.fetch_ids()),
+                         ['1000000003.1', '%d.1' % self.now])
+        self.assertEqual(open(self.appended).read(),
+                         'a@example.com\nb@example.com\n')
+        self.queue.cleanup()
+        self.assertEqual(self.queue.fetch_ids(), ['%d.1' % self.now])
+
+    def testUnlimited(self):
+        Defaults.PENDING_CLEANUP_BATCH = 0
+        self.queue.cleanup()
+        self.assertEqual(self.queue.fetch_ids(), ['%d.1' % self.now])
+        self.assertEqual(open(self.appended).read(),
+                         'a@example.com\nb@example.com\nc@example.com\n')
+
+class OriginalCleanupTests(CleanupTestMixin, unittest.TestCase):
+    queueclass = OriginalQueue
+
+class MaildirCleanupTests(CleanupTestMixin, unittest.TestCase):
+    queueclass = MaildirQueue
+
+class SQLiteCleanupTests(CleanupTestMixin, unittest.TestCase):
+    queueclass = SQLiteQueue
+
+class ScheduleTests(CleanupTestMixin, unittest.TestCase):
+    queueclass = OriginalQueue
+
+    def setUp(self):
+        CleanupTestMixin.setUp(self)
+        self.interval = Defaults.PENDING_CLEANUP_INTERVAL
+        Defaults.PENDING_CLEANUP_INTERVAL = '1h'
+        Defaults.PENDING_CLEANUP_BATCH = 1
+
+    def tearDown(self):
+        Defaults.PENDING_CLEANUP_INTERVAL = self.interval
+        CleanupTestMixin.tearDown(self)
+
+    def testOncePerInterval(self):
+        self.assertTrue(QueueUtil.cleanup_due())
+        QueueUtil.schedule_cleanup(self.queue, detach=False)
+        self.assertEqual(len(self.queue.fetch_ids()), 3)
+        self.assertFalse(QueueUtil.cleanup_due())
+        QueueUtil.schedule_cleanup(self.queue, detach=False)
+        self.assertFalse(QueueUtil.sweep(self.queue))
+        self.assertEqual(len(self.queue.fetch_ids()), 3)
+
+        # Pretend the last cleanup was two hours ago.
+        stamp = os.path.join(Defaults.PENDING_DIR, '.cleanup')
+        earlier = time.time() - 2 * 60 * 60
+        os.utime(stamp, (earlier, earlier))
+        self.assertTrue(QueueUtil.sweep(self.queue))
+        self.assertEqual(len(self.queue.fetch_ids()), 2)
+
+    def testLocked(self):
+        lock = open(os.path.join(Defaults.PENDING_DIR, '.cleanup.lock'), 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            self.assertFalse(QueueUtil.sweep(self.queue))
+        finally:
+            lock.close()
+        self.assertTrue(QueueUtil.sweep(self.queue))
+
+    def testDetached(self):
+        QueueUtil.schedule_cleanup(self.queue)
+        for i in range(50):
+            if len(self.queue.fetch_ids()) == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(self.queue.fetch_ids()), 3)
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
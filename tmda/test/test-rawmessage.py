@@ -0,0 +1,64 @@
+import unittest
+from cStringIO import StringIO
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Util
+
+class RawMessageTests(unittest.TestCase):
+    messages = [
+        'From: a@example.com\nSubject: hi\n\nbody\n\nmore\n',
+        'From a@example.com Mon Jan  1 00:00:00 2001\n'
+        'From: a@example.com\n\nbody',
+        'Subject: folded\n\tcontinued\n\nbody\n',
+        'Subject: no body\n',
+        '\nno headers\n',
+        'Subject: hi\r\n\r\nbody\r\n',
+        'Subject: hi\nnot a header\nTo: b@example.com\n\nbody\n',
+        'Content-Type: multipart/mixed; boundary=x\n\n'
+        '--x\nSubject: inner\n\npart\n--x--\n',
+    ]
+
+    def testSameParse(self):
+        for text in self.messages:
+            parsed = Util.msg_from_file(StringIO(text))
+            raw = Util.RawMessage(text)
+            self.assertEqual(raw.msg.items(), parsed.items(), repr(text))
+            self.assertEqual(raw.msg.get_payload(), parsed.get_payload())
+            self.assertEqual(raw.msg.get_unixfrom(), parsed.get_unixfrom())
+            self.assertEqual(raw.body, parsed.get_payload())
+
+    def testRawStrings(self):
+        for text in self.messages[:3]:
+            parsed = Util.msg_from_file(StringIO(text))
+            raw = Util.RawMessage(text)
+            self.assertEqual(raw.headers, Util.headers_as_raw_string(parsed))
+            self.assertEqual(raw.body, Util.body_as_raw_string(parsed))
+            self.assertEqual(raw.as_string(), Util.msg_as_string(parsed))
+            self.assertEqual(raw.size, len(Util.msg_as_string(parsed)))
+
+    def testNotRegenerated(self):
+        text = self.messages[0]
+        raw = Util.RawMessage(text)
+        self.assertFalse(raw.modified())
+        self.assertTrue(raw.as_string() is text)
+        self.assertTrue(raw.body is raw.msg.get_payload())
+
+    def testModified(self):
+        raw = Util.RawMessage(self.messages[0])
+        raw.msg['X-TMDA-Action'] = 'OK'
+        self.assertTrue(raw.modified())
+        self.assertEqual(raw.as_string(), Util.msg_as_string(raw.msg))
+        self.assertTrue('X-TMDA-Action: OK\n' in raw.as_string())
+        # The original strings are unchanged.
+        self.assertFalse('X-TMDA-Action' in raw.headers)
+
+        raw = Util.RawMessage(self.messages[0])
+        raw.msg.set_payload('new body\n')
+        self.assertTrue(raw.as_string().endswith('\n\nnew body\n'))
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
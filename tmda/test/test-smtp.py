@@ -0,0 +1,109 @@
+import unittest
+import asyncore
+import os
+import smtpd
+import threading
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import SMTP
+from TMDA import Util
+
+class RecordingServer(smtpd.SMTPServer):
+    '''
+    An SMTP server which counts its connections and keeps the messages
+    it receives.
+    '''
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.channels = []
+        self.messages = []
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.connections += 1
+            self.channels.append(smtpd.SMTPChannel(self, *pair))
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def dropConnections(self):
+        for channel in self.channels:
+            channel.close()
+        self.channels = []
+
+class PoolTests(unittest.TestCase):
+    settings = ('MAIL_TRANSPORT', 'SMTPHOST', 'SMTPAUTH_USERNAME',
+                'SMTPAUTH_PASSWORD', 'SMTPSSL',
+                'SMTP_MAX_SESSIONS_PER_CONNECTION')
+
+    def setUp(self):
+        self.server = RecordingServer()
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.05})
+        self.thread.start()
+        self.saved = {}
+        for name in self.settings:
+            self.saved[name] = getattr(Defaults, name, None)
+        Defaults.MAIL_TRANSPORT = 'smtp'
+        Defaults.SMTPHOST = '127.0.0.1:%d' % self.server.port
+        Defaults.SMTPAUTH_USERNAME = Defaults.SMTPAUTH_PASSWORD = None
+        Defaults.SMTPSSL = False
+        Defaults.SMTP_MAX_SESSIONS_PER_CONNECTION = 0
+
+    def tearDown(self):
+        SMTP.pool.close()
+        self.server.dropConnections()
+        self.server.close()
+        self.thread.join()
+        for name in self.settings:
+            setattr(Defaults, name, self.saved[name])
+
+    def send(self, count):
+        for i in range(count):
+            Util.sendmail('Subject: %d\n\nbody\n' % i,
+                          'to@example.com', 'from@example.com')
+
+    def testReuse(self):
+        self.send(5)
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def testMaxSessions(self):
+        Defaults.SMTP_MAX_SESSIONS_PER_CONNECTION = 2
+        self.send(5)
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.connections, 3)
+
+    def testReconnect(self):
+        self.send(1)
+        # The server closes the idle connection.
+        self.server.dropConnections()
+        self.send(1)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def testFork(self):
+        self.send(1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.send(1)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.send(1)
+        self.assertEqual(len(self.server.messages), 3)
+        # The child opened its own connection.
+        self.assertEqual(self.server.connections, 2)
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
@@ -0,0 +1,230 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import FilterParser
+from TMDA import SQL
+
+class SQLTestMixin(object):
+    '''
+    Provides a scratch sqlite3 database with a whitelist table, and a
+    filter file to match against it.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-sql.')
+        self.dbfile = os.path.join(self.tmpdir, 'tmda.db')
+        db = self.connect()
+        db.execute('CREATE TABLE whitelist (address TEXT UNIQUE, action TEXT)')
+        db.executemany('INSERT INTO whitelist VALUES (?, ?)',
+                       [('friend@example.com', None),
+                        ('boss@example.com', 'hold'),
+                        ('*@trusted.com', None)])
+        db.commit()
+        db.close()
+        self.connections = []
+        self.queries = 0
+        SQL._connections.clear()
+
+    def tearDown(self):
+        Defaults.DB_CHECK_INTERVAL = 60
+        SQL._connections.clear()
+        for db in self.connections:
+            db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self):
+        db = sqlite3.connect(self.dbfile)
+        # counted() tells how many rows the queries went through.
+        db.create_function('counted', 0, self.count)
+        return db
+
+    def factory(self):
+        db = self.connect()
+        self.connections.append(db)
+        return db
+
+    def count(self):
+        self.queries += 1
+        return 1
+
+    def parse(self, rules, db):
+        path = os.path.join(self.tmpdir, 'incoming')
+        f = open(path, 'w')
+        f.write('\n'.join(rules) + '\n')
+        f.close()
+        parser = FilterParser.FilterParser(db)
+        parser.read(path)
+        return parser
+
+    def firstmatch(self, parser, sender):
+        return parser.firstmatch('nobody@nowhere.com', [sender])[0]
+
+    def rows(self, table='whitelist'):
+        db = self.connect()
+        try:
+            return [ row[0] for row in
+                     db.execute('SELECT address FROM %s ORDER BY address'
+                                % table) ]
+        finally:
+            db.close()
+
+class FilterSQLTests(SQLTestMixin, unittest.TestCase):
+    select = ('"SELECT address, action FROM whitelist'
+              ' WHERE %(criteria)s AND counted()"')
+    wildcards = '"SELECT address, action FROM whitelist WHERE counted()"'
+
+    def testCriteria(self):
+        parser = self.parse(['from-sql -addr_column=address %s ok'
+                             % self.select], self.factory)
+        self.assertEqual(self.firstmatch(parser, 'friend@example.com'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(self.firstmatch(parser, 'foe@example.com'), {})
+
+    def testActionColumn(self):
+        parser = self.parse(['from-sql -addr_column=address'
+                             ' -action_column=action %s ok' % self.select],
+                            self.factory)
+        self.assertEqual(self.firstmatch(parser, 'boss@example.com'),
+                         {'incoming': ('hold', None)})
+
+    def testWildcards(self):
+        parser = self.parse(['from-sql -wildcards %s ok' % self.wildcards],
+                            self.factory)
+        self.assertEqual(self.firstmatch(parser, 'pal@trusted.com'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(self.firstmatch(parser, 'boss@example.com'),
+                         {'incoming': ('hold', None)})
+
+    def testSharedQuery(self):
+        parser = self.parse(['from-sql -wildcards %s drop' % self.wildcards,
+                             'to-sql -wildcards %s ok' % self.wildcards,
+                             'from nobody@nowhere.com bounce'], self.factory)
+        self.assertEqual(self.firstmatch(parser, 'nobody@nowhere.com'),
+                         {'incoming': ('bounce', None)})
+        # One pass over the three rows, for both rules.
+        self.assertEqual(self.queries, 3)
+        # The next message makes its own query.
+        self.firstmatch(parser, 'nobody@nowhere.com')
+        self.assertEqual(self.queries, 6)
+
+    def testStatementCache(self):
+        FilterParser._sqlcache.clear()
+        parser = self.parse(['from-sql -addr_column=address %s ok'
+                             % self.select], self.factory)
+        self.firstmatch(parser, 'a@example.com')
+        self.firstmatch(parser, 'b@example.com')
+        self.assertEqual(len(FilterParser._sqlcache), 1)
+        parser.firstmatch('nobody@nowhere.com',
+                          ['a@example.com', 'b@example.com'])
+        self.assertEqual(len(FilterParser._sqlcache), 2)
+
+    def testConnectionReused(self):
+        parser = self.parse(['from-sql -addr_column=address %s ok'
+                             % self.select], self.factory)
+        self.firstmatch(parser, 'friend@example.com')
+        self.firstmatch(parser, 'friend@example.com')
+        self.assertEqual(len(self.connections), 1)
+
+    def testHealthCheck(self):
+        Defaults.DB_CHECK_INTERVAL = 0
+        parser = self.parse(['from-sql -addr_column=address %s ok'
+                             % self.select], self.factory)
+        self.firstmatch(parser, 'friend@example.com')
+        self.connections[0].close()
+        self.assertEqual(self.firstmatch(parser, 'friend@example.com'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(len(self.connections), 2)
+
+    def testReconnectOnFailure(self):
+        parser = self.parse(['from-sql -addr_column=address %s ok'
+                             % self.select], self.factory)
+        self.firstmatch(parser, 'friend@example.com')
+        # Too recently used to be checked; the query fails and is retried.
+        self.connections[0].close()
+        self.assertEqual(self.firstmatch(parser, 'friend@example.com'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(len(self.connections), 2)
+
+    def testPlainConnection(self):
+        db = self.connect()
+        self.connections.append(db)
+        parser = self.parse(['from-sql -addr_column=address %s ok'
+                             % self.select], db)
+        self.assertEqual(self.firstmatch(parser, 'friend@example.com'),
+                         {'incoming': ('ok', None)})
+
+class InsertTests(SQLTestMixin, unittest.TestCase):
+    insert = 'INSERT INTO whitelist (address) VALUES (%(sender)s)'
+
+    def testInsert(self):
+        FilterParser.Util.db_insert(self.factory, self.insert,
+                                    {'sender': 'new@example.com'})
+        # Already there.
+        FilterParser.Util.db_insert(self.factory, self.insert,
+                                    {'sender': 'friend@example.com'})
+        self.assertTrue('new@example.com' in self.rows())
+
+    def insertAll(self, senders):
+        for sender in senders:
+            FilterParser.Util.db_insert(self.factory, self.insert,
+                                        {'sender': sender})
+
+    def testBatch(self):
+        batch = SQL.InsertBatch(self.factory)
+        self.insertAll(['a@example.com', 'b@example.com'])
+        self.assertFalse('a@example.com' in self.rows())
+        batch.finish()
+        self.assertTrue('a@example.com' in self.rows())
+        self.assertTrue('b@example.com' in self.rows())
+        self.assertEqual(len(self.connections), 1)
+        # Closed, so rows are committed as they come again.
+        self.insertAll(['c@example.com'])
+        self.assertTrue('c@example.com' in self.rows())
+
+    def testBatchFailure(self):
+        batch = SQL.InsertBatch(self.factory)
+        self.insertAll(['a@example.com', 'friend@example.com',
+                        'b@example.com'])
+        batch.finish()
+        rows = self.rows()
+        self.assertTrue('a@example.com' in rows)
+        self.assertTrue('b@example.com' in rows)
+        self.assertEqual(rows.count('friend@example.com'), 1)
+
+class PrepareTests(unittest.TestCase):
+    statement = "SELECT a FROM t WHERE b = %(x)s AND c LIKE '%%' || %(y)s"
+
+    def prepare(self, paramstyle):
+        class Module:
+            pass
+        Module.paramstyle = paramstyle
+        saved = SQL.module
+        SQL.module = lambda conn: Module
+        try:
+            return SQL.prepare(None, self.statement)
+        finally:
+            SQL.module = saved
+
+    def testParamstyles(self):
+        self.assertEqual(self.prepare('pyformat'), (self.statement, None))
+        self.assertEqual(self.prepare('qmark'),
+                         ("SELECT a FROM t WHERE b = ? AND c LIKE '%' || ?",
+                          ['x', 'y']))
+        self.assertEqual(self.prepare('named'),
+                         ("SELECT a FROM t WHERE b = :x AND c LIKE '%' || :y",
+                          None))
+        self.assertEqual(self.prepare('numeric'),
+                         ("SELECT a FROM t WHERE b = :1 AND c LIKE '%' || :2",
+                          ['x', 'y']))
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)